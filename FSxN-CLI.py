@@ -1,35 +1,535 @@
+# boto3, botocore, asyncio and statistics are imported where they are used, so `-h`
+# and argument errors return before any of them is loaded. See benchmarks/startup.py.
 import argparse
-import boto3
+import base64
+import functools
 import time
 import logging
+import hashlib
+import json
+import gzip
+import os
+import random
+import math
+import re
+import shlex
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 
-# Set the log level in the basic configuration.  This means we will capture all our log entries and not just those at Warning or above.
-logging.basicConfig(
-    filename='FSxN-CLI.log',
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Local directory for caches and run state. Override with the FSXN_CLI_HOME environment variable.
+STATE_DIR = os.environ.get('FSXN_CLI_HOME', os.path.join(os.path.expanduser('~'), '.fsxn-cli'))
+
+# How long (in seconds) each kind of cached lookup stays valid
+CACHE_TTL = {
+    'account': 30 * 24 * 3600,
+    'vpc': 24 * 3600,
+    'subnets': 6 * 3600,
+    'security_group': 6 * 3600,
+    'ami': 6 * 3600,
+}
+
+# Number of subnets in distinct availability zones discovery looks for; a Multi-AZ file system needs two
+SUBNET_ZONES = 2
+
+# Subnets requested per describe_subnets page, so discovery can stop after the first pages of a large VPC
+SUBNET_PAGE_SIZE = 100
+
+# Maximum number of entries kept in the discovery cache; the least recently used are dropped first
+CACHE_MAX_ENTRIES = 512
+
+# Settings of an AWS profile, and environment variables, that decide which account its credentials belong to
+CREDENTIAL_IDENTITY_SETTINGS = ['aws_access_key_id', 'role_arn', 'source_profile', 'credential_source', 'web_identity_token_file',
+                                'sso_session', 'sso_start_url', 'sso_account_id', 'sso_role_name', 'credential_process']
+CREDENTIAL_IDENTITY_VARIABLES = ['AWS_ACCESS_KEY_ID', 'AWS_ROLE_ARN', 'AWS_WEB_IDENTITY_TOKEN_FILE']
+
+# Account ID in the ARN of an IAM role
+ROLE_ARN_PATTERN = re.compile(r'^arn:aws[a-z-]*:iam::([0-9]{12}):')
+
+# Prefixes of the operations in each API family
+API_FAMILIES = {
+    'describe': ('Describe', 'Get', 'List'),
+    'create': ('Create', 'Run', 'Copy'),
+    'delete': ('Delete', 'Terminate'),
+}
+
+# Error codes that mean a call was throttled
+THROTTLE_ERRORS = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+    'EC2ThrottledException',
+]
+
+# The rate limiter never slows a bucket below this many calls per second
+RATE_LIMIT_FLOOR = 0.1
+
+# Error codes returned by create calls when an ID we passed in no longer exists
+REJECTED_ID_ERRORS = [
+    'InvalidSubnetID.NotFound',
+    'InvalidGroup.NotFound',
+    'InvalidAMIID.NotFound',
+    'InvalidAMIID.Unavailable',
+    'InvalidNetworkSettings',
+]
+
+# Lifecycle values of each kind of resource, and what the waiter does with them
+LIFECYCLE = {
+    'file_system': {
+        'ready': ['AVAILABLE'],
+        'pending': ['CREATING', 'UPDATING'],
+        'misconfigured': ['MISCONFIGURED', 'MISCONFIGURED_UNAVAILABLE'],
+        'failed': ['FAILED', 'DELETING'],
+    },
+    'svm': {
+        'ready': ['CREATED'],
+        'pending': ['CREATING', 'PENDING'],
+        'misconfigured': ['MISCONFIGURED'],
+        'failed': ['FAILED', 'DELETING'],
+    },
+    'volume': {
+        'ready': ['CREATED', 'AVAILABLE'],
+        'pending': ['CREATING', 'PENDING'],
+        'misconfigured': ['MISCONFIGURED'],
+        'failed': ['FAILED', 'DELETING'],
+    },
+}
+
+# Describe API, ID parameter, response list and ID field of each kind of FSx resource
+DESCRIBE_APIS = {
+    'file_system': ('describe_file_systems', 'FileSystemIds', 'FileSystems', 'FileSystemId'),
+    'svm': ('describe_storage_virtual_machines', 'StorageVirtualMachineIds', 'StorageVirtualMachines', 'StorageVirtualMachineId'),
+    'volume': ('describe_volumes', 'VolumeIds', 'Volumes', 'VolumeId'),
+}
+
+# Maximum number of IDs sent in one describe request
+DESCRIBE_BATCH_SIZE = 50
+
+# Typical creation time (in seconds) of each kind of resource, used until the local history has samples
+DEFAULT_DURATIONS = {
+    'file_system': 30 * 60,
+    'svm': 8 * 60,
+    'volume': 60,
+}
+
+# Polling behaviour of the lifecycle waiter (intervals and timeouts in seconds)
+WAITER_SETTINGS = {
+    'min_interval': 5,          # Never poll more often than this
+    'max_interval': 120,        # Never poll less often than this
+    'busy_fraction': 0.6,       # Poll rarely until this fraction of the expected duration has passed
+    'dense_fraction': 0.01,     # Near the expected completion, poll every expected * dense_fraction seconds
+    'jitter': 0.2,              # Randomise each interval by +/- this fraction
+    'misconfigured_grace': 300, # Give up if a resource stays MISCONFIGURED for this long
+    'history_size': 20,         # Number of past durations kept per resource kind and deployment type
+    'timeout': {
+        'file_system': 3 * 3600,
+        'svm': 3600,
+        'volume': 3600,
+    },
+}
+
+# Define throughput capacity based on deployment type
+VALID_THROUGHPUT_GEN1 = [128, 256, 512, 1024, 2048, 4096]
+VALID_THROUGHPUT_GEN2 = [384, 768, 1536, 3072, 6144]
+
+# Throughput capacity per HA pair of a SINGLE_AZ_2 file system with more than one HA pair, and the most HA pairs it can have
+VALID_THROUGHPUT_PER_HA_PAIR = [1536, 3072, 6144]
+MAX_HA_PAIRS = 12
+
+# SSD IOPS included with every GiB of storage, and the most SSD IOPS one HA pair can be provisioned with at each throughput capacity
+INCLUDED_IOPS_PER_GIB = 3
+MAX_SSD_IOPS = {
+    128: 6000,
+    256: 12000,
+    512: 20000,
+    1024: 40000,
+    2048: 80000,
+    4096: 160000,
+    384: 18750,
+    768: 37500,
+    1536: 75000,
+    3072: 150000,
+    6144: 200000,
+}
+
+# Settings of a workload profile given to the capacity planner, and the stack settings a plan fills in
+WORKLOAD_FIELDS = ['throughput', 'iops', 'working_set', 'read_percent', 'multi_az']
+PLAN_FIELDS = ['deployment_type', 'storage_capacity', 'throughput_capacity', 'ha_pairs', 'disk_iops']
+
+# Sizing guidelines of the capacity planner, not AWS limits: how full the SSD tier may get, the spare throughput and IOPS
+# kept on top of the workload, and how much more a write costs than a read on Multi-AZ, which also sends it to the standby
+PLAN_SSD_FILL = 0.8
+PLAN_HEADROOM = 1.2
+MULTI_AZ_WRITE_COST = 2
+
+# SSM parameter holding the latest Amazon Linux 2023 AMI
+AMI_PARAMETER = '/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-6.12-x86_64'
+
+# Instance type of a client fleet: network-optimized, with enhanced networking
+CLIENT_FLEET_INSTANCE_TYPE = 'c6in.xlarge'
+
+# Baseline network bandwidth (in Gbps) of client instance types, used to size a client fleet; 1 Gbps carries 125 MB/s
+NETWORK_BANDWIDTH = {
+    't3.medium': 0.256,
+    't3.large': 0.512,
+    't3.xlarge': 1.024,
+    'm5.large': 0.75,
+    'm5.xlarge': 1.25,
+    'c5n.large': 3,
+    'c5n.xlarge': 5,
+    'c5n.2xlarge': 10,
+    'c5n.4xlarge': 15,
+    'c5n.9xlarge': 50,
+    'c6in.large': 3.125,
+    'c6in.xlarge': 6.25,
+    'c6in.2xlarge': 12.5,
+    'c6in.4xlarge': 25,
+    'c6in.8xlarge': 50,
+    'm6in.large': 3.125,
+    'm6in.xlarge': 6.25,
+    'm6in.2xlarge': 12.5,
+    'm6in.4xlarge': 25,
+    'm6in.8xlarge': 50,
+}
+
+# NFS versions the clients can mount with; both support nconnect
+NFS_VERSIONS = ['3', '4.1']
+
+# Tuning of the clients' NFS mounts, sizing guidelines of this script rather than limits: the MB/s one NFS connection
+# carries (EC2 caps a single flow at 5 Gbps), the most connections Linux opens per mount, the read and write size
+# below and from a throughput capacity (the server lowers it to its own maximum), and the attribute cache timeout
+# in seconds of a single client and of a fleet, whose clients must see each other's writes
+NFS_CONNECTION_THROUGHPUT = 300
+NFS_MAX_CONNECTIONS = 16
+NFS_TRANSFER_SIZE = (262144, 1048576)
+NFS_LARGE_TRANSFER_THROUGHPUT = 512
+NFS_ATTRIBUTE_CACHE = {'single': 600, 'fleet': 3}
+
+# Where the clients mount each volume's junction path, and the largest user-data EC2 accepts (in bytes)
+MOUNT_ROOT = '/mnt/fsx'
+MAX_USER_DATA = 16384
+
+# fio job matrix of the benchmark stage; every job runs once per queue depth of --fio-iodepths
+FIO_JOBS = {
+    'seqread': {'rw': 'read', 'bs': '1M'},
+    'seqwrite': {'rw': 'write', 'bs': '1M'},
+    'randread': {'rw': 'randread', 'bs': '4k'},
+    'randwrite': {'rw': 'randwrite', 'bs': '4k'},
+    'mixed': {'rw': 'randrw', 'bs': '4k', 'rwmixread': 70},
+}
+
+# Options shared by every fio job. Each of the numjobs processes of a client writes one file of FIO_FILE_SIZE GiB,
+# which every job reuses, and the completion latency percentiles kept are those of FIO_PERCENTILES.
+FIO_FILE_SIZE = 4
+FIO_GLOBAL_OPTIONS = {
+    'ioengine': 'libaio',
+    'direct': 1,
+    'time_based': 1,
+    'ramp_time': 5,
+    'size': f"{FIO_FILE_SIZE}G",
+    'numjobs': 4,
+    'group_reporting': 1,
+    'filename_format': 'fsxn.$jobnum',
+    'percentile_list': '50:99:99.9',
+}
+FIO_PERCENTILES = {'p50': '50.000000', 'p99': '99.000000', 'p99.9': '99.900000'}
+
+# fio read/write modes held against the throughput capacity; the others are held against the SSD IOPS
+FIO_SEQUENTIAL = ['read', 'write', 'rw']
+
+# Share of the provisioned throughput or IOPS the best fio job must reach
+FIO_TARGET_FRACTION = 0.8
+
+# Seconds the fio stage allows for installing fio, waiting for the mount and laying out the files
+FIO_SETUP_SECONDS = 1800
+
+# SSM Run Command: seconds between polls, how long clients may take to register, the final invocation states
+# and the most output characters it returns inline
+SSM_POLL_INTERVAL = 15
+SSM_REGISTRATION_TIMEOUT = 15 * 60
+SSM_FINAL_STATUSES = ['Success', 'Cancelled', 'TimedOut', 'Failed']
+SSM_MAX_OUTPUT = 24000
+
+# Settings a manifest may set per stack (the CLI values are the defaults)
+STACK_FIELDS = [
+    'name', 'region', 'tags', 'volumes', 'storage_capacity', 'svm_name', 'volume_size', 'volume_name', 'admin_password',
+    'instance_type', 'key_pair', 'security_group', 'deployment_type', 'snapmirror', 'snapmirror_type', 'throughput_capacity',
+    'volume_concurrency', 'destination_region', 'ha_pairs', 'disk_iops', 'workload', 'tiering', 'cooling_period',
+    'storage_efficiency', 'snapshot_policy', 'volume_style', 'aggregates', 'constituents', 'clients', 'client_throughput',
+    'placement_group', 'mount', 'nfs_version', 'instance_profile',
+]
+
+# Settings of one volume in a volume list; only name is required
+VOLUME_FIELDS = ['name', 'size', 'junction_path', 'type', 'security_style', 'snapshot_policy', 'tiering', 'cooling_period', 'storage_efficiency',
+                 'style', 'aggregates', 'constituents']
+
+# Data placement profiles of a volume and the FSx tiering policy of each
+TIERING_PROFILES = {
+    'hot': 'NONE',
+    'auto': 'AUTO',
+    'snapshot-only': 'SNAPSHOT_ONLY',
+    'archive': 'ALL',
+}
+
+# Days data must go unread before the auto and snapshot-only profiles move it to the capacity pool
+COOLING_PERIOD_LIMITS = (2, 183)
+
+# Smallest and largest SSD storage capacity (in GiB) of each deployment type
+STORAGE_CAPACITY_LIMITS = {
+    'MULTI_AZ_1': (1024, 196608),
+    'SINGLE_AZ_1': (1024, 196608),
+    'MULTI_AZ_2': (1024, 524288),
+    'SINGLE_AZ_2': (1024, 1048576),
+}
+
+# Smallest and largest FlexVol volume (in MiB)
+VOLUME_SIZE_LIMITS = (20, 300 * 1024 * 1024)
+
+# Storage capacity (in GiB) below which a throughput tier is mostly unused; a sizing guideline of this script, not an AWS limit
+MIN_STORAGE_PER_THROUGHPUT = {
+    1024: 2048,
+    1536: 2048,
+    2048: 4096,
+    3072: 4096,
+    4096: 8192,
+    6144: 8192,
+}
+
+# FlexGroup volumes: the constituents each aggregate can hold, how many are used by default, the smallest constituent
+# and the largest FlexGroup (in GiB). Each HA pair of a file system has one aggregate, aggr1 to aggr<HA pairs>.
+FLEXGROUP_CONSTITUENTS_PER_AGGREGATE = (1, 200)
+FLEXGROUP_DEFAULT_CONSTITUENTS = 8
+FLEXGROUP_MIN_CONSTITUENT_SIZE = 100
+FLEXGROUP_MAX_SIZE = 20 * 1024 * 1024
+AGGREGATE_PATTERN = re.compile(r'^aggr([1-9][0-9]*)$')
+
+# Names ONTAP accepts for SVMs and volumes, and the limits on tags
+SVM_NAME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]{0,46}$')
+VOLUME_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]{0,202}$')
+MAX_TAGS = 50
+MAX_TAG_KEY_LENGTH = 128
+MAX_TAG_VALUE_LENGTH = 256
+
+# Tag added to everything this script creates, so the inventory can find its instances
+TOOL_TAG = {'Key': 'created-by', 'Value': 'FSxN-CLI'}
+
+# Schema of the local inventory: one row per resource, its tags, and when each region was last listed
+INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    id TEXT PRIMARY KEY, account TEXT, region TEXT, kind TEXT, name TEXT, parent_id TEXT,
+    file_system_id TEXT, lifecycle TEXT, created REAL, updated REAL, details TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (resource_id TEXT, key TEXT, value TEXT, PRIMARY KEY (resource_id, key));
+CREATE TABLE IF NOT EXISTS refreshes (account TEXT, region TEXT, refreshed REAL, PRIMARY KEY (account, region));
+CREATE INDEX IF NOT EXISTS resources_name ON resources (account, region, kind, name);
+CREATE INDEX IF NOT EXISTS resources_parent ON resources (parent_id);
+CREATE INDEX IF NOT EXISTS resources_file_system ON resources (file_system_id);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+"""
+
+# Kinds of resources the inventory keeps
+INVENTORY_KINDS = ['file_system', 'svm', 'volume', 'instance']
+
+# Lifecycle values of resources that are on their way out; they never count as name collisions
+GONE_LIFECYCLES = ['DELETING', 'FAILED', 'shutting-down', 'terminated']
+
+# Check the throughput capacity against the deployment type and fill in its default
+def check_throughput(deployment_type, throughput_capacity, ha_pairs=1):
+    """With more than one HA pair, `throughput_capacity` is the total of all of them"""
+    if ha_pairs != 1:
+        if deployment_type != 'SINGLE_AZ_2' or not 1 <= ha_pairs <= MAX_HA_PAIRS:
+            raise Exception(f"Only SINGLE_AZ_2 can have more than one HA pair, and at most {MAX_HA_PAIRS}")
+        if throughput_capacity is None:
+            return VALID_THROUGHPUT_PER_HA_PAIR[0] * ha_pairs
+        if throughput_capacity % ha_pairs or throughput_capacity // ha_pairs not in VALID_THROUGHPUT_PER_HA_PAIR:
+            raise Exception(f"With {ha_pairs} HA pairs, throughput capacity must be {ha_pairs} times one of: {VALID_THROUGHPUT_PER_HA_PAIR}")
+        return throughput_capacity
+
+    if deployment_type in ['MULTI_AZ_1', 'SINGLE_AZ_1']:
+        valid_throughput, default = VALID_THROUGHPUT_GEN1, 128 # Default value for 1st gen.
+    else: # For second generation
+        valid_throughput, default = VALID_THROUGHPUT_GEN2, 384 # Default value for 2nd gen.
+
+    if throughput_capacity is None:
+        return default
+    if throughput_capacity not in valid_throughput:
+        raise Exception(f"For {deployment_type}, throughput capacity must be one of: {valid_throughput}")
+    return throughput_capacity
+
+# Smallest and largest storage capacity (in GiB) of a deployment type with `ha_pairs` HA pairs
+def storage_limits(deployment_type, ha_pairs=1):
+    low, high = STORAGE_CAPACITY_LIMITS[deployment_type]
+    if ha_pairs == 1:
+        return low, high
+    return low * ha_pairs, min(high, STORAGE_CAPACITY_LIMITS['MULTI_AZ_2'][1] * ha_pairs)
+
+# Size a file system for a workload profile
+def plan_capacity(workload):
+    """`workload` has throughput (MB/s), working_set (GiB), and optionally iops, read_percent (default 70)
+    and multi_az (default false). Every deployment that meets it is considered, and the one with the least
+    throughput capacity wins, since that is most of the price; ties go to fewer HA pairs, then to the
+    second generation. Returns the PLAN_FIELDS settings plus `reasons`, the steps that led to them."""
+    for key in workload:
+        if key not in WORKLOAD_FIELDS:
+            raise Exception(f"Unknown workload setting: {key}")
+    if 'throughput' not in workload or 'working_set' not in workload:
+        raise Exception("A workload needs throughput (MB/s) and working_set (GiB)")
+    throughput, working_set = workload['throughput'], workload['working_set']
+    iops, read_percent, multi_az = workload.get('iops', 0), workload.get('read_percent', 70), bool(workload.get('multi_az', False))
+    if throughput <= 0 or working_set <= 0 or iops < 0 or not 0 <= read_percent <= 100:
+        raise Exception("Workload throughput and working_set must be positive, iops not negative and read_percent between 0 and 100")
+    reasons = []
+
+    write_cost = MULTI_AZ_WRITE_COST if multi_az else 1
+    needed_throughput = math.ceil(throughput * (read_percent + (100 - read_percent) * write_cost) / 100 * PLAN_HEADROOM)
+    reasons.append(f"{throughput} MB/s at {read_percent}% reads" + (f", writes counted {write_cost}x for the Multi-AZ standby" if multi_az else '')
+                   + f", plus {round((PLAN_HEADROOM - 1) * 100)}% headroom: at least {needed_throughput} MB/s of throughput capacity")
+    needed_storage = math.ceil(working_set / PLAN_SSD_FILL)
+    reasons.append(f"{working_set} GiB working set kept on SSD at most {round(PLAN_SSD_FILL * 100)}% full: at least {needed_storage} GiB of storage")
+    needed_iops = math.ceil(iops * PLAN_HEADROOM)
+    if iops:
+        reasons.append(f"{iops} IOPS plus {round((PLAN_HEADROOM - 1) * 100)}% headroom: at least {needed_iops} SSD IOPS")
+
+    # Every deployment that could serve the workload, as (throughput capacity, HA pairs, deployment type, throughput per HA pair)
+    candidates = []
+    for deployment_type in ['MULTI_AZ_1', 'MULTI_AZ_2'] if multi_az else ['SINGLE_AZ_1', 'SINGLE_AZ_2']:
+        if deployment_type.endswith('_1'):
+            options = [(1, per_pair) for per_pair in VALID_THROUGHPUT_GEN1]
+        elif deployment_type == 'MULTI_AZ_2':
+            options = [(1, per_pair) for per_pair in VALID_THROUGHPUT_GEN2]
+        else:
+            # One HA pair takes every second generation size; only scale-out file systems are limited to the larger ones
+            options = [(1, per_pair) for per_pair in VALID_THROUGHPUT_GEN2]
+            options += [(pairs, per_pair) for pairs in range(2, MAX_HA_PAIRS + 1) for per_pair in VALID_THROUGHPUT_PER_HA_PAIR]
+        for pairs, per_pair in options:
+            if (pairs * per_pair >= needed_throughput and pairs * MAX_SSD_IOPS[per_pair] >= needed_iops
+                    and storage_limits(deployment_type, pairs)[1] >= needed_storage):
+                candidates.append((pairs * per_pair, pairs, deployment_type.endswith('_1'), deployment_type, per_pair))
+    if not candidates:
+        raise Exception(f"No {'Multi-AZ' if multi_az else 'Single-AZ'} FSx for ONTAP file system provides {needed_throughput} MB/s, "
+                        f"{needed_iops} SSD IOPS and {needed_storage} GiB")
+    throughput_capacity, ha_pairs, _, deployment_type, per_pair = min(candidates)
+    reasons.append(f"{deployment_type} with {ha_pairs} HA pair(s) of {per_pair} MB/s is the smallest of {len(candidates)} deployments that fit"
+                   + (f" (up to {ha_pairs * MAX_SSD_IOPS[per_pair]} SSD IOPS)" if iops else ''))
+
+    storage_capacity = max(needed_storage, storage_limits(deployment_type, ha_pairs)[0], MIN_STORAGE_PER_THROUGHPUT.get(per_pair, 0) * ha_pairs)
+    if storage_capacity > needed_storage:
+        reasons.append(f"Storage raised to {storage_capacity} GiB, the least that {deployment_type} with {throughput_capacity} MB/s should have")
+    disk_iops = None
+    if needed_iops > storage_capacity * INCLUDED_IOPS_PER_GIB:
+        disk_iops = needed_iops
+        reasons.append(f"{storage_capacity} GiB includes {storage_capacity * INCLUDED_IOPS_PER_GIB} SSD IOPS; provision {disk_iops}")
+    else:
+        reasons.append(f"The {storage_capacity * INCLUDED_IOPS_PER_GIB} SSD IOPS included with {storage_capacity} GiB are enough")
+    return {'deployment_type': deployment_type, 'storage_capacity': storage_capacity, 'throughput_capacity': throughput_capacity,
+            'ha_pairs': ha_pairs, 'disk_iops': disk_iops, 'reasons': reasons}
+
+# Number of client instances: a positive number, or auto
+def client_count(value):
+    if value == 'auto':
+        return value
+    if isinstance(value, bool) or not str(value).isdigit() or int(value) < 1:
+        raise ValueError(f"Clients must be a positive number or auto, not {value}")
+    return int(value)
+
+# Number of clients of an instance type it takes to drive `throughput` MB/s
+def fleet_size(instance_type, throughput):
+    """Each client is counted at its baseline network bandwidth, the rate it can sustain; bursts do not count"""
+    if instance_type not in NETWORK_BANDWIDTH:
+        raise Exception(f"Network bandwidth of {instance_type} is unknown; set the number of clients instead of auto, "
+                        f"or use one of {', '.join(NETWORK_BANDWIDTH)}")
+    return max(1, math.ceil(throughput / (NETWORK_BANDWIDTH[instance_type] * 125)))
+
+# Options of the AWS clients, shared by every command
+def add_aws_arguments(parser):
+    parser.add_argument(
+        '--api-rate',
+        type=float,
+        default=2,
+        help='Maximum calls per second to each family of AWS APIs (describe, create, delete) per service and region, with bursts of twice that (default: 2)'
+    )
+
+    parser.add_argument(
+        '--max-attempts',
+        type=int,
+        default=10,
+        help='Attempts per AWS call, with adaptive retry backoff between them (default: 10)'
+    )
+
+    parser.add_argument(
+        '--max-pool-connections',
+        type=int,
+        default=50,
+        help='HTTP connections kept open per AWS client (default: 50)'
+    )
+
+# Check the options added by add_aws_arguments
+def check_aws_arguments(parser, args):
+    if args.max_attempts < 1 or args.max_pool_connections < 1:
+        parser.error("--max-attempts and --max-pool-connections must be at least 1")
+    if args.api_rate <= 0:
+        parser.error("--api-rate must be greater than 0")
+
+# Accept both "-r us-east-1 us-west-2" and "-r us-east-1,us-west-2"
+def split_regions(parser, values):
+    regions = list(dict.fromkeys(name for value in values for name in value.split(',') if name))
+    if 'all-enabled' in regions and len(regions) > 1:
+        parser.error("--region all-enabled cannot be combined with other regions")
+    return regions
+
+# Accept both "--aggregates aggr1 aggr2" and "--aggregates aggr1,aggr2"
+def split_aggregates(parser, values):
+    """Whether an aggregate exists depends on each stack's HA pairs, which preflight checks"""
+    aggregates = [name for value in values for name in value.split(',') if name]
+    for name in aggregates:
+        if not AGGREGATE_PATTERN.match(name):
+            parser.error(f"--aggregates: {name} is not an aggregate name like aggr1")
+    if len(set(aggregates)) != len(aggregates):
+        parser.error("--aggregates: each aggregate can only be given once")
+    return aggregates
 
 # define function for CLIs
-def parse_args():
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # --resume replays the arguments of the run it continues; arguments given after it still win
+    resume_parser = argparse.ArgumentParser(prog='FSxN-CLI', add_help=False)
+    resume_parser.add_argument('--resume')
+    resume, rest = resume_parser.parse_known_args(argv)
+    run_argv = argv
+    if resume.resume:
+        if not os.path.exists(run_state_path(resume.resume)):
+            resume_parser.error(f"no saved state for run {resume.resume} in {os.path.dirname(run_state_path(resume.resume))}")
+        run_argv = RunState(resume.resume).data['argv']
+        argv = run_argv + rest + ['--resume', resume.resume]
+
     parser = argparse.ArgumentParser(
         description='FSx ONTAP and EC2 Resource Creation Script',
-        prog='FSxN-CLI'
+        prog='FSxN-CLI',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join([
+            'other commands (run FSxN-CLI <command> -h for their options):',
+            '  destroy      Delete the resources of a run, a tag or a manifest',
+            '  inventory    Refresh or query the local index of FSx resources and client instances',
+            '  plan         Size a file system for a workload, without calling AWS',
+            '  fio-report   Compare recorded fio output with a file system, without calling AWS',
+        ])
     )
 
-    # Define throughput capacity based on deployment type
-    valid_throughput_gen1 = [128, 256, 512, 1024, 2048, 4096]
-    valid_throughput_gen2 = [384, 768, 1536, 3072, 6144]
-    
     # Required arguments
     parser.add_argument(
         '-r', 
         '--region', 
         type=str, 
-        default='ap-southeast-2',
-        nargs='?',
-        help='AWS region (default: ap-southeast-2)'
+        default=['ap-southeast-2'],
+        nargs='+',
+        help='One or more AWS regions, or all-enabled for every region enabled in the account (default: ap-southeast-2)'
     )
 
     parser.add_argument(
@@ -99,9 +599,73 @@ def parse_args():
         '-it', 
         '--instance-type', 
         type=str, 
-        default='t3.medium',
         nargs='?',
-        help='EC2 instance type (default: t3.medium)'
+        help=f'EC2 instance type (default: t3.medium, or {CLIENT_FLEET_INSTANCE_TYPE} for a client fleet)'
+    )
+
+    parser.add_argument(
+        '--clients',
+        type=client_count,
+        default=1,
+        help='''Number of client instances, launched together in the file system's preferred availability zone,
+        or auto for as many as it takes to drive --client-throughput (default: 1)'''
+    )
+
+    parser.add_argument(
+        '--client-throughput',
+        type=int,
+        metavar='MBPS',
+        help='Throughput in MB/s the clients must be able to drive with --clients auto (default: the throughput capacity)'
+    )
+
+    parser.add_argument(
+        '--placement-group',
+        metavar='NAME',
+        help='Launch the clients into this cluster placement group, created if it does not exist'
+    )
+
+    parser.add_argument(
+        '--no-mount',
+        dest='mount',
+        action='store_false',
+        help=f'''Launch the clients right away with no user-data, instead of once the SVM exists
+        with user-data that mounts every volume under {MOUNT_ROOT}'''
+    )
+
+    parser.add_argument(
+        '--nfs-version',
+        choices=NFS_VERSIONS,
+        default='4.1',
+        help='NFS version of the client mounts (default: 4.1)'
+    )
+
+    parser.add_argument(
+        '--instance-profile',
+        metavar='NAME',
+        help='IAM instance profile of the clients; --fio needs one with the AmazonSSMManagedInstanceCore policy'
+    )
+
+    parser.add_argument(
+        '--fio',
+        action='store_true',
+        help='After provisioning, run a fio job matrix on the clients through SSM Run Command and compare the results with the provisioned throughput and IOPS'
+    )
+
+    parser.add_argument(
+        '--fio-runtime',
+        type=int,
+        default=30,
+        metavar='SECONDS',
+        help='Run time of each fio job (default: 30)'
+    )
+
+    parser.add_argument(
+        '--fio-iodepths',
+        type=int,
+        nargs='+',
+        default=[1, 32],
+        metavar='DEPTH',
+        help=f'Queue depths each of the fio jobs {", ".join(FIO_JOBS)} runs at (default: 1 32)'
     )
     
     parser.add_argument(
@@ -118,8 +682,8 @@ def parse_args():
         '-s', 
         '--snapmirror', 
         type=str, 
-        choices=['yes', 'no'],
-        help='Enable or disable snapmirror (default: Disabled)', 
+        choices=['yes', 'no', 'pair'],
+        help='Enable or disable snapmirror, or pair to create the source and destination stacks together (default: Disabled)', 
         default='no',
         nargs='?'
     )
@@ -131,6 +695,12 @@ def parse_args():
         choices=['src', 'dest'],
         help='Snapmirror type (required if snapmirror is yes)'
     )
+
+    parser.add_argument(
+        '--destination-region',
+        type=str,
+        help='Region of the destination stack with --snapmirror pair (default: the source region)'
+    )
     
     parser.add_argument(
         '-tc', 
@@ -138,297 +708,3362 @@ def parse_args():
         type=int,
         nargs='?',
         help=f'''Throughput capacity in MB/s. 
-        For MULTI_AZ_1/SINGLE_AZ_1: {valid_throughput_gen1} (default: 128)
-        For MULTI_AZ_2/SINGLE_AZ_2: {valid_throughput_gen2} (default: 384)'''
+        For MULTI_AZ_1/SINGLE_AZ_1: {VALID_THROUGHPUT_GEN1} (default: 128)
+        For MULTI_AZ_2/SINGLE_AZ_2: {VALID_THROUGHPUT_GEN2} (default: 384)
+        With --ha-pairs, the total of all HA pairs'''
+    )
+
+    parser.add_argument(
+        '--ha-pairs',
+        type=int,
+        default=1,
+        help=f'HA pairs of a scale-out SINGLE_AZ_2 file system, each with {VALID_THROUGHPUT_PER_HA_PAIR} MB/s (default: 1)'
+    )
+
+    parser.add_argument(
+        '--disk-iops',
+        type=int,
+        help=f'SSD IOPS to provision (default: {INCLUDED_IOPS_PER_GIB} per GiB of storage)'
+    )
+
+    parser.add_argument(
+        '--plan',
+        metavar='PATH',
+        help='Take the deployment type, storage, throughput, HA pairs and SSD IOPS from a plan saved by the plan command'
     )
     
-    args = parser.parse_args()
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument(
+        '--refresh-cache',
+        dest='cache_mode',
+        action='store_const',
+        const='refresh',
+        help='Ignore cached VPC/subnet/security group/AMI lookups and store fresh ones'
+    )
 
-    # Validate snapmirror-type requirement
-    if args.snapmirror.lower() == 'yes' and not args.snapmirror_type:
-        parser.error("--snapmirror-type is required when --snapmirror is set to 'yes'")
+    cache_mode.add_argument(
+        '--no-cache',
+        dest='cache_mode',
+        action='store_const',
+        const='off',
+        help='Neither read nor write the discovery cache'
+    )
+    parser.set_defaults(cache_mode='on')
 
-    # Set key-pair default value to region if not specified
-    if args.key_pair is None:
-        args.key_pair = args.region
+    parser.add_argument(
+        '--subnet-min-free-ips',
+        type=int,
+        default=16,
+        help='Only use subnets with at least this many free IP addresses (default: 16)'
+    )
 
-    # Set security group default value to default if not specified
-    if args.security_group is None:
-        args.security_group = 'default'
+    parser.add_argument(
+        '--subnet-tag',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Only use subnets with this tag; repeat for several tags'
+    )
 
-    # Validate throughput capacity based on deployment type
-    if args.deployment_type in ['MULTI_AZ_1', 'SINGLE_AZ_1']:
-        if args.throughput_capacity is None:
-            args.throughput_capacity = 128 # Default value for 1st gen.
-        elif args.throughput_capacity not in valid_throughput_gen1:
-            parser.error(f" For {args.deployment_type}, throughput capacity must be one of: {valid_throughput_gen1}")
+    parser.add_argument(
+        '--resume',
+        metavar='RUN_ID',
+        help='Continue an earlier run with its original arguments, reusing every resource it already created'
+    )
 
-    else: # For second generation
-        if args.throughput_capacity is None:
-            args.throughput_capacity = 384 # Default value for 2nd gen.
-        elif args.throughput_capacity not in valid_throughput_gen2:
-            parser.error(f" For {args.deployment_type}, throughput capacity must be one of: {valid_throughput_gen2}")        
-    
-    return args
+    parser.add_argument(
+        '--volumes',
+        metavar='PATH',
+        help='YAML or JSON list of volumes to create on the SVM instead of the single -vn/-vs volume'
+    )
 
-def get_fsx_inputs(args):
-    """Process FSx inputs from command line arguments"""
-    deployment_type = args.deployment_type.upper()
-    snapmirror = args.snapmirror.lower()
-    snapmirror_type = args.snapmirror_type.lower() if args.snapmirror_type else None
-    
-    return deployment_type, snapmirror, snapmirror_type
+    parser.add_argument(
+        '--volume-concurrency',
+        type=int,
+        default=8,
+        help='Number of volumes of one SVM created at the same time (default: 8)'
+    )
 
-# Get Security group
-def get_security_group(sg_name):
-    response = ec2_client.describe_security_groups(
-        Filters = [{'Name': 'group-name', 'Values': [sg_name]}]
+    parser.add_argument(
+        '--volume-style',
+        choices=['flexvol', 'flexgroup'],
+        default='flexvol',
+        help='Create FlexVol volumes, on one aggregate, or FlexGroup volumes spread over several (default: flexvol)'
     )
-    
-    if not response['SecurityGroups']:
-        logging.error(f"No security group found with name: {sg_name}")
-        raise Exception(f"No security group found with name: {sg_name}") 
-    
-    security_group = response['SecurityGroups'][0]['GroupId']
-    return security_group
 
-# Get default VPC
-def get_default_vpc():
-    response = ec2_client.describe_vpcs(
-        Filters=[{
-            'Name': 'is-default',
-            'Values':['true']
-        }]
+    parser.add_argument(
+        '--aggregates',
+        nargs='+',
+        help='Aggregates of a FlexGroup volume, e.g. aggr1 aggr2 (default: every aggregate, one per HA pair)'
     )
 
-    if not response['Vpcs']:
-        logging.error(f"No default VPC found in this region")
-        return None
-    
-    default_vpc = response['Vpcs'][0]['VpcId']
-    return default_vpc
+    parser.add_argument(
+        '--constituents',
+        type=int,
+        help=f'Constituents of a FlexGroup volume, spread evenly over its aggregates (default: up to {FLEXGROUP_DEFAULT_CONSTITUENTS} per aggregate, '
+             f'fewer if the volume size leaves less than {FLEXGROUP_MIN_CONSTITUENT_SIZE} GiB for each)'
+    )
 
-# Get subnets in default VPC
-def get_subnets(vpc_id):
-    response = ec2_client.describe_subnets(
-        Filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    parser.add_argument(
+        '--tiering',
+        choices=list(TIERING_PROFILES),
+        default='archive',
+        help='''Where volume data lives: hot keeps it on SSD, auto moves data not read for --cooling-period days
+        to the capacity pool, snapshot-only moves only snapshot data, archive moves everything (default: archive)'''
     )
 
-    if not response['Subnets']:
-        logging.error(f"No subnets found in the VPC: {vpc_id}")
-        raise Exception(f"No subnets found in the VPC: {vpc_id}")
-    
-    subnets = []
-    for subnet in response['Subnets']:
-        subnets.append(subnet['SubnetId'])
-    return subnets
+    parser.add_argument(
+        '--cooling-period',
+        type=int,
+        metavar='DAYS',
+        help=f'Days before cold data is tiered with auto or snapshot-only, {COOLING_PERIOD_LIMITS[0]} to {COOLING_PERIOD_LIMITS[1]} (default: 31 for auto, 2 for snapshot-only)'
+    )
 
-# Get AMI Id through SSM parameter
-def get_ami(parameter_name):
-    response = ssm_client.get_parameter(Name = parameter_name)
-    ami_id = response['Parameter']['Value']
-    return ami_id
+    parser.add_argument(
+        '--no-storage-efficiency',
+        dest='storage_efficiency',
+        action='store_false',
+        help='Turn off deduplication, compression and compaction on the volumes'
+    )
 
-# Create file system
-def create_file_system():
-    logging.info(f"Creating FSx file system: {snapmirror_type}..." if snapmirror == 'yes' else f"Creating FSx file system: {deployment_type}_{region}...")
-    if deployment_type in ['SINGLE_AZ_1', 'SINGLE_AZ_2']:
-        response = fsx_client.create_file_system(
-            FileSystemType = 'ONTAP',
-            StorageCapacity = storage_capacity,
-            SubnetIds = subnet_ids[:1],
-            SecurityGroupIds = [get_security_group(security_group)], # SG needs to be changed as per your use case.
-            OntapConfiguration={
-                'AutomaticBackupRetentionDays' : 0,
-                'DeploymentType' : deployment_type,
-                'FsxAdminPassword' : admin_password,
-                'ThroughputCapacity' : throughput_capacity
-            },
-            Tags = [{'Key': 'Name', 'Value': f"{snapmirror_type}" if snapmirror == 'yes' else f"{deployment_type}_{region}"}]
-        )
-    else:
-        response = fsx_client.create_file_system(
-            FileSystemType = 'ONTAP',
-            StorageCapacity = storage_capacity,
-            SubnetIds = subnet_ids[:2],
-            SecurityGroupIds = [get_security_group(security_group)], # SG needs to be changed as per your use case.
-            OntapConfiguration={
-                'AutomaticBackupRetentionDays' : 0,
-                'DeploymentType' : deployment_type,
-                'FsxAdminPassword' : admin_password,
-                'ThroughputCapacity' : throughput_capacity,
-                'PreferredSubnetId' : f"{subnet_ids[0]}"
-            },
-            Tags = [{'Key': 'Name', 'Value': f"{snapmirror_type}" if snapmirror == 'yes' else f"{deployment_type}_{region}"}]            
-        )
-        
-    file_system_id = response['FileSystem']['FileSystemId']
-    logging.info(f"File system creation initiated: {file_system_id}")
-    return file_system_id
+    parser.add_argument(
+        '--snapshot-policy',
+        default='none',
+        help='Snapshot policy of the volumes: none, default, default-1weekly, default-30min or a custom policy (default: none)'
+    )
 
-# Wait for file system to become available
-def wait_for_file_system(file_system_id):
-    logging.info(f"Waiting for file system {file_system_id} to become available...")
-    while True:
-        response = fsx_client.describe_file_systems(FileSystemIds=[file_system_id])
-        status = response['FileSystems'][0]['Lifecycle']
-        if status == 'AVAILABLE':
-            logging.info(f"File system {file_system_id} is now available.")
-            break
-        elif status in ['FAILED', 'DELETING']:
-            logging.error(f"File system creation failed with status: {status}")
-            raise Exception(f"File system creation failed with status: {status}")
-        time.sleep(30)
+    parser.add_argument(
+        '--preflight-only',
+        action='store_true',
+        help='Check the stacks against the FSx limits and the cached discovery results, then exit without creating anything'
+    )
 
-# Create storage virtual machine
-def create_svm(file_system_id):
-    logging.info(f"Creating SVM: {svm_name}_{snapmirror_type}..." if snapmirror == 'yes' else f"Creating SVM: {svm_name}...")
-    response = fsx_client.create_storage_virtual_machine(
-        FileSystemId = file_system_id,
-        Name = f"{svm_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{svm_name}",
-        RootVolumeSecurityStyle = 'UNIX',
+    parser.add_argument(
+        '--wait-timeout',
+        type=int,
+        help='Give up waiting for any single resource after this many minutes (default: 180 for file systems, 60 for SVMs and volumes)'
     )
-    svm_id = response['StorageVirtualMachine']['StorageVirtualMachineId']
-    logging.info(f"SVM creation initiated: {svm_id}")
-    return svm_id
 
-# Wait for SVM to become available
-def wait_for_svm(svm_id):
-    logging.info(f"Waiting for {svm_id} to become available...")
-    while True:
-        response = fsx_client.describe_storage_virtual_machines(StorageVirtualMachineIds=[svm_id])
-        status = response['StorageVirtualMachines'][0]['Lifecycle']
-        if status == 'CREATED':
-            logging.info(f"SVM {svm_id} is now active")
-            break
-        elif status in ['FAILED', 'DELETING']:
-            logging.error(f"SVM creation failed with status: {status}")
-            raise Exception(f"SVM creation failed with status: {status}")
-        time.sleep(15)
+    parser.add_argument(
+        '-m',
+        '--manifest',
+        type=str,
+        help='YAML or JSON file listing many stacks to provision; command line values are the defaults for every stack'
+    )
 
-# Create volume
-def create_volume(svm_id):
-    logging.info(f"Creating data volume {volume_name}_{snapmirror_type}..." if snapmirror == 'yes' else f"Creating data volume {volume_name}...")
-    if (snapmirror == 'yes' and snapmirror_type == 'dest'):
-        response = fsx_client.create_volume(
-            Name = f"{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{volume_name}",
-            VolumeType = 'ONTAP',
-            OntapConfiguration = {        
-                'SizeInMegabytes': volume_size*1024,
-                'StorageVirtualMachineId': svm_id,
-                'TieringPolicy' : {
-                    'Name': 'ALL'
-                },
-                'OntapVolumeType': 'DP',
-            }
-        )
-    else:
-        response = fsx_client.create_volume(
-            Name = f"{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{volume_name}",
-            VolumeType = 'ONTAP',
-            OntapConfiguration = {        
-                'SizeInMegabytes': volume_size*1024,
-                'StorageVirtualMachineId': svm_id,
-                'JunctionPath': f"/{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"/{volume_name}",
-                'SecurityStyle': 'UNIX',
-                'StorageEfficiencyEnabled': True,
-                'TieringPolicy' : {
-                    'Name': 'ALL'
-                },
-                'OntapVolumeType': 'RW',
-                'SnapshotPolicy': 'none'
-            }
-        )
-    volume_id = response['Volume']['VolumeId']
-    logging.info(f"Volume creation initiated: {volume_id}")
-    return volume_id
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        default=4,
+        help='Number of stacks provisioned at the same time (default: 4)'
+    )
 
-# Wait for volume to become available
-def wait_for_volume(volume_id):
-    logging.info(f"Waiting for volume {volume_id} to become available...")
-    while True:
-        response = fsx_client.describe_volumes(VolumeIds=[volume_id])
-        status = response['Volumes'][0]['Lifecycle']
-        if status == 'CREATED':
-            logging.info(f"Volume {volume_id} is now available")
-            break
-        elif status in ['FAILED', 'DELETING']:
-            logging.error(f"Volume creation failed with status: {status}")
-            raise Exception(f"Volume creation failed with status: {status}")
-        time.sleep(15)
-
-# Create EC2 instance
-def create_ec2():
-    logging.info(f"Creating EC2 instance...")
-    response = ec2_client.run_instances(
-        ImageId = image_id,
-        InstanceType = instance_type,
-        KeyName = key_pair,
-        SubnetId = subnet_ids[0],
-        MaxCount = 1,
-        MinCount = 1,
-        SecurityGroupIds = [get_security_group(security_group)], # SG needs to be changed as per your use case.
-        TagSpecifications = [{
-            'ResourceType': 'instance',
-            'Tags':[{'Key': 'Name', 'Value': f"{snapmirror_type}" if snapmirror == 'yes' else f"{deployment_type}_client_{region}"}]
-        }]
+    add_aws_arguments(parser)
+
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'async'],
+        default='threads',
+        help='Drive provisioning with a thread per step or with one asyncio event loop (default: threads)'
     )
 
-    instance_id = response['Instances'][0]['InstanceId']
-    logging.info(f"EC2 Instance launched: {instance_id}")
-    return instance_id
+    parser.add_argument(
+        '--async-workers',
+        type=int,
+        default=32,
+        help='Threads available to the async engine for blocking AWS calls (default: 32)'
+    )
 
-def main():
-    # Parse command line arguments
-    args = parse_args()
-    
-    # Initialize clients with region from args
-    global region
-    region = args.region
-
-    global fsx_client, ec2_client, ssm_client
-    fsx_client = boto3.client('fsx', region_name=region)
-    ec2_client = boto3.client('ec2', region_name=region)
-    ssm_client = boto3.client('ssm', region_name=region)
-    
-    # Use the parsed arguments in your existing variables
-    global storage_capacity, svm_name, volume_size, volume_name, admin_password, instance_type, throughput_capacity, key_pair, security_group
-    storage_capacity = args.storage_capacity
-    svm_name = args.svm_name
-    volume_size = args.volume_size
-    volume_name = args.volume_name
-    admin_password = args.admin_password
-    instance_type = args.instance_type
-    throughput_capacity = args.throughput_capacity
-    key_pair = args.key_pair
-    security_group = args.security_group
-    
-    # Get other required variables
-    global subnet_ids, image_id, deployment_type, snapmirror, snapmirror_type
-    subnet_ids = get_subnets(get_default_vpc())
-    image_id = get_ami(f"/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-6.12-x86_64")
-    deployment_type, snapmirror, snapmirror_type = get_fsx_inputs(args)
+    parser.add_argument(
+        '--report',
+        metavar='PATH',
+        help='Append the JSON-lines timing report of the run to this file (default: ~/.fsxn-cli/runs/<run-id>.report.jsonl)'
+    )
 
-    try:
-        file_system_id = create_file_system()
-        wait_for_file_system(file_system_id)
+    parser.add_argument(
+        '--prometheus-file',
+        metavar='PATH',
+        help='Also write the run metrics in Prometheus text format, e.g. for the node_exporter textfile collector'
+    )
 
-        svm_id = create_svm(file_system_id)
-        wait_for_svm(svm_id)
+    # A manifest stack can set a workload profile instead, which is planned when the stack is built
+    parser.set_defaults(workload=None)
 
-        volume_id = create_volume(svm_id)
-        wait_for_volume(volume_id)
+    args = parser.parse_args(argv)
+    args.argv = run_argv
 
-        instance_id = create_ec2()
-    
-        print(f"All resource created successfully!")
-        logging.debug(f"File System ID: {file_system_id}")
-        logging.debug(f"SVM ID: {svm_id}")
-        logging.debug(f"Volume ID: {volume_id}")
-        logging.debug(f"EC2 instance ID: {instance_id}")
-        
-    except Exception as e:
-        logging.error(f"Error: {str(e)}")
+    # Validate snapmirror-type requirement
+    if args.snapmirror.lower() == 'yes' and not args.snapmirror_type:
+        parser.error("--snapmirror-type is required when --snapmirror is set to 'yes'")
+    if args.snapmirror.lower() == 'pair' and args.snapmirror_type:
+        parser.error("--snapmirror-type cannot be used with --snapmirror pair, which creates both")
+    if args.destination_region and args.snapmirror.lower() != 'pair':
+        parser.error("--destination-region is only used with --snapmirror pair")
+
+    args.region = split_regions(parser, args.region)
+
+    # Set security group default value to default if not specified
+    if args.security_group is None:
+        args.security_group = 'default'
+
+    if args.plan:
+        try:
+            plan = load_document(args.plan)
+            for key in PLAN_FIELDS:
+                setattr(args, key, plan[key])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error(f"{args.plan} is not a plan saved by the plan command: {str(e)}")
+
+    # Validate throughput capacity based on deployment type
+    try:
+        args.throughput_capacity = check_throughput(args.deployment_type, args.throughput_capacity, args.ha_pairs)
+    except Exception as e:
+        parser.error(f" {str(e)}")
+
+    if args.max_workers < 1:
+        parser.error("--max-workers must be at least 1")
+    if args.async_workers < 1:
+        parser.error("--async-workers must be at least 1")
+    if any('=' not in tag for tag in args.subnet_tag):
+        parser.error("--subnet-tag must be KEY=VALUE")
+    if args.volume_concurrency < 1:
+        parser.error("--volume-concurrency must be at least 1")
+    if args.aggregates:
+        args.aggregates = split_aggregates(parser, args.aggregates)
+    if (args.aggregates or args.constituents) and args.volume_style != 'flexgroup':
+        parser.error("--aggregates and --constituents are only used with --volume-style flexgroup")
+    if args.fio_runtime < 1 or min(args.fio_iodepths) < 1:
+        parser.error("--fio-runtime and --fio-iodepths must be at least 1")
+    check_aws_arguments(parser, args)
+    
+    return args
+
+# Command line of the destroy command
+def parse_destroy_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Delete the EC2 instances, placement groups, volumes, SVMs and file systems of a run, a tag or a manifest',
+        prog='FSxN-CLI destroy'
+    )
+
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        '--run',
+        metavar='RUN_ID',
+        help='Everything created by this run, and every other volume and SVM of its file systems'
+    )
+
+    target.add_argument(
+        '--tag',
+        action='append',
+        metavar='KEY=VALUE',
+        help=f"File systems and instances created by this script (tagged {TOOL_TAG['Key']}={TOOL_TAG['Value']}) with this tag; "
+             'repeat to require several tags'
+    )
+
+    target.add_argument(
+        '-m',
+        '--manifest',
+        help=f"The file systems and instances named by the stacks of this manifest, if tagged {TOOL_TAG['Key']}={TOOL_TAG['Value']}"
+    )
+
+    parser.add_argument(
+        '-r',
+        '--region',
+        default=['ap-southeast-2'],
+        nargs='+',
+        help='Regions searched with --tag and --manifest, or all-enabled (default: ap-southeast-2)'
+    )
+
+    parser.add_argument(
+        '--yes',
+        action='store_true',
+        help='Delete the resources; without it the resources are only listed'
+    )
+
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        default=8,
+        help='Delete calls made at the same time in each region (default: 8)'
+    )
+
+    parser.add_argument(
+        '--wait-timeout',
+        type=int,
+        help='Give up waiting for a tier to be deleted after this many minutes (default: 180 for file systems, 60 for the others)'
+    )
+
+    add_aws_arguments(parser)
+    # Settings configure() reads that destroy has no use for
+    parser.set_defaults(cache_mode='on', resume=None, async_workers=1, subnet_min_free_ips=0, subnet_tag=[])
+
+    args = parser.parse_args(argv)
+    args.argv = ['destroy'] + list(argv)
+    args.region = split_regions(parser, args.region)
+    if args.tag and any('=' not in tag for tag in args.tag):
+        parser.error("--tag must be KEY=VALUE")
+    if args.max_workers < 1:
+        parser.error("--max-workers must be at least 1")
+    check_aws_arguments(parser, args)
+    return args
+
+# Command line of the inventory command
+def parse_inventory_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Keep a local index of FSx for ONTAP file systems, SVMs and volumes, and of the instances this script created',
+        prog='FSxN-CLI inventory'
+    )
+    actions = parser.add_subparsers(dest='action', required=True)
+
+    refresh = actions.add_parser('refresh', help='List the resources of each region and update the index')
+    refresh.add_argument(
+        '-r',
+        '--region',
+        default=['ap-southeast-2'],
+        nargs='+',
+        help='Regions to list, or all-enabled (default: ap-southeast-2)'
+    )
+
+    refresh.add_argument(
+        '--max-age',
+        type=int,
+        help='Skip regions listed less than this many minutes ago'
+    )
+
+    add_aws_arguments(refresh)
+
+    query = actions.add_parser('query', help='Search the index; makes no AWS call')
+    query.add_argument(
+        '--kind',
+        choices=INVENTORY_KINDS,
+        help='Only this kind of resource'
+    )
+
+    query.add_argument(
+        '--name',
+        help='Name, or Name tag of instances; * and ? are wildcards'
+    )
+
+    query.add_argument(
+        '--tag',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Only resources with this tag; repeat to require several tags'
+    )
+
+    query.add_argument(
+        '--parent',
+        metavar='ID',
+        help='Only the SVMs of this file system, or the volumes of this SVM'
+    )
+
+    query.add_argument(
+        '--has-volume',
+        metavar='NAME',
+        help='Only file systems and SVMs with a volume of this name; * and ? are wildcards'
+    )
+
+    query.add_argument(
+        '-r',
+        '--region',
+        nargs='+',
+        help='Only these regions (default: every region in the index)'
+    )
+
+    query.add_argument(
+        '--all',
+        action='store_true',
+        help='Include resources that are being deleted, failed or terminated'
+    )
+    query.set_defaults(api_rate=2, max_attempts=10, max_pool_connections=50)
+
+    # Settings configure() reads that the inventory has no use for
+    parser.set_defaults(cache_mode='on', resume=None, async_workers=1, subnet_min_free_ips=0, subnet_tag=[], wait_timeout=None)
+
+    args = parser.parse_args(argv)
+    args.argv = ['inventory'] + list(argv)
+    if args.region:
+        args.region = split_regions(parser, args.region)
+    if args.action == 'refresh':
+        check_aws_arguments(parser, args)
+        if args.max_age is not None and args.max_age < 0:
+            parser.error("--max-age must not be negative")
+    elif any('=' not in tag for tag in args.tag):
+        parser.error("--tag must be KEY=VALUE")
+    return args
+
+# Command line of the plan command
+def parse_plan_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Size an FSx for ONTAP file system for a workload: deployment type, storage, throughput, HA pairs and SSD IOPS',
+        prog='FSxN-CLI plan'
+    )
+
+    parser.add_argument(
+        '--throughput',
+        type=int,
+        required=True,
+        help='Throughput the clients need, in MB/s'
+    )
+
+    parser.add_argument(
+        '--iops',
+        type=int,
+        default=0,
+        help='IOPS the clients need (default: 0, only what the storage includes)'
+    )
+
+    parser.add_argument(
+        '--working-set',
+        type=int,
+        required=True,
+        help='Data that must stay on SSD, in GiB'
+    )
+
+    parser.add_argument(
+        '--read-percent',
+        type=int,
+        default=70,
+        help='Share of reads in the traffic, 0 to 100 (default: 70)'
+    )
+
+    parser.add_argument(
+        '--multi-az',
+        action='store_true',
+        help='Plan a Multi-AZ file system'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='PATH',
+        help='Save the plan as JSON, for --plan'
+    )
+
+    args = parser.parse_args(argv)
+    args.workload = {'throughput': args.throughput, 'iops': args.iops, 'working_set': args.working_set,
+                     'read_percent': args.read_percent, 'multi_az': args.multi_az}
+    return args
+
+# Command line of the fio-report command
+def parse_fio_report_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Summarize recorded fio JSON output and compare it with a file system's throughput capacity and SSD IOPS, without calling AWS",
+        prog='FSxN-CLI fio-report'
+    )
+
+    parser.add_argument(
+        'outputs',
+        nargs='+',
+        metavar='PATH',
+        help='Output of fio --output-format=json, one file per client'
+    )
+
+    parser.add_argument(
+        '-tc',
+        '--throughput-capacity',
+        type=int,
+        required=True,
+        help='Throughput capacity of the file system in MB/s'
+    )
+
+    parser.add_argument(
+        '--iops',
+        type=int,
+        required=True,
+        help='SSD IOPS of the file system'
+    )
+
+    args = parser.parse_args(argv)
+    if args.throughput_capacity < 1 or args.iops < 1:
+        parser.error("--throughput-capacity and --iops must be at least 1")
+    return args
+
+def get_fsx_inputs(args):
+    """Process FSx inputs from command line arguments"""
+    deployment_type = args.deployment_type.upper()
+    snapmirror = args.snapmirror.lower()
+    snapmirror_type = args.snapmirror_type.lower() if args.snapmirror_type else None
+    
+    return deployment_type, snapmirror, snapmirror_type
+
+# Every ID in a cached value: a string, or a list of strings or of dicts of them
+def cached_ids(value):
+    if isinstance(value, dict):
+        return [item for nested in value.values() for item in cached_ids(nested)]
+    if isinstance(value, list):
+        return [item for nested in value for item in cached_ids(nested)]
+    return [value]
+
+# Persistent cache for read-only discovery lookups
+class DiscoveryCache:
+    """On-disk cache of lookups keyed by account, region and query.
+
+    `mode` is 'on' (read and write), 'refresh' (write only) or 'off'.
+    Entries expire after CACHE_TTL[kind] seconds and the cache keeps at
+    most CACHE_MAX_ENTRIES, evicting the least recently used ones.
+    """
+
+    def __init__(self, path, mode='on'):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.account_lock = threading.Lock()
+        self.account = None
+        self.identity = None
+        self.entries = self._load() if mode != 'off' else {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def account_id(self, region):
+        """Resolve the account ID once per credential identity, so cache hits cost no API call"""
+        # Lookups start in parallel; only the first one resolves the account, the others wait for it
+        with self.account_lock:
+            if self.account is None:
+                identity, account = self._identity()
+                lookup = lambda: account or make_client(new_session(), 'sts', region).get_caller_identity()['Account']
+                self.account = lookup() if self.mode == 'off' else self._lookup(f"identity/{identity}", 'account', lookup)
+        return self.account
+
+    def cached_account(self):
+        """The account ID if it is already known, without calling AWS; otherwise None"""
+        if self.account is not None or self.mode != 'on':
+            return self.account
+        try:
+            identity, account = self._identity()
+        except Exception:
+            # No usable AWS configuration yet; the run itself will report that
+            return None
+        if account:
+            return account
+        with self.lock:
+            entry = self.entries.get(f"identity/{identity}")
+        if not entry or time.time() - entry['stored'] >= CACHE_TTL['account']:
+            return None
+        return entry['value']
+
+    def _lookup(self, key, kind, lookup):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if self.mode == 'on' and entry and now - entry['stored'] < CACHE_TTL[kind]:
+                entry['used'] = now
+                return entry['value']
+
+        # Call AWS outside the lock so independent lookups still run in parallel
+        value = lookup()
+        if value is None:
+            return value
+
+        with self.lock:
+            self.entries[key] = {'value': value, 'stored': now, 'used': now}
+            if len(self.entries) > CACHE_MAX_ENTRIES:
+                for old_key in sorted(self.entries, key=lambda k: self.entries[k]['used'])[:len(self.entries) - CACHE_MAX_ENTRIES]:
+                    del self.entries[old_key]
+            self._save()
+        return value
+
+    def _identity(self):
+        """Hash of the profile and the settings that pick its credentials, and the account ID when they name it
+        (an SSO account or a role ARN). Only the environment and the AWS config files are read: fetching the
+        credentials can itself call STS, SSO or the instance metadata service, and temporary ones change on
+        every refresh, while these settings do not."""
+        if self.identity is None:
+            import botocore.session
+            session = botocore.session.get_session()
+            config = session.get_scoped_config()
+            settings = {'profile': session.get_config_variable('profile') or 'default',
+                        **{name: config.get(name) for name in CREDENTIAL_IDENTITY_SETTINGS},
+                        **{name: os.environ.get(name) for name in CREDENTIAL_IDENTITY_VARIABLES}}
+            role_arn = ROLE_ARN_PATTERN.match(settings['AWS_ROLE_ARN'] or settings['role_arn'] or '')
+            account = settings['sso_account_id'] or (role_arn.group(1) if role_arn else None)
+            self.identity = (hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16], account)
+        return self.identity
+
+    def peek(self, region, kind, query):
+        """Return the cached value for `query` in `region`, or None; never calls AWS"""
+        account = self.cached_account()
+        if self.mode != 'on' or account is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(f"{account}/{region}/{kind}/{query}")
+        if not entry or time.time() - entry['stored'] >= CACHE_TTL[kind]:
+            return None
+        return entry['value']
+
+    def get(self, region, kind, query, lookup):
+        """Return the cached value for `query` in `region`, calling `lookup()` on a miss"""
+        if self.mode == 'off':
+            return lookup()
+        return self._lookup(f"{self.account_id(region)}/{region}/{kind}/{query}", kind, lookup)
+
+    def invalidate(self, ids):
+        """Drop every entry whose value contains one of `ids`"""
+        if self.mode == 'off':
+            return
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if any(value in ids for value in cached_ids(entry['value']))]
+            for key in stale:
+                logging.warning(f"Dropping rejected cache entry: {key}")
+                del self.entries[key]
+            if stale:
+                self._save()
+
+# Call a create API, dropping any cached IDs it rejects
+def call_with_cached_ids(api_call, cached_ids, **kwargs):
+    from botocore.exceptions import ClientError
+    try:
+        return api_call(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in REJECTED_ID_ERRORS:
+            logging.error(f"{e.response['Error']['Code']}: cached discovery data was invalidated, rerun to look it up again")
+            discovery_cache.invalidate(cached_ids)
+        raise
+
+# Local history of how long resources took to become ready
+class DurationHistory:
+    """Durations of past runs per resource kind and deployment type, stored as JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.samples = json.load(f)
+        except (OSError, ValueError):
+            self.samples = {}
+
+    def expected(self, kind, profile):
+        """Median of past durations, or the default for this kind of resource"""
+        import statistics
+        samples = self.samples.get(f"{kind}/{profile}")
+        return statistics.median(samples) if samples else DEFAULT_DURATIONS[kind]
+
+    def record(self, kind, profile, seconds):
+        with self.lock:
+            samples = self.samples.setdefault(f"{kind}/{profile}", [])
+            samples.append(round(seconds, 1))
+            del samples[:-WAITER_SETTINGS['history_size']]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.samples, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logging.warning(f"Could not save duration history: {str(e)}")
+
+# Path of the state file of a run
+def run_state_path(run_id):
+    return os.path.join(STATE_DIR, 'runs', f"{run_id}.state.jsonl")
+
+# Local record of one provisioning run
+class RunState:
+    """Arguments, finished steps and resource lifecycles of one run.
+
+    Every change is appended to the state file as one JSON line, so saving
+    costs the same however many stacks the run has. Loading replays the
+    lines; `--resume <run-id>` uses this to skip steps that already
+    finished and to wait only on resources that are not ready yet.
+    """
+
+    def __init__(self, run_id=None, argv=None):
+        self.run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        self.path = run_state_path(self.run_id)
+        self.lock = threading.Lock()
+        self.data = {'run_id': self.run_id, 'argv': argv or [], 'stacks': {}, 'resources': {}}
+        # Set when a killed run left the last line unfinished, so the next change starts a new line
+        self.torn = False
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    self.torn = not line.endswith('\n')
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        logging.warning(f"Ignoring a damaged line in {self.path}")
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, change):
+        if 'argv' in change:
+            self.data['argv'] = change['argv']
+        elif 'resource' in change:
+            self.data['resources'][change['resource']] = change['lifecycle']
+        else:
+            stack = self.data['stacks'].setdefault(change['stack'], {'steps': {}, 'status': 'IN_PROGRESS'})
+            if 'step' in change:
+                stack['steps'][change['step']] = change['result']
+            if 'status' in change:
+                stack['status'] = change['status']
+                stack['error'] = change.get('error')
+
+    def _append(self, change):
+        self._apply(change)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # The arguments can include the admin password, so only the owner may read the file
+        with open(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), 'a') as f:
+            f.write(('\n' if self.torn else '') + json.dumps(change) + '\n')
+        self.torn = False
+
+    def start(self, stack_keys):
+        with self.lock:
+            if not os.path.exists(self.path):
+                self._append({'run_id': self.run_id, 'argv': self.data['argv']})
+            for key in stack_keys:
+                if key not in self.data['stacks']:
+                    self._append({'stack': key, 'status': 'IN_PROGRESS'})
+
+    def result(self, stack_key, step):
+        """Result of a step an earlier attempt of this run finished, or None"""
+        with self.lock:
+            return self.data['stacks'].get(stack_key, {}).get('steps', {}).get(step)
+
+    def record(self, stack_key, step, value):
+        with self.lock:
+            self._append({'stack': stack_key, 'step': step, 'result': value})
+
+    def steps(self, stack_key):
+        """Results of every step of a stack finished so far"""
+        with self.lock:
+            return dict(self.data['stacks'].get(stack_key, {}).get('steps', {}))
+
+    def known(self, resource_id):
+        """True if an earlier poll of this run saw the resource"""
+        with self.lock:
+            return resource_id in self.data['resources']
+
+    def lifecycle(self, resource_id, status):
+        """Remember the last known Lifecycle (or EC2 state) of a resource"""
+        with self.lock:
+            if self.data['resources'].get(resource_id) != status:
+                self._append({'resource': resource_id, 'lifecycle': status})
+
+    def finish(self, stack_key, status, error=None):
+        with self.lock:
+            self._append({'stack': stack_key, 'status': status, 'error': error})
+
+    def token(self, stack_key, step):
+        """Idempotency token of a create call; the same for every attempt of the same run"""
+        return hashlib.sha256(f"{self.run_id}/{stack_key}/{step}".encode()).hexdigest()[:32]
+
+# Local index of FSx resources and of the instances this script created
+class Inventory:
+    """SQLite copy of what exists in each account and region.
+
+    `inventory refresh` fills it from paginated describes and only writes
+    the rows whose Lifecycle, name or tags changed. Each run adds what it
+    created, and destroy removes what it deleted. Lookups by name, tag or
+    parent use indexes, so they never need a scan of the account.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        """The database, created on first use; sqlite3 is only loaded then"""
+        if self._db is None:
+            import sqlite3
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            with self._db:
+                self._db.executescript(INVENTORY_SCHEMA)
+        return self._db
+
+    def sync(self, account, region, rows, kinds=None):
+        """Store `rows` (dicts with id, kind, name, parent_id, file_system_id, lifecycle, created, tags, details).
+
+        When `kinds` is given the rows are a complete listing of those kinds
+        in the region, and resources of those kinds that are missing from it
+        are removed. Returns the number of rows added, changed and removed.
+        """
+        now = time.time()
+        added = changed = 0
+        with self.lock, self.db:
+            stored = {}
+            for row in self.db.execute("SELECT id, kind, name, lifecycle FROM resources WHERE account = ? AND region = ?", (account, region)):
+                stored[row['id']] = (row['kind'], row['name'], row['lifecycle'], {})
+            for row in self.db.execute("SELECT t.resource_id, t.key, t.value FROM tags t JOIN resources r ON r.id = t.resource_id"
+                                       " WHERE r.account = ? AND r.region = ?", (account, region)):
+                stored[row['resource_id']][3][row['key']] = row['value']
+
+            for row in rows:
+                previous = stored.pop(row['id'], None)
+                if previous == (row['kind'], row['name'], row['lifecycle'], row['tags']):
+                    continue
+                added += previous is None
+                changed += previous is not None
+                self.db.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (row['id'], account, region, row['kind'], row['name'], row.get('parent_id'), row.get('file_system_id'),
+                                 row['lifecycle'], row.get('created'), now, json.dumps(row.get('details', {}))))
+                self.db.execute("DELETE FROM tags WHERE resource_id = ?", (row['id'],))
+                self.db.executemany("INSERT INTO tags VALUES (?, ?, ?)", [(row['id'], key, value) for key, value in row['tags'].items()])
+
+            gone = [resource_id for resource_id, (kind, _, _, _) in stored.items() if kinds and kind in kinds]
+            self._remove(gone)
+            if kinds:
+                self.db.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)", (account, region, now))
+        return added, changed, len(gone)
+
+    def _remove(self, ids):
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            self.db.execute(f"DELETE FROM resources WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            self.db.execute(f"DELETE FROM tags WHERE resource_id IN ({','.join('?' * len(chunk))})", chunk)
+
+    def remove(self, ids):
+        with self.lock, self.db:
+            self._remove(list(ids))
+
+    def refreshed(self, account, region):
+        """When the region was last listed completely, or None"""
+        if self._db is None and not os.path.exists(self.path):
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT refreshed FROM refreshes WHERE account = ? AND region = ?", (account, region)).fetchone()
+        return row['refreshed'] if row else None
+
+    def query(self, account=None, region=None, kind=None, name=None, tags=None, parent_id=None, has_volume=None, include_gone=False):
+        """Rows matching every given condition; `name` may use * wildcards, `has_volume` keeps
+        file systems and SVMs with a volume of that name"""
+        conditions, values = [], []
+        for column, value in [('account', account), ('kind', kind), ('parent_id', parent_id)]:
+            if value:
+                conditions.append(f"r.{column} = ?")
+                values.append(value)
+        if region:
+            regions = [region] if isinstance(region, str) else list(region)
+            conditions.append(f"r.region IN ({','.join('?' * len(regions))})")
+            values += regions
+        if name:
+            conditions.append("r.name GLOB ?")
+            values.append(name)
+        for key, value in (tags or {}).items():
+            conditions.append("EXISTS (SELECT 1 FROM tags t WHERE t.resource_id = r.id AND t.key = ? AND t.value = ?)")
+            values += [key, value]
+        if has_volume:
+            conditions.append("EXISTS (SELECT 1 FROM resources v WHERE v.kind = 'volume' AND v.name GLOB ? AND (v.parent_id = r.id OR v.file_system_id = r.id))")
+            values.append(has_volume)
+        if not include_gone:
+            conditions.append(f"r.lifecycle NOT IN ({','.join('?' * len(GONE_LIFECYCLES))})")
+            values += GONE_LIFECYCLES
+        # Nothing was ever recorded; do not create an empty database just to look
+        if self._db is None and not os.path.exists(self.path):
+            return []
+        with self.lock:
+            return [dict(row) for row in self.db.execute(
+                "SELECT * FROM resources r" + (f" WHERE {' AND '.join(conditions)}" if conditions else '') + " ORDER BY region, kind, name, id", values)]
+
+# Prometheus help text of each per-operation API counter
+API_METRICS = {
+    'calls': 'AWS API calls per operation',
+    'retries': 'Retried attempts of AWS API calls',
+    'throttles': 'Throttled attempts of AWS API calls',
+    'errors': 'AWS API calls that failed',
+    'seconds': 'Wall time of AWS API calls, including retries but not rate limiting',
+}
+
+# Quote a Prometheus label value
+def prometheus_label(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+# Timings of one run, exported as a JSON-lines report and a Prometheus textfile
+class RunMetrics:
+    """Wall time of every step, polls and time per Lifecycle of every wait, and AWS API call counts.
+
+    Step and wait records are collected while the run is going. API call
+    counts are read from api_stats when the run is exported.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.records = []
+
+    def _add(self, record):
+        with self.lock:
+            self.records.append({'run_id': self.run_id, 'time': round(time.time(), 3), **record})
+
+    def step(self, stack, step, seconds, status):
+        """`status` is 'ok', 'failed', 'cancelled' or 'skipped' (finished by an earlier attempt of the run)"""
+        self._add({
+            'type': 'step', 'stack': stack.name or file_system_name(stack), 'region': stack.region,
+            'deployment_type': stack.deployment_type, 'step': step, 'status': status, 'seconds': round(seconds, 3),
+        })
+
+    def wait(self, waiter, status):
+        self._add({
+            'type': 'wait', 'kind': waiter.kind, 'resource_id': waiter.resource_id, 'region': waiter.region,
+            'deployment_type': waiter.profile, 'status': status, 'seconds': round(waiter.elapsed(), 3),
+            'expected_seconds': round(waiter.expected, 3), 'polls': waiter.polls,
+            'lifecycle_seconds': {state: round(seconds, 3) for state, seconds in waiter.state_seconds.items()},
+        })
+
+    def mount(self, stack, svm_id, dns_name, options, user_data):
+        """How the clients of a stack mount its volumes, with the user-data they were launched with"""
+        self._add({
+            'type': 'mount', 'stack': stack.name or file_system_name(stack), 'region': stack.region, 'svm_id': svm_id,
+            'dns_name': dns_name, 'options': options, 'user_data': user_data,
+            'mounts': [{'volume': volume_name(stack, volume), 'junction_path': volume['junction_path'],
+                        'mount_point': MOUNT_ROOT + volume['junction_path']} for volume in mounted_volumes(stack)],
+        })
+
+    def export(self, summaries):
+        """Every record of the run: steps, waits, one per AWS operation and a final run record"""
+        with self.lock:
+            records = list(self.records)
+        for key, counts in sorted(api_stats.operations().items()):
+            region, operation = key.split('/', 1)
+            service, operation = operation.split('.', 1)
+            records.append({'run_id': self.run_id, 'type': 'api', 'region': region, 'service': service, 'operation': operation,
+                            **counts, 'seconds': round(counts['seconds'], 3)})
+        totals = api_stats.totals()
+        records.append({
+            'run_id': self.run_id, 'time': round(time.time(), 3), 'type': 'run', 'seconds': round(time.time() - self.started, 3),
+            'stacks': len(summaries), 'created': sum(summary['status'] == 'CREATED' for summary in summaries),
+            'failed': sum(summary['status'] == 'FAILED' for summary in summaries),
+            'api_calls': totals['calls'], 'api_retries': totals['retries'], 'api_throttles': totals['throttles'], 'api_errors': totals['errors'],
+        })
+        return records
+
+    def fio(self, stack, jobs, checks):
+        """Records of the fio benchmark of a stack: one per job and one per comparison with what was provisioned"""
+        base = {'run_id': self.run_id, 'time': round(time.time(), 3), 'stack': stack.name or file_system_name(stack), 'region': stack.region}
+        return [{**base, 'type': 'fio', **job} for job in jobs] + [{**base, 'type': 'fio_check', **check} for check in checks]
+
+    def write_report(self, path, summaries):
+        """Append the run to a JSON-lines file; a resumed run appends to the same file by default"""
+        self.write_records(path, self.export(summaries))
+
+    def write_records(self, path, records):
+        """Append records to a JSON-lines file, also for stages that finish after the run was reported"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self, path, summaries):
+        """Write gauges describing this run in the Prometheus text format, replacing the file atomically"""
+        metrics = {}
+
+        def add(name, help_text, labels, value):
+            series = metrics.setdefault(name, (help_text, {}))[1]
+            key = ','.join(f"{label}={prometheus_label(value)}" for label, value in labels.items())
+            series[key] = series.get(key, 0) + value
+
+        for record in self.export(summaries):
+            if record['type'] == 'step':
+                add('fsxn_step_duration_seconds', 'Wall time of each provisioning step',
+                    {name: record[name] for name in ['stack', 'region', 'deployment_type', 'step', 'status']}, record['seconds'])
+            elif record['type'] == 'wait':
+                labels = {name: record[name] for name in ['kind', 'region', 'deployment_type']}
+                add('fsxn_wait_polls', 'Describe polls spent waiting for resources', labels, record['polls'])
+                for state, seconds in record['lifecycle_seconds'].items():
+                    add('fsxn_lifecycle_seconds', 'Time resources spent in each Lifecycle state', {**labels, 'lifecycle': state}, seconds)
+            elif record['type'] == 'api':
+                labels = {name: record[name] for name in ['region', 'service', 'operation']}
+                for name, help_text in API_METRICS.items():
+                    add(f"fsxn_api_{name}", help_text, labels, record[name])
+            elif record['type'] == 'run':
+                add('fsxn_run_duration_seconds', 'Wall time of the run', {}, record['seconds'])
+                add('fsxn_run_timestamp_seconds', 'Time the run finished', {}, record['time'])
+                for status in ['created', 'failed']:
+                    add('fsxn_stacks', 'Stacks of the run by outcome', {'status': status}, record[status])
+            # Other records, such as mount, have no gauges; they are only in the JSON-lines report
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            for name, (help_text, series) in metrics.items():
+                f.write(f"# HELP {name} {help_text}\n# TYPE {name} gauge\n")
+                for labels, value in series.items():
+                    f.write(f"{name}{{{labels}}} {round(value, 3)}\n" if labels else f"{name} {round(value, 3)}\n")
+        os.replace(tmp_path, path)
+
+# Decide when to poll a resource and what its lifecycle means
+class AdaptiveWaiter:
+    """Poll rarely while a resource is expected to be busy and densely near its expected completion.
+
+    After the expected completion the interval backs off exponentially.
+    Every interval is jittered, and the wait fails after a hard timeout or
+    when the resource stays MISCONFIGURED for longer than the grace period.
+    """
+
+    def __init__(self, kind, resource_id, profile, region=None):
+        self.kind = kind
+        self.resource_id = resource_id
+        self.profile = profile
+        self.region = region
+        self.expected = duration_history.expected(kind, profile)
+        self.timeout = wait_timeout or WAITER_SETTINGS['timeout'][kind]
+        self.started = time.monotonic()
+        # A --resume wait on a resource an earlier attempt created only sees the rest of its creation
+        self.reattached = run_state.known(resource_id)
+        self.misconfigured_since = None
+        self.overdue_polls = 0
+        self.polls = 0
+        # Seconds spent in each Lifecycle, as far as the polls can tell
+        self.state_seconds = {}
+        self.last_status = None
+        self.last_polled = self.started
+        # Set by check() once a resource this wait saw from the start is ready; the pollers add it to the duration history
+        self.duration = None
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def check(self, status):
+        """Return True once `status` means ready; raise if it never will be"""
+        self.polls += 1
+        # Time between two polls counts towards the earlier status; time before the first poll towards the first
+        now = time.monotonic()
+        state = self.last_status or status
+        self.state_seconds[state] = self.state_seconds.get(state, 0) + now - self.last_polled
+        self.last_status, self.last_polled = status, now
+        states = LIFECYCLE[self.kind]
+        if status in states['ready']:
+            if not self.reattached:
+                self.duration = self.elapsed()
+            return True
+        if status in states['failed']:
+            raise Exception(f"{self.kind} {self.resource_id} creation failed with status: {status}")
+
+        if status in states['misconfigured']:
+            if self.misconfigured_since is None:
+                logging.warning(f"{self.kind} {self.resource_id} is {status}, waiting up to {WAITER_SETTINGS['misconfigured_grace']}s for it to recover")
+                self.misconfigured_since = time.monotonic()
+            elif time.monotonic() - self.misconfigured_since > WAITER_SETTINGS['misconfigured_grace']:
+                raise Exception(f"{self.kind} {self.resource_id} stayed {status}, check its configuration")
+        else:
+            self.misconfigured_since = None
+            if status not in states['pending']:
+                logging.warning(f"{self.kind} {self.resource_id} has unexpected status {status}, still waiting")
+
+        if self.elapsed() > self.timeout:
+            raise Exception(f"Timed out after {int(self.elapsed())}s waiting for {self.kind} {self.resource_id} (last status: {status})")
+        return False
+
+    def next_delay(self):
+        """Seconds to sleep before the next poll"""
+        elapsed = self.elapsed()
+        dense = max(WAITER_SETTINGS['min_interval'], self.expected * WAITER_SETTINGS['dense_fraction'])
+        busy_until = self.expected * WAITER_SETTINGS['busy_fraction']
+
+        if elapsed < busy_until:
+            delay = min(busy_until - elapsed, WAITER_SETTINGS['max_interval'])
+        elif elapsed < self.expected:
+            delay = dense
+        else:
+            # Overdue: back off so a slow resource doesn't cost a describe call every few seconds
+            delay = dense * 2 ** self.overdue_polls
+            self.overdue_polls += 1
+
+        delay = min(max(delay, WAITER_SETTINGS['min_interval']), WAITER_SETTINGS['max_interval'])
+        delay *= random.uniform(1 - WAITER_SETTINGS['jitter'], 1 + WAITER_SETTINGS['jitter'])
+        return max(0, min(delay, self.timeout - elapsed))
+
+# Describe many FSx resources of one kind in batches
+def describe_resources(fsx_client, kind, resource_ids):
+    """Return a dict of ID -> description; IDs that no longer exist are left out"""
+    from botocore.exceptions import ClientError
+    api, id_param, response_key, id_key = DESCRIBE_APIS[kind]
+    resources = {}
+    for start in range(0, len(resource_ids), DESCRIBE_BATCH_SIZE):
+        chunk = resource_ids[start:start + DESCRIBE_BATCH_SIZE]
+        try:
+            for page in fsx_client.get_paginator(api).paginate(**{id_param: chunk}):
+                for resource in page[response_key]:
+                    resources[resource[id_key]] = resource
+        except ClientError as e:
+            if not e.response['Error']['Code'].endswith('NotFound'):
+                raise
+            # One missing ID fails the whole batch, so find out which one it was
+            if len(chunk) > 1:
+                for resource_id in chunk:
+                    resources.update(describe_resources(fsx_client, kind, [resource_id]))
+    return resources
+
+# Lifecycle of many FSx resources of one kind
+def describe_lifecycles(fsx_client, kind, resource_ids):
+    """Return a dict of ID -> Lifecycle; IDs that no longer exist are left out"""
+    return {resource_id: resource['Lifecycle'] for resource_id, resource in describe_resources(fsx_client, kind, resource_ids).items()}
+
+# Save the Lifecycle of every resource a poll described in the run state
+def record_lifecycles(resources):
+    for resource_id, resource in resources.items():
+        run_state.lifecycle(resource_id, resource['Lifecycle'])
+
+# Feed a described resource to a poller entry
+def apply_status(entry, kind, resource_id, resources):
+    """Resolve the entry's future with the resource's description and return True once the wait is over,
+    otherwise schedule its next poll. Never does I/O, so the async engine can call it on its event loop;
+    the caller saves the waiter's duration with record_durations."""
+    waiter = entry['waiter']
+    try:
+        if resource_id not in resources:
+            raise Exception(f"{kind} {resource_id} no longer exists")
+        ready = waiter.check(resources[resource_id]['Lifecycle'])
+    except Exception as e:
+        run_metrics.wait(waiter, 'failed')
+        entry['future'].set_exception(e)
+        return True
+    if ready:
+        logging.info(f"{kind} {resource_id} ready after {int(waiter.elapsed())}s and {waiter.polls} polls (expected {int(waiter.expected)}s)")
+        run_metrics.wait(waiter, 'ready')
+        entry['future'].set_result(resources[resource_id])
+        return True
+    entry['due'] = time.monotonic() + waiter.next_delay()
+    return False
+
+# Save how long the finished waits took, so later waits of the same kind and profile poll at the right time
+def record_durations(waiters):
+    for waiter in waiters:
+        if waiter.duration is not None:
+            duration_history.record(waiter.kind, waiter.profile, waiter.duration)
+
+# Shared status poller for every resource being waited on
+class StatusPoller:
+    """Poll all registered resources from one background thread.
+
+    Whenever any resource of a kind is due for a poll, every pending ID of
+    that kind is described in one paginated batch call, so the number of
+    describe calls grows with the number of resource kinds rather than the
+    number of resources. Each resource keeps its own AdaptiveWaiter, which
+    decides when it is due and what its Lifecycle means.
+    """
+
+    def __init__(self, fsx_client):
+        self.fsx_client = fsx_client
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.thread = None
+
+    def register(self, kind, resource_id, profile, callback=None):
+        """Start waiting for a resource; returns a future resolved with its description once it is ready"""
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        with self.condition:
+            self.pending[(kind, resource_id)] = {
+                'waiter': AdaptiveWaiter(kind, resource_id, profile, self.fsx_client.meta.region_name),
+                'future': future,
+                'due': time.monotonic(),
+            }
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='status-poller', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.thread = None
+                    return
+                now = time.monotonic()
+                next_due = min(entry['due'] for entry in self.pending.values())
+                if next_due > now:
+                    self.condition.wait(next_due - now)
+                    continue
+                due_kinds = {kind for (kind, _), entry in self.pending.items() if entry['due'] <= now}
+                batches = {kind: [resource_id for (k, resource_id) in self.pending if k == kind] for kind in due_kinds}
+
+            # Call AWS outside the lock so new registrations are never blocked
+            for kind, resource_ids in batches.items():
+                try:
+                    resources = self._describe(kind, resource_ids)
+                except Exception as e:
+                    logging.warning(f"Describing {len(resource_ids)} {kind} resources failed, retrying: {str(e)}")
+                    self._reschedule(kind, resource_ids, WAITER_SETTINGS['max_interval'] / 4)
+                    continue
+                record_lifecycles(resources)
+                self._update(kind, resource_ids, resources)
+
+    def _describe(self, kind, resource_ids):
+        return describe_resources(self.fsx_client, kind, resource_ids)
+
+    def _reschedule(self, kind, resource_ids, delay):
+        with self.condition:
+            for resource_id in resource_ids:
+                if (kind, resource_id) in self.pending:
+                    self.pending[(kind, resource_id)]['due'] = time.monotonic() + delay
+
+    def _update(self, kind, resource_ids, resources):
+        finished = []
+        with self.condition:
+            for resource_id in resource_ids:
+                entry = self.pending.get((kind, resource_id))
+                if entry is None:
+                    continue
+                if apply_status(entry, kind, resource_id, resources):
+                    finished.append(entry['waiter'])
+                    del self.pending[(kind, resource_id)]
+        # The history is a file, so it is written outside the lock
+        record_durations(finished)
+
+# Get Security group
+def get_security_group(ctx, sg_name):
+    def lookup():
+        response = ctx.ec2.describe_security_groups(
+            Filters = [{'Name': 'group-name', 'Values': [sg_name]}]
+        )
+        
+        if not response['SecurityGroups']:
+            logging.error(f"No security group found with name: {sg_name}")
+            raise Exception(f"No security group found with name: {sg_name}") 
+        
+        security_group = response['SecurityGroups'][0]['GroupId']
+        return security_group
+    return discovery_cache.get(ctx.region, 'security_group', sg_name, lookup)
+
+# Get default VPC
+def get_default_vpc(ctx):
+    def lookup():
+        response = ctx.ec2.describe_vpcs(
+            Filters=[{
+                'Name': 'is-default',
+                'Values':['true']
+            }]
+        )
+
+        if not response['Vpcs']:
+            logging.error(f"No default VPC found in {ctx.region}")
+            return None
+        
+        default_vpc = response['Vpcs'][0]['VpcId']
+        return default_vpc
+    return discovery_cache.get(ctx.region, 'vpc', 'default', lookup)
+
+# Stream the subnets of a VPC, one page at a time
+def iter_subnets(ctx, vpc_id):
+    """Tag filters run in EC2; the free IP filter runs here, as subnets arrive"""
+    filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}, {'Name': 'state', 'Values': ['available']}]
+    filters += [{'Name': f"tag:{key}", 'Values': [value]} for key, value in subnet_settings['tags'].items()]
+    pages = ctx.ec2.get_paginator('describe_subnets').paginate(
+        Filters = filters,
+        PaginationConfig = {'PageSize': SUBNET_PAGE_SIZE}
+    )
+    for page in pages:
+        for subnet in page['Subnets']:
+            if subnet.get('AvailableIpAddressCount', 0) >= subnet_settings['min_free_ips']:
+                yield subnet
+
+# Pick one subnet per availability zone
+def select_subnets(subnets, zones=SUBNET_ZONES):
+    """Take the first subnet of each availability zone and stop as soon as
+    `zones` zones are covered, so no more pages are fetched than needed"""
+    selected = {}
+    for subnet in subnets:
+        selected.setdefault(subnet['AvailabilityZone'], subnet)
+        if len(selected) >= zones:
+            break
+    return [{'SubnetId': subnet['SubnetId'], 'AvailabilityZone': zone} for zone, subnet in selected.items()]
+
+# Key of the subnet selection in the discovery cache; the filters are part of it
+def subnet_query(vpc_id):
+    tags = ','.join(f"{key}={value}" for key, value in sorted(subnet_settings['tags'].items()))
+    return f"{vpc_id}?free={subnet_settings['min_free_ips']}&tags={tags}"
+
+# Get subnets in default VPC, one per availability zone
+def get_subnets(ctx, vpc_id):
+    def lookup():
+        subnets = select_subnets(iter_subnets(ctx, vpc_id))
+        if not subnets:
+            logging.error(f"No subnets with {subnet_settings['min_free_ips']} free IP addresses found in the VPC: {vpc_id}")
+            raise Exception(f"No subnets with {subnet_settings['min_free_ips']} free IP addresses found in the VPC: {vpc_id}")
+        logging.info(f"Subnets in {vpc_id}: {', '.join(subnet['SubnetId'] + ' (' + subnet['AvailabilityZone'] + ')' for subnet in subnets)}")
+        return subnets
+    return discovery_cache.get(ctx.region, 'subnets', subnet_query(vpc_id), lookup)
+
+# Subnet IDs for a deployment type; Multi-AZ needs subnets in two availability zones
+def deployment_subnets(stack, subnets):
+    count = 2 if stack.deployment_type in ['MULTI_AZ_1', 'MULTI_AZ_2'] else 1
+    if len(subnets) < count:
+        raise Exception(f"{stack.deployment_type} needs subnets in {count} availability zones, but only "
+                        f"{', '.join(subnet['AvailabilityZone'] for subnet in subnets)} has a matching subnet")
+    return [subnet['SubnetId'] for subnet in subnets[:count]]
+
+# Get AMI Id through SSM parameter
+def get_ami(ctx, parameter_name):
+    def lookup():
+        response = ctx.ssm.get_parameter(Name = parameter_name)
+        ami_id = response['Parameter']['Value']
+        return ami_id
+    return discovery_cache.get(ctx.region, 'ami', parameter_name, lookup)
+
+# Background lookups shared by every stack in a region
+class Discovery:
+    """Start every independent lookup at once and hand out the results as futures.
+
+    The create steps call `.result()` only when they need a value, so the
+    VPC -> subnets chain, the AMI parameter and the security group lookups
+    all overlap with each other and with the first create call. Security
+    groups are looked up once per name, however many stacks use them.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.lock = threading.Lock()
+        self.subnets = ctx.executor.submit(lambda: get_subnets(ctx, get_default_vpc(ctx)))
+        self.image_id = ctx.executor.submit(get_ami, ctx, AMI_PARAMETER)
+        self.security_groups = {}
+
+    def security_group(self, sg_name):
+        with self.lock:
+            if sg_name not in self.security_groups:
+                self.security_groups[sg_name] = self.ctx.executor.submit(get_security_group, self.ctx, sg_name)
+            return self.security_groups[sg_name]
+
+# Clients and discovery state of one region
+class RegionContext:
+    """Everything that differs between regions: clients, discovery results and the status poller"""
+
+    def __init__(self, region):
+        self.region = region
+        self.lock = threading.Lock()
+        self.session = None
+        self.clients = {}
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self._discovery = None
+        self._poller = None
+
+    def client(self, service):
+        """Create the client of `service` on first use and reuse it afterwards"""
+        with self.lock:
+            if service not in self.clients:
+                # A session per region, so regions can be set up from different threads
+                if self.session is None:
+                    self.session = new_session()
+                self.clients[service] = make_client(self.session, service, self.region)
+            return self.clients[service]
+
+    @property
+    def fsx(self):
+        return self.client('fsx')
+
+    @property
+    def ec2(self):
+        return self.client('ec2')
+
+    @property
+    def ssm(self):
+        return self.client('ssm')
+
+    @property
+    def discovery(self):
+        """Discovery starts on first use, so commands that never create anything skip it"""
+        with self.lock:
+            if self._discovery is None:
+                self._discovery = Discovery(self)
+            return self._discovery
+
+    @property
+    def poller(self):
+        fsx = self.fsx
+        with self.lock:
+            if self._poller is None:
+                self._poller = StatusPoller(fsx)
+            return self._poller
+
+# Get the context of a region, creating it on first use
+def region_context(region):
+    with region_contexts_lock:
+        if region not in region_contexts:
+            region_contexts[region] = RegionContext(region)
+        return region_contexts[region]
+
+region_contexts = {}
+region_contexts_lock = threading.Lock()
+
+# Resolve --region all-enabled into the regions that are enabled in the account and offer FSx
+def enabled_regions(home_region):
+    session = new_session()
+    ec2 = make_client(session, 'ec2', home_region)
+    enabled = [entry['RegionName'] for entry in ec2.describe_regions()['Regions']]
+    fsx_regions = session.get_available_regions('fsx')
+    return sorted(name for name in enabled if name in fsx_regions)
+
+# Family of an API operation; every operation of a family shares one token bucket
+def api_family(operation):
+    for family, prefixes in API_FAMILIES.items():
+        if operation.startswith(prefixes):
+            return family
+    return 'other'
+
+# Token bucket rate limiting for AWS API calls
+class RateLimiter:
+    """One token bucket per region, service and API family, shared by every thread in the process.
+
+    A throttled call halves the rate of its bucket, and every successful
+    call wins back a little of it, so a busy account slows the whole run
+    down instead of failing it.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.rates = {}
+
+    def acquire(self, key):
+        """Block until a call in bucket `key` is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                rate = self.rates.get(key, self.rate)
+                tokens, updated = self.buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    self.buckets[key] = (tokens - 1, now)
+                    return
+                self.buckets[key] = (tokens, now)
+                delay = (1 - tokens) / rate
+            time.sleep(delay)
+
+    def throttled(self, key):
+        with self.lock:
+            self.rates[key] = max(RATE_LIMIT_FLOOR, self.rates.get(key, self.rate) / 2)
+            logging.warning(f"{key} throttled, slowing down to {self.rates[key]:.2f} calls/s")
+
+    def succeeded(self, key):
+        with self.lock:
+            if key in self.rates:
+                self.rates[key] = min(self.rate, self.rates[key] + self.rate * 0.05)
+                if self.rates[key] >= self.rate:
+                    del self.rates[key]
+
+# Counters of API calls, retries and throttles
+class ApiStats:
+    """Process-wide call, retry, throttle and error counts and wall time per region, service and operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, key, **counts):
+        with self.lock:
+            entry = self.counts.setdefault(key, {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'seconds': 0})
+            for name, value in counts.items():
+                entry[name] += value
+
+    def operations(self):
+        """Copy of the counts, keyed by region/service.Operation"""
+        with self.lock:
+            return {key: dict(entry) for key, entry in self.counts.items()}
+
+    def totals(self):
+        with self.lock:
+            totals = {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'seconds': 0}
+            for entry in self.counts.values():
+                for name in totals:
+                    totals[name] += entry[name]
+            return totals
+
+# Start a boto3 session; boto3 is only loaded once an AWS call is about to happen
+def new_session():
+    import boto3
+    return boto3.session.Session()
+
+# Create a client with adaptive retries, rate limiting and call counting
+def make_client(session, service, region):
+    """Every AWS client of this script comes from here"""
+    from botocore.config import Config
+    client = session.client(service, region_name=region, config=Config(
+        retries={'mode': 'adaptive', 'max_attempts': client_settings['max_attempts']},
+        max_pool_connections=client_settings['max_pool_connections'],
+    ))
+
+    # AWS throttles per account and region, so each region gets its own buckets
+    prefix = f"{region}/{service}"
+
+    def before_call(model, context=None, **kwargs):
+        rate_limiter.acquire(f"{prefix}.{api_family(model.name)}")
+        # Time the call itself, not the wait for a token
+        if context is not None:
+            context['started'] = time.monotonic()
+
+    def call_seconds(context):
+        return time.monotonic() - (context or {}).get('started', time.monotonic())
+
+    def needs_retry(response, operation, **kwargs):
+        if response and response[1].get('Error', {}).get('Code') in THROTTLE_ERRORS:
+            api_stats.add(f"{prefix}.{operation.name}", throttles=1)
+            rate_limiter.throttled(f"{prefix}.{api_family(operation.name)}")
+
+    def after_call(parsed, model, context=None, **kwargs):
+        failed = 'Error' in parsed
+        api_stats.add(f"{prefix}.{model.name}", calls=1, retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                      errors=int(failed), seconds=call_seconds(context))
+        if not failed:
+            rate_limiter.succeeded(f"{prefix}.{api_family(model.name)}")
+
+    def after_call_error(event_name, context=None, **kwargs):
+        # No response was parsed, e.g. after a connection error; the event name ends with the operation
+        api_stats.add(f"{prefix}.{event_name.rsplit('.', 1)[-1]}", calls=1, errors=1, seconds=call_seconds(context))
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('needs-retry', needs_retry)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+    return client
+
+# Name tag of a stack's file system
+def file_system_name(stack):
+    if stack.name:
+        return stack.name
+    return f"{stack.snapmirror_type}" if stack.snapmirror == 'yes' else f"{stack.deployment_type}_{stack.region}"
+
+# Name tag of a stack's EC2 instance
+def instance_name(stack):
+    if stack.name:
+        return f"{stack.name}_client"
+    return f"{stack.snapmirror_type}" if stack.snapmirror == 'yes' else f"{stack.deployment_type}_client_{stack.region}"
+
+# Name of a stack's SVM
+def svm_name(stack):
+    return f"{stack.svm_name}_{stack.snapmirror_type}" if stack.snapmirror == 'yes' else f"{stack.svm_name}"
+
+# Name of one of a stack's volumes
+def volume_name(stack, volume):
+    return f"{volume['name']}_{stack.snapmirror_type}" if stack.snapmirror == 'yes' else f"{volume['name']}"
+
+# Key of a stack in the run state; unique within a run
+def stack_key(stack):
+    return f"{stack.name or file_system_name(stack)} ({stack.region})"
+
+# Name tag plus the stack's own tags, in the format the create APIs expect
+def stack_tags(stack, name):
+    return [{'Key': 'Name', 'Value': name}, TOOL_TAG] + [{'Key': key, 'Value': str(value)} for key, value in stack.tags.items()]
+
+# Create file system
+def create_file_system(stack):
+    logging.info(f"Creating FSx file system: {file_system_name(stack)}...")
+    ctx = region_context(stack.region)
+    subnet_ids = deployment_subnets(stack, ctx.discovery.subnets.result())
+    fsx_security_group = ctx.discovery.security_group(stack.security_group).result()
+    # Scale-out file systems are sized per HA pair, and SSD IOPS beyond those included with the storage are provisioned
+    performance = {'ThroughputCapacity': stack.throughput_capacity}
+    if stack.ha_pairs > 1:
+        performance = {'HAPairs': stack.ha_pairs, 'ThroughputCapacityPerHAPair': stack.throughput_capacity // stack.ha_pairs}
+    if stack.disk_iops:
+        performance['DiskIopsConfiguration'] = {'Mode': 'USER_PROVISIONED', 'Iops': stack.disk_iops}
+    if stack.deployment_type in ['SINGLE_AZ_1', 'SINGLE_AZ_2']:
+        response = call_with_cached_ids(
+            ctx.fsx.create_file_system,
+            subnet_ids + [fsx_security_group],
+            ClientRequestToken = run_state.token(stack_key(stack), 'file_system_id'),
+            FileSystemType = 'ONTAP',
+            StorageCapacity = stack.storage_capacity,
+            SubnetIds = subnet_ids,
+            SecurityGroupIds = [fsx_security_group], # SG needs to be changed as per your use case.
+            OntapConfiguration={
+                'AutomaticBackupRetentionDays' : 0,
+                'DeploymentType' : stack.deployment_type,
+                'FsxAdminPassword' : stack.admin_password,
+                **performance
+            },
+            Tags = stack_tags(stack, file_system_name(stack))
+        )
+    else:
+        response = call_with_cached_ids(
+            ctx.fsx.create_file_system,
+            subnet_ids + [fsx_security_group],
+            ClientRequestToken = run_state.token(stack_key(stack), 'file_system_id'),
+            FileSystemType = 'ONTAP',
+            StorageCapacity = stack.storage_capacity,
+            SubnetIds = subnet_ids,
+            SecurityGroupIds = [fsx_security_group], # SG needs to be changed as per your use case.
+            OntapConfiguration={
+                'AutomaticBackupRetentionDays' : 0,
+                'DeploymentType' : stack.deployment_type,
+                'FsxAdminPassword' : stack.admin_password,
+                'PreferredSubnetId' : f"{subnet_ids[0]}",
+                **performance
+            },
+            Tags = stack_tags(stack, file_system_name(stack))
+        )
+        
+    file_system_id = response['FileSystem']['FileSystemId']
+    logging.info(f"File system creation initiated: {file_system_id}")
+    return file_system_id
+
+# Wait for file system to become available
+def wait_for_file_system(stack, file_system_id):
+    logging.info(f"Waiting for file system {file_system_id} to become available...")
+    region_context(stack.region).poller.register('file_system', file_system_id, stack.deployment_type).result()
+    logging.info(f"File system {file_system_id} is now available.")
+    return file_system_id
+
+# Create storage virtual machine
+def create_svm(stack, file_system_id):
+    name = svm_name(stack)
+    logging.info(f"Creating SVM: {name}...")
+    response = region_context(stack.region).fsx.create_storage_virtual_machine(
+        ClientRequestToken = run_state.token(stack_key(stack), 'svm_id'),
+        FileSystemId = file_system_id,
+        Name = name,
+        RootVolumeSecurityStyle = 'UNIX',
+        Tags = stack_tags(stack, name),
+    )
+    svm_id = response['StorageVirtualMachine']['StorageVirtualMachineId']
+    logging.info(f"SVM creation initiated: {svm_id}")
+    return svm_id
+
+# Wait for SVM to become available
+def wait_for_svm(stack, svm_id):
+    logging.info(f"Waiting for {svm_id} to become available...")
+    svm = region_context(stack.region).poller.register('svm', svm_id, stack.deployment_type).result()
+    logging.info(f"SVM {svm_id} is now active")
+    check_nfs_endpoint(stack, svm)
+    return svm_id
+
+# Create volume
+def create_volume(stack, volume, svm_id):
+    name = volume_name(stack, volume)
+    logging.info(f"Creating data volume {name}...")
+    ontap_configuration = {
+        'SizeInMegabytes': volume['size']*1024,
+        'StorageVirtualMachineId': svm_id,
+        'TieringPolicy' : {
+            'Name': TIERING_PROFILES[volume['tiering']],
+            **({'CoolingPeriod': volume['cooling_period']} if volume['cooling_period'] is not None else {})
+        },
+        'OntapVolumeType': volume['type'],
+    }
+    # A FlexGroup spreads its constituents evenly over the aggregates, one per HA pair
+    if volume['style'] == 'flexgroup':
+        ontap_configuration.update({
+            'VolumeStyle': 'FLEXGROUP',
+            'AggregateConfiguration': {
+                'Aggregates': volume['aggregates'],
+                'ConstituentsPerAggregate': volume['constituents'] // len(volume['aggregates'])
+            }
+        })
+    # A DP (SnapMirror destination) volume gets its junction path and settings from the source
+    if volume['type'] == 'RW':
+        ontap_configuration.update({
+            'JunctionPath': volume['junction_path'],
+            'SecurityStyle': volume['security_style'],
+            'StorageEfficiencyEnabled': volume['storage_efficiency'],
+            'SnapshotPolicy': volume['snapshot_policy']
+        })
+    response = region_context(stack.region).fsx.create_volume(
+        ClientRequestToken = run_state.token(stack_key(stack), f"volume_id:{volume['name']}"),
+        Name = name,
+        VolumeType = 'ONTAP',
+        OntapConfiguration = ontap_configuration,
+        Tags = stack_tags(stack, name)
+    )
+    volume_id = response['Volume']['VolumeId']
+    logging.info(f"Volume creation initiated: {volume_id}, data placement {volume['tiering']} ({TIERING_PROFILES[volume['tiering']]})")
+    if volume['style'] == 'flexgroup':
+        logging.info(f"Volume {name} is a FlexGroup of {volume['constituents']} constituents of {volume['size'] / volume['constituents']:.0f} GiB "
+                     f"on {', '.join(volume['aggregates'])}")
+    return volume_id
+
+# Create every volume of a stack and wait for all of them together
+def create_volumes(stack, svm_id):
+    """Up to `volume_concurrency` create calls run at once. Every volume is
+    handed to the region's poller as soon as it is created, so all of them
+    are waited on with the same batched describes: N volumes take about as
+    long as the slowest one, not N times as long as one.
+
+    Each create is checkpointed on its own, so a resumed run only creates
+    the volumes that are missing. Returns volume name -> volume ID.
+    """
+    poller = region_context(stack.region).poller
+    volume_ids, waits, errors = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=stack.volume_concurrency) as executor:
+        creates = {executor.submit(checkpointed(stack, f"volume_id:{volume['name']}", create_volume), stack, volume, svm_id): volume['name']
+                   for volume in stack.volumes}
+        for future in as_completed(creates):
+            name = creates[future]
+            try:
+                volume_ids[name] = future.result()
+                waits[name] = poller.register('volume', volume_ids[name], stack.deployment_type)
+            except Exception as e:
+                errors[name] = e
+
+    logging.info(f"Waiting for {len(waits)} volume(s) of {stack_key(stack)} to become available...")
+    for name, future in waits.items():
+        try:
+            future.result()
+        except Exception as e:
+            errors[name] = e
+    if errors:
+        raise Exception('; '.join(f"volume {name}: {str(e)}" for name, e in errors.items()))
+    logging.info(f"All {len(volume_ids)} volume(s) of {stack_key(stack)} are now available")
+    return {volume['name']: volume_ids[volume['name']] for volume in stack.volumes}
+
+# Create the cluster placement group of the clients, or reuse the one with that name
+def create_placement_group(ctx, stack):
+    """A group this creates is recorded in the run state, so that destroy --run deletes it with the run's instances"""
+    from botocore.exceptions import ClientError
+    try:
+        ctx.ec2.create_placement_group(
+            GroupName = stack.placement_group,
+            Strategy = 'cluster',
+            TagSpecifications = [{
+                'ResourceType': 'placement-group',
+                'Tags': stack_tags(stack, stack.placement_group)
+            }]
+        )
+        logging.info(f"Placement group created: {stack.placement_group}")
+        run_state.record(stack_key(stack), 'placement_group', stack.placement_group)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPlacementGroup.Duplicate':
+            raise
+        logging.info(f"Placement group {stack.placement_group} already exists, launching into it")
+
+# Volumes the clients mount: those with a junction path, which DP volumes do not have
+def mounted_volumes(stack):
+    return [volume for volume in stack.volumes if volume['type'] == 'RW' and volume.get('junction_path')]
+
+# NFS DNS name of an SVM, which the clients mount the volumes from
+def nfs_dns_name(region, file_system_id, svm_id):
+    """FSx names the endpoint after the SVM and file system IDs, so the clients can be given it
+    as soon as the SVM exists, without waiting for it to be created"""
+    return f"{svm_id}.{file_system_id}.fsx.{region}.amazonaws.com"
+
+# Warn when the NFS endpoint of a created SVM is not the one its clients mount
+def check_nfs_endpoint(stack, svm):
+    """`svm` is the description the poller returned, so this costs no API call"""
+    if not (stack.mount and mounted_volumes(stack)):
+        return
+    dns_name = svm.get('Endpoints', {}).get('Nfs', {}).get('DNSName')
+    expected = nfs_dns_name(stack.region, svm['FileSystemId'], svm['StorageVirtualMachineId'])
+    if dns_name and dns_name != expected:
+        logging.warning(f"SVM {svm['StorageVirtualMachineId']} serves NFS on {dns_name}, but the clients of {stack_key(stack)} mount {expected}; "
+                        f"remount them from {dns_name}")
+
+# NFS mount options of a stack's clients
+def mount_options(stack):
+    """One client moves at most its baseline network bandwidth and never more than the throughput capacity.
+    nconnect opens enough connections for that rate, larger throughput tiers get larger reads and writes,
+    and the clients of a fleet cache attributes briefly so that they see each other's writes."""
+    rate = stack.throughput_capacity
+    if stack.instance_type in NETWORK_BANDWIDTH:
+        rate = min(rate, NETWORK_BANDWIDTH[stack.instance_type] * 125)
+    nconnect = min(NFS_MAX_CONNECTIONS, max(1, math.ceil(rate / NFS_CONNECTION_THROUGHPUT)))
+    transfer = NFS_TRANSFER_SIZE[stack.throughput_capacity >= NFS_LARGE_TRANSFER_THROUGHPUT]
+    actimeo = NFS_ATTRIBUTE_CACHE['fleet' if stack.clients > 1 else 'single']
+    return f"nfsvers={stack.nfs_version},nconnect={nconnect},rsize={transfer},wsize={transfer},hard,timeo=600,retrans=2,actimeo={actimeo}"
+
+# User-data that mounts a stack's volumes on its clients at first boot
+def mount_user_data(stack, dns_name):
+    """Each volume is added to /etc/fstab and mounted under MOUNT_ROOT plus its junction path. The clients start
+    while the SVM and volumes are still being created, so a mount that fails is retried every 10 seconds for up to an hour."""
+    junctions = ' '.join(shlex.quote(volume['junction_path']) for volume in mounted_volumes(stack))
+    return '\n'.join([
+        '#!/bin/bash',
+        f"# Written by FSxN-CLI: mount the volumes of {stack_key(stack)} from {dns_name}",
+        'command -v mount.nfs > /dev/null || dnf install -y nfs-utils',
+        'mount_volume() {',
+        f'    mkdir -p "{MOUNT_ROOT}$1"',
+        f'    echo "{dns_name}:$1 {MOUNT_ROOT}$1 nfs {mount_options(stack)},_netdev,nofail 0 0" >> /etc/fstab',
+        '    for attempt in $(seq 360); do',
+        f'        mount "{MOUNT_ROOT}$1" && return',
+        '        sleep 10',
+        '    done',
+        '}',
+        f"for junction in {junctions}; do",
+        '    mount_volume "$junction" &',
+        'done',
+        'wait',
+        '',
+    ])
+
+# Create the EC2 client instances
+def create_ec2(stack, file_system_id=None, svm_id=None):
+    """All clients are launched by one call, so they either all start or none does. Returns their instance IDs.
+    With `svm_id`, the clients get user-data that mounts the stack's volumes from that SVM."""
+    logging.info(f"Creating {stack.clients} EC2 instance(s)...")
+    ctx = region_context(stack.region)
+    # The file system's preferred subnet, so the clients sit in the same availability zone
+    subnet = ctx.discovery.subnets.result()[0]
+    image_id = ctx.discovery.image_id.result()
+    ec2_security_group = ctx.discovery.security_group(stack.security_group).result()
+    placement = {'AvailabilityZone': subnet['AvailabilityZone']}
+    if stack.placement_group:
+        create_placement_group(ctx, stack)
+        placement['GroupName'] = stack.placement_group
+    user_data = {}
+    if svm_id:
+        dns_name = nfs_dns_name(stack.region, file_system_id, svm_id)
+        user_data['UserData'] = mount_user_data(stack, dns_name)
+        run_metrics.mount(stack, svm_id, dns_name, mount_options(stack), user_data['UserData'])
+        logging.info(f"Clients will mount {', '.join(volume['junction_path'] for volume in mounted_volumes(stack))} "
+                     f"from {dns_name} with {mount_options(stack)}")
+    response = call_with_cached_ids(
+        ctx.ec2.run_instances,
+        [image_id, subnet['SubnetId'], ec2_security_group],
+        ClientToken = run_state.token(stack_key(stack), 'instance_ids'),
+        ImageId = image_id,
+        InstanceType = stack.instance_type,
+        KeyName = stack.key_pair,
+        SubnetId = subnet['SubnetId'],
+        Placement = placement,
+        MaxCount = stack.clients,
+        MinCount = stack.clients,
+        SecurityGroupIds = [ec2_security_group], # SG needs to be changed as per your use case.
+        TagSpecifications = [{
+            'ResourceType': 'instance',
+            'Tags': stack_tags(stack, instance_name(stack))
+        }],
+        **({'IamInstanceProfile': {'Name': stack.instance_profile}} if stack.instance_profile else {}),
+        **user_data
+    )
+
+    instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+    for instance in response['Instances']:
+        run_state.lifecycle(instance['InstanceId'], instance['State']['Name'])
+    logging.info(f"EC2 Instance(s) launched in {subnet['AvailabilityZone']}: {', '.join(instance_ids)}")
+    return instance_ids
+
+# Run provisioning steps as a dependency graph
+class TaskGraph:
+    """Run each step as soon as the steps it depends on have finished.
+
+    Independent branches run concurrently on a thread pool, so the total
+    wall-clock time is the length of the longest chain of dependencies.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+
+    def add(self, name, func, deps=()):
+        """Register step `name`; `func` is called with the results of `deps` in order"""
+        for dep in deps:
+            if dep not in self.tasks:
+                raise Exception(f"Step {name} depends on unknown step {dep}")
+        self.tasks[name] = (func, tuple(deps))
+
+    def run(self):
+        """Run every step and return a dict of step name -> result"""
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if any(dep in self.errors or dep in self.skipped for dep in deps):
+                        # Never start a step whose inputs are missing
+                        logging.warning(f"Skipping step {name} because a dependency failed")
+                        self.skipped.append(name)
+                        del pending[name]
+                    elif all(dep in self.results for dep in deps):
+                        logging.debug(f"Starting step {name}")
+                        running[executor.submit(func, *[self.results[dep] for dep in deps])] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        logging.debug(f"Step {name} finished")
+                    except Exception as e:
+                        logging.error(f"Step {name} failed: {str(e)}")
+                        self.errors[name] = e
+
+        if self.errors:
+            raise Exception('; '.join(f"{name} failed: {str(e)}" for name, e in self.errors.items()))
+        return self.results
+
+# Wrap a step so that it is skipped if an earlier attempt of this run finished it
+def checkpointed(stack, step, func):
+    """The wrapped step records its result in the run state as soon as it finishes"""
+    def run(*args):
+        result = run_state.result(stack_key(stack), step)
+        if result is not None:
+            logging.info(f"Step {step} of {stack_key(stack)} already finished: {result}")
+            run_metrics.step(stack, step, 0, 'skipped')
+            return result
+        started = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception:
+            run_metrics.step(stack, step, time.monotonic() - started, 'failed')
+            raise
+        run_metrics.step(stack, step, time.monotonic() - started, 'ok')
+        run_state.record(stack_key(stack), step, result)
+        return result
+    return run
+
+# Build the provisioning graph for one stack
+def build_stack_graph(stack):
+    """The EC2 clients only need the AMI, subnet and security group, so they are launched while FSx is still provisioning.
+    Clients that mount the volumes also need the SVM ID, which names the NFS endpoint in their user-data; they launch
+    as soon as the SVM exists and keep retrying the mounts while the SVM and volumes are being created."""
+    graph = TaskGraph()
+
+    def add(name, func, deps=()):
+        graph.add(name, checkpointed(stack, name, func), deps)
+
+    add('file_system_id', lambda: create_file_system(stack))
+    add('file_system', lambda file_system_id: wait_for_file_system(stack, file_system_id), deps=['file_system_id'])
+    add('svm_id', lambda file_system_id: create_svm(stack, file_system_id), deps=['file_system'])
+    add('svm', lambda svm_id: wait_for_svm(stack, svm_id), deps=['svm_id'])
+    add('volumes', lambda svm_id: create_volumes(stack, svm_id), deps=['svm'])
+    if stack.mount and mounted_volumes(stack):
+        add('instance_ids', lambda file_system_id, svm_id: create_ec2(stack, file_system_id, svm_id), deps=['file_system_id', 'svm_id'])
+    else:
+        add('instance_ids', lambda: create_ec2(stack))
+    return graph
+
+# Build a stack definition from the command line arguments and optional overrides
+def make_stack(args, overrides=None):
+    """Return a Namespace describing one file system, SVM, its volumes and a client instance"""
+    stack = argparse.Namespace(**vars(args))
+    stack.name = None
+    stack.region = args.region[0]
+    stack.tags = {}
+    stack.source = None
+    for key, value in (overrides or {}).items():
+        if key not in STACK_FIELDS:
+            raise Exception(f"Unknown stack setting: {key}")
+        setattr(stack, key, value)
+
+    # Set key-pair default value to region if not specified
+    if stack.key_pair is None:
+        stack.key_pair = stack.region
+
+    # A workload profile is sized by the planner, whose settings win over the stack's own
+    if stack.workload:
+        plan = plan_capacity(stack.workload)
+        for reason in plan['reasons']:
+            logging.info(f"Plan for {stack.name or 'stack'}: {reason}")
+        for key in PLAN_FIELDS:
+            setattr(stack, key, plan[key])
+
+    stack.deployment_type, stack.snapmirror, stack.snapmirror_type = get_fsx_inputs(stack)
+    if stack.snapmirror == 'yes' and not stack.snapmirror_type:
+        raise Exception(f"Stack {stack.name}: snapmirror_type is required when snapmirror is 'yes'")
+    if 'throughput_capacity' not in (overrides or {}) and ({'deployment_type', 'ha_pairs'} & set(overrides or {})) and not stack.workload:
+        stack.throughput_capacity = None
+    stack.throughput_capacity = check_throughput(stack.deployment_type, stack.throughput_capacity, stack.ha_pairs)
+
+    # More than one client is a load-generator fleet, which gets a network-optimized type unless the stack names one
+    stack.clients = client_count(stack.clients)
+    if stack.instance_type is None:
+        stack.instance_type = 't3.medium' if stack.clients == 1 else CLIENT_FLEET_INSTANCE_TYPE
+    if stack.clients == 'auto':
+        stack.clients = fleet_size(stack.instance_type, stack.client_throughput or stack.throughput_capacity)
+        logging.info(f"{stack.clients} {stack.instance_type} client(s) drive {stack.client_throughput or stack.throughput_capacity} MB/s")
+    # A manifest may give the NFS version as a number
+    stack.nfs_version = str(stack.nfs_version)
+
+    if stack.volumes is None:
+        stack.volumes = [{'name': stack.volume_name, 'size': stack.volume_size}]
+    stack.volumes = [dict(volume) for volume in stack.volumes]
+    for volume in stack.volumes:
+        if 'name' not in volume:
+            raise Exception(f"Stack {stack.name}: every volume needs a name")
+        for key in volume:
+            if key not in VOLUME_FIELDS:
+                raise Exception(f"Stack {stack.name}: unknown volume setting: {key}")
+        volume.setdefault('size', stack.volume_size)
+        volume.setdefault('type', 'DP' if stack.snapmirror_type == 'dest' else 'RW')
+        volume['type'] = volume['type'].upper()
+        volume.setdefault('security_style', 'UNIX')
+        volume.setdefault('snapshot_policy', stack.snapshot_policy)
+        volume.setdefault('tiering', stack.tiering)
+        # The stack's cooling period belongs to the stack's profile, so a volume with another profile does not inherit it
+        volume.setdefault('cooling_period', stack.cooling_period if volume['tiering'] == stack.tiering else None)
+        volume.setdefault('storage_efficiency', stack.storage_efficiency)
+        volume.setdefault('style', stack.volume_style)
+        if volume['style'] == 'flexgroup':
+            volume.setdefault('aggregates', stack.aggregates or [f"aggr{index + 1}" for index in range(stack.ha_pairs)])
+            # Constituents are sized from the volume: up to the default per aggregate, as long as each gets the smallest size
+            per_aggregate = volume['size'] // (FLEXGROUP_MIN_CONSTITUENT_SIZE * max(1, len(volume['aggregates'])))
+            volume.setdefault('constituents', stack.constituents or max(1, min(FLEXGROUP_DEFAULT_CONSTITUENTS, per_aggregate)) * len(volume['aggregates']))
+        if volume['type'] == 'RW':
+            volume.setdefault('junction_path', f"/{volume_name(stack, volume)}")
+    return stack
+
+# Build one copy of a stack definition per region
+def make_stacks(args, overrides=None):
+    """A stack's own `region` (a name or a list) wins over the --region list"""
+    overrides = overrides or {}
+    regions = overrides.get('region', args.region)
+    if isinstance(regions, str):
+        regions = [regions]
+    if str(overrides.get('snapmirror', args.snapmirror)).lower() == 'pair':
+        if len(regions) > 1 and (overrides.get('destination_region') or args.destination_region):
+            raise Exception("A SnapMirror pair with a destination region needs a single source region")
+        return [stack for name in regions for stack in make_pair(args, {**overrides, 'region': name})]
+    return [make_stack(args, {**overrides, 'region': name}) for name in regions]
+
+# Build the source and destination stacks of a SnapMirror pair
+def make_pair(args, overrides):
+    """The destination gets one DP volume per source volume, of the same size and style, and `source` points at the source stack.
+    A FlexGroup destination keeps the source's constituent count, spread over its own aggregates."""
+    destination_region = overrides.get('destination_region') or args.destination_region or overrides['region']
+    name = overrides.get('name')
+    source = make_stack(args, {**overrides, 'snapmirror': 'yes', 'snapmirror_type': 'src',
+                               **({'name': f"{name}-src"} if name else {})})
+    destination = make_stack(args, {**overrides, 'snapmirror': 'yes', 'snapmirror_type': 'dest', 'region': destination_region,
+                                    'volumes': [{key: volume[key] for key in ['name', 'size', 'style', 'constituents'] if key in volume}
+                                                for volume in source.volumes],
+                                    **({'name': f"{name}-dest"} if name else {})})
+    destination.source = source
+    return [source, destination]
+
+# Read a YAML or JSON file
+def load_document(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception(f"PyYAML is required to read {path}: pip install pyyaml, or use a JSON file")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+# Load a volume list for --volumes
+def load_volumes(path):
+    """The file holds a list of volumes, or a mapping with a `volumes` list"""
+    volumes = load_document(path)
+    if isinstance(volumes, dict):
+        volumes = volumes.get('volumes')
+    if not isinstance(volumes, list) or not volumes:
+        raise Exception(f"{path} must contain a non-empty list of volumes")
+    return volumes
+
+# Load stack definitions from a YAML or JSON manifest
+def load_manifest(path, args):
+    """The manifest holds `stacks` (a list of settings per stack) and optional `defaults` applied to every stack"""
+    manifest = load_document(path)
+
+    if not isinstance(manifest, dict) or not manifest.get('stacks'):
+        raise Exception(f"Manifest {path} must contain a non-empty 'stacks' list")
+
+    defaults = manifest.get('defaults', {})
+    stacks = []
+    for index, entry in enumerate(manifest['stacks']):
+        stacks.extend(make_stacks(args, {**defaults, 'name': f"stack-{index + 1}", **entry}))
+
+    names = [f"{stack.name} ({stack.region})" for stack in stacks]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise Exception(f"Duplicate stack names in {path}: {', '.join(duplicates)}")
+    return stacks
+
+# Preflight rules: each yields the problems it finds in one stack
+def check_storage_capacity(stack, cached):
+    low, high = storage_limits(stack.deployment_type, stack.ha_pairs)
+    if not low <= stack.storage_capacity <= high:
+        yield (f"storage capacity {stack.storage_capacity} GiB is outside {low}-{high} GiB for {stack.deployment_type}"
+               + (f" with {stack.ha_pairs} HA pairs" if stack.ha_pairs > 1 else ''))
+
+def check_disk_iops(stack, cached):
+    included = stack.storage_capacity * INCLUDED_IOPS_PER_GIB
+    most = MAX_SSD_IOPS.get(stack.throughput_capacity // stack.ha_pairs, 0) * stack.ha_pairs
+    if stack.disk_iops is not None and stack.disk_iops < included:
+        yield f"{stack.disk_iops} SSD IOPS is fewer than the {included} included with {stack.storage_capacity} GiB of storage"
+    if stack.disk_iops is not None and stack.disk_iops > most:
+        yield f"{stack.disk_iops} SSD IOPS is more than the {most} that {stack.throughput_capacity} MB/s can use"
+
+def check_volume_sizes(stack, cached):
+    low, high = VOLUME_SIZE_LIMITS
+    for volume in stack.volumes:
+        if volume['style'] == 'flexgroup':
+            if isinstance(volume.get('constituents'), int) and volume['size'] < FLEXGROUP_MIN_CONSTITUENT_SIZE * volume['constituents']:
+                yield (f"volume {volume['name']}: {volume['size']} GiB gives each of its {volume['constituents']} constituents less than "
+                       f"{FLEXGROUP_MIN_CONSTITUENT_SIZE} GiB")
+            elif volume['size'] > FLEXGROUP_MAX_SIZE:
+                yield f"volume {volume['name']}: size {volume['size']} GiB is more than the {FLEXGROUP_MAX_SIZE} GiB of a FlexGroup"
+        elif not low <= volume['size'] * 1024 <= high:
+            yield f"volume {volume['name']}: size {volume['size']} GiB is outside {low} MiB-{high // 1024} GiB"
+        elif volume['size'] > stack.storage_capacity:
+            yield f"volume {volume['name']}: size {volume['size']} GiB is larger than the storage capacity of {stack.storage_capacity} GiB"
+
+def check_volume_settings(stack, cached):
+    for volume in stack.volumes:
+        if volume['type'] not in ['RW', 'DP']:
+            yield f"volume {volume['name']}: type must be RW or DP, not {volume['type']}"
+        if volume['security_style'] not in ['UNIX', 'NTFS', 'MIXED']:
+            yield f"volume {volume['name']}: security style must be UNIX, NTFS or MIXED, not {volume['security_style']}"
+        if volume['type'] == 'RW' and not str(volume['junction_path']).startswith('/'):
+            yield f"volume {volume['name']}: junction path {volume['junction_path']!r} must start with /"
+        if volume['tiering'] not in TIERING_PROFILES:
+            yield f"volume {volume['name']}: tiering must be one of {', '.join(TIERING_PROFILES)}, not {volume['tiering']}"
+        elif volume['cooling_period'] is not None and volume['tiering'] not in ['auto', 'snapshot-only']:
+            yield f"volume {volume['name']}: a cooling period only applies to the auto and snapshot-only profiles"
+        elif volume['cooling_period'] is not None and not COOLING_PERIOD_LIMITS[0] <= volume['cooling_period'] <= COOLING_PERIOD_LIMITS[1]:
+            yield f"volume {volume['name']}: cooling period must be {COOLING_PERIOD_LIMITS[0]} to {COOLING_PERIOD_LIMITS[1]} days"
+        if not isinstance(volume['storage_efficiency'], bool):
+            yield f"volume {volume['name']}: storage_efficiency must be true or false"
+        if volume['style'] not in ['flexvol', 'flexgroup']:
+            yield f"volume {volume['name']}: style must be flexvol or flexgroup, not {volume['style']}"
+        elif volume['style'] == 'flexgroup':
+            yield from check_flexgroup_layout(stack, volume)
+        elif 'aggregates' in volume or 'constituents' in volume:
+            yield f"volume {volume['name']}: aggregates and constituents only apply to FlexGroup volumes"
+    paths = [volume['junction_path'] for volume in stack.volumes if volume['type'] == 'RW']
+    for path in sorted({path for path in paths if paths.count(path) > 1}):
+        yield f"junction path {path} is used by more than one volume"
+
+# Problems with the aggregates and constituents of a FlexGroup volume
+def check_flexgroup_layout(stack, volume):
+    aggregates, constituents = volume['aggregates'], volume['constituents']
+    for aggregate in aggregates:
+        match = AGGREGATE_PATTERN.match(str(aggregate))
+        if not match or int(match.group(1)) > stack.ha_pairs:
+            yield (f"volume {volume['name']}: aggregate {aggregate} is not one of the file system's aggregates, "
+                   f"{', '.join(f'aggr{index + 1}' for index in range(stack.ha_pairs))}")
+    if not aggregates or len(set(aggregates)) != len(aggregates):
+        yield f"volume {volume['name']}: a FlexGroup needs a list of distinct aggregates"
+    elif not isinstance(constituents, int) or constituents % len(aggregates):
+        yield f"volume {volume['name']}: {constituents} constituents cannot be spread evenly over {len(aggregates)} aggregates"
+    elif not FLEXGROUP_CONSTITUENTS_PER_AGGREGATE[0] <= constituents // len(aggregates) <= FLEXGROUP_CONSTITUENTS_PER_AGGREGATE[1]:
+        yield (f"volume {volume['name']}: {constituents // len(aggregates)} constituents per aggregate is outside "
+               f"{FLEXGROUP_CONSTITUENTS_PER_AGGREGATE[0]}-{FLEXGROUP_CONSTITUENTS_PER_AGGREGATE[1]}")
+    if stack.source:
+        source = next((other for other in stack.source.volumes if other['name'] == volume['name']), None)
+        if source and source.get('constituents') != constituents:
+            yield f"volume {volume['name']}: a SnapMirror destination FlexGroup needs the {source.get('constituents')} constituents of its source"
+
+def check_flexgroup_spread(stack, cached):
+    for volume in stack.volumes:
+        if volume['style'] == 'flexgroup' and len(set(volume['aggregates'])) < stack.ha_pairs:
+            yield f"volume {volume['name']}: FlexGroup on {len(set(volume['aggregates']))} of {stack.ha_pairs} aggregates leaves the other HA pairs idle"
+
+def check_total_volume_size(stack, cached):
+    total = sum(volume['size'] for volume in stack.volumes)
+    if len(stack.volumes) > 1 and total > stack.storage_capacity:
+        yield f"volumes add up to {total} GiB, more than the storage capacity of {stack.storage_capacity} GiB; only tiered data will fit"
+    hot = sum(volume['size'] for volume in stack.volumes if volume['tiering'] == 'hot')
+    if hot > stack.storage_capacity:
+        yield f"hot volumes add up to {hot} GiB, more than the {stack.storage_capacity} GiB SSD tier they are kept on"
+
+def check_throughput_sizing(stack, cached):
+    minimum = MIN_STORAGE_PER_THROUGHPUT.get(stack.throughput_capacity // stack.ha_pairs, 0) * stack.ha_pairs
+    if stack.storage_capacity < minimum:
+        yield f"{stack.throughput_capacity} MB/s is mostly unused with {stack.storage_capacity} GiB of storage; use at least {minimum} GiB"
+
+def check_client_fleet(stack, cached):
+    # A single default client is only there to mount the volumes; a fleet is meant to drive the file system
+    if stack.clients > 1 and stack.instance_type in NETWORK_BANDWIDTH:
+        bandwidth = round(stack.clients * NETWORK_BANDWIDTH[stack.instance_type] * 125)
+        if bandwidth < stack.throughput_capacity:
+            yield (f"{stack.clients} {stack.instance_type} clients sustain {bandwidth} MB/s, less than the {stack.throughput_capacity} MB/s "
+                   f"of throughput capacity; use --clients auto")
+    if stack.instance_type.startswith('t') and (stack.clients > 1 or stack.placement_group):
+        yield f"{stack.instance_type} is a burstable type, which only sustains its baseline bandwidth and cannot join a cluster placement group"
+
+def check_mounts(stack, cached):
+    if str(stack.nfs_version) not in NFS_VERSIONS:
+        yield f"NFS version {stack.nfs_version} must be one of {', '.join(NFS_VERSIONS)}"
+    elif stack.mount and mounted_volumes(stack):
+        # The DNS name is not known yet; SVM and file system IDs always have the same length
+        size = len(mount_user_data(stack, f"svm-{'0' * 17}.fs-{'0' * 17}.fsx.{stack.region}.amazonaws.com").encode())
+        if size > MAX_USER_DATA:
+            yield f"user-data mounting {len(mounted_volumes(stack))} volumes is {size} bytes, more than the {MAX_USER_DATA} EC2 accepts; use --no-mount"
+
+def check_fio(stack, cached):
+    if not stack.fio:
+        return
+    if not stack.instance_profile:
+        yield "--fio runs through SSM, so the clients need an instance profile with AmazonSSMManagedInstanceCore (--instance-profile)"
+    if not stack.mount:
+        yield "--fio runs on the mounted volumes; drop --no-mount"
+    elif mounted_volumes(stack):
+        volume = mounted_volumes(stack)[0]
+        needed = stack.clients * FIO_GLOBAL_OPTIONS['numjobs'] * FIO_FILE_SIZE
+        if volume['size'] < needed:
+            yield f"fio writes {needed} GiB to volume {volume_name(stack, volume)} from {stack.clients} client(s), more than its {volume['size']} GiB"
+
+def check_names(stack, cached):
+    if not SVM_NAME_PATTERN.match(svm_name(stack)):
+        yield f"SVM name {svm_name(stack)!r} must start with a letter and have at most 47 letters, digits or underscores"
+    names = [volume_name(stack, volume) for volume in stack.volumes]
+    for name in names:
+        if not VOLUME_NAME_PATTERN.match(name):
+            yield f"volume name {name!r} must start with a letter or underscore and have at most 203 letters, digits or underscores"
+    for name in sorted({name for name in names if names.count(name) > 1}):
+        yield f"volume name {name!r} is used more than once"
+
+def check_admin_password(stack, cached):
+    if not 8 <= len(stack.admin_password or '') <= 50:
+        yield "admin password must be 8 to 50 characters long"
+
+def check_tags(stack, cached):
+    if len(stack.tags) + 2 > MAX_TAGS:
+        yield f"{len(stack.tags)} tags plus Name and {TOOL_TAG['Key']} is more than the {MAX_TAGS} AWS allows"
+    for key, value in stack.tags.items():
+        if key in ['Name', TOOL_TAG['Key']]:
+            yield f"tag key {key!r} is set by this script"
+        if not 1 <= len(str(key)) <= MAX_TAG_KEY_LENGTH or str(key).lower().startswith('aws:'):
+            yield f"tag key {key!r} must be 1 to {MAX_TAG_KEY_LENGTH} characters and must not start with aws:"
+        elif len(str(value)) > MAX_TAG_VALUE_LENGTH:
+            yield f"tag {key}: value is longer than {MAX_TAG_VALUE_LENGTH} characters"
+
+def check_multi_az_subnets(stack, cached):
+    vpc_id = cached('vpc', 'default')
+    subnets = cached('subnets', subnet_query(vpc_id)) if vpc_id else None
+    if subnets is not None:
+        try:
+            deployment_subnets(stack, subnets)
+        except Exception as e:
+            yield f"{str(e)} in the default VPC {vpc_id}"
+
+def check_inventory(stack, cached):
+    # Only the local index is read, so resources created since the last refresh or run are not seen
+    account = discovery_cache.cached_account()
+    if account is None:
+        return
+    own = set(cached_ids(list(run_state.steps(stack_key(stack)).values())))
+    wanted = {volume_name(stack, volume) for volume in stack.volumes}
+    for kind, name in [('file_system', file_system_name(stack)), ('instance', instance_name(stack))]:
+        for row in inventory.query(account, stack.region, kind, glob_escape(name)):
+            if row['id'] in own:
+                continue
+            reuse = []
+            for svm in inventory.query(account, stack.region, 'svm', glob_escape(svm_name(stack)), parent_id=row['id']) if kind == 'file_system' else []:
+                volumes = sorted(volume['name'] for volume in inventory.query(account, stack.region, 'volume', parent_id=svm['id']) if volume['name'] in wanted)
+                reuse.append(f"SVM {svm['id']}" + (f" with volumes {', '.join(volumes)}" if volumes else ''))
+            yield (f"{kind.replace('_', ' ')} {name} already exists as {row['id']} ({row['lifecycle']})"
+                   + (f"; reuse candidates: {'; '.join(reuse)}" if reuse else ''))
+
+# Rules checked before a run makes any AWS call: (severity, rule). Errors stop the run, warnings are only printed.
+PREFLIGHT_RULES = [
+    ('error', check_storage_capacity),
+    ('error', check_disk_iops),
+    ('error', check_volume_sizes),
+    ('error', check_names),
+    ('error', check_volume_settings),
+    ('error', check_admin_password),
+    ('error', check_tags),
+    ('error', check_multi_az_subnets),
+    ('error', check_mounts),
+    ('error', check_fio),
+    ('warning', check_total_volume_size),
+    ('warning', check_flexgroup_spread),
+    ('warning', check_throughput_sizing),
+    ('warning', check_client_fleet),
+    ('warning', check_inventory),
+]
+
+# Check every stack against every preflight rule
+def preflight(stacks):
+    """Return (severity, stack key, problem) for everything wrong with `stacks`.
+
+    Only the arguments and the discovery cache are read, so a doomed run is
+    rejected before it creates anything, with all of its problems at once.
+    """
+    problems = []
+    for stack in stacks:
+        cached = functools.partial(discovery_cache.peek, stack.region)
+        for severity, rule in PREFLIGHT_RULES:
+            problems.extend((severity, stack_key(stack), problem) for problem in rule(stack, cached))
+    return problems
+
+# Summarise the outcome of one stack
+def stack_summary(stack, results, started, error=None):
+    # Volumes are checkpointed one by one, so the run state also has those created by a failed step
+    steps = {**run_state.steps(stack_key(stack)), **results}
+    summary = {
+        'stack': stack.name or file_system_name(stack),
+        'region': stack.region,
+        'status': 'FAILED' if error else 'CREATED',
+        'minutes': round((time.monotonic() - started) / 60, 1),
+        'file_system_id': results.get('file_system_id'),
+        'svm_id': results.get('svm_id'),
+        'volume_ids': [steps[f"volume_id:{volume['name']}"] for volume in stack.volumes if f"volume_id:{volume['name']}" in steps],
+        'tiering': list(dict.fromkeys(volume['tiering'] for volume in stack.volumes)),
+        'instance_ids': results.get('instance_ids'),
+    }
+    if error:
+        logging.error(f"Stack {summary['stack']} failed: {str(error)}")
+        summary['error'] = str(error)
+    return summary
+
+# Provision one stack and return its summary
+def provision_stack(stack):
+    graph = build_stack_graph(stack)
+    started = time.monotonic()
+    try:
+        region_context(stack.region)
+        graph.run()
+    except Exception as e:
+        return stack_summary(stack, graph.results, started, e)
+    return stack_summary(stack, graph.results, started)
+
+# Provision many stacks with bounded concurrency
+def provision_fleet(stacks, max_workers):
+    """One failed stack never stops the others; returns one summary per stack, in manifest order"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(provision_stack, stacks))
+
+# Format one value of the summary table
+def format_cell(value):
+    if isinstance(value, list) and len(value) > 3:
+        return f"{value[0]}, ..., {value[-1]} ({len(value)})"
+    if isinstance(value, list):
+        return ', '.join(value) or '-'
+    return '-' if value is None else str(value)
+
+# Print one line per stack
+def print_summary(summaries):
+    columns = ['stack', 'region', 'status', 'minutes', 'file_system_id', 'svm_id', 'volume_ids', 'tiering', 'instance_ids']
+    rows = [[format_cell(row.get(column)) for column in columns] for row in summaries]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.upper().ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+    for summary in summaries:
+        if summary['status'] == 'FAILED':
+            print(f"{summary['stack']} ({summary['region']}): {summary['error']}")
+
+    regions = sorted({summary['region'] for summary in summaries})
+    if len(regions) > 1:
+        for name in regions:
+            statuses = [summary['status'] for summary in summaries if summary['region'] == name]
+            print(f"{name}: {statuses.count('CREATED')} created, {statuses.count('FAILED')} failed")
+
+# Intercluster IP addresses of a file system, used to peer it with another one
+def intercluster_addresses(region, file_system_id):
+    response = region_context(region).fsx.describe_file_systems(FileSystemIds = [file_system_id])
+    endpoints = response['FileSystems'][0].get('OntapConfiguration', {}).get('Endpoints', {})
+    return endpoints.get('Intercluster', {}).get('IpAddresses', [])
+
+# Print the details and ONTAP commands needed to peer a SnapMirror pair
+def print_peering(source, destination, source_summary, destination_summary):
+    """Cluster names on FSx for ONTAP are FsxId followed by the file system ID"""
+    source_cluster = f"FsxId{source_summary['file_system_id'][3:]}"
+    destination_cluster = f"FsxId{destination_summary['file_system_id'][3:]}"
+    try:
+        source_addresses = ' '.join(intercluster_addresses(source.region, source_summary['file_system_id'])) or '<source intercluster IPs>'
+        destination_addresses = ' '.join(intercluster_addresses(destination.region, destination_summary['file_system_id'])) or '<destination intercluster IPs>'
+    except Exception as e:
+        logging.warning(f"Could not look up the intercluster endpoints: {str(e)}")
+        source_addresses, destination_addresses = '<source intercluster IPs>', '<destination intercluster IPs>'
+
+    lines = [
+        f"SnapMirror pair {stack_key(source)} -> {stack_key(destination)}",
+        f"  Source:      {source_cluster} ({source.region}), SVM {svm_name(source)} ({source_summary['svm_id']}), intercluster {source_addresses}",
+        f"  Destination: {destination_cluster} ({destination.region}), SVM {svm_name(destination)} ({destination_summary['svm_id']}), intercluster {destination_addresses}",
+    ]
+    for volume in source.volumes:
+        lines.append(f"  Volume:      {volume_name(source, volume)} -> {volume_name(destination, volume)} ({volume['size']} GiB)")
+    lines += [
+        "  On the destination, as fsxadmin:",
+        f"    cluster peer create -address-family ipv4 -peer-addrs {source_addresses}",
+        f"    vserver peer create -vserver {svm_name(destination)} -peer-vserver {svm_name(source)} -peer-cluster {source_cluster} -applications snapmirror",
+        "  On the source, as fsxadmin:",
+        f"    cluster peer create -address-family ipv4 -peer-addrs {destination_addresses}",
+        f"    vserver peer accept -vserver {svm_name(source)} -peer-vserver {svm_name(destination)}",
+        "  On the destination, for each volume:",
+    ]
+    for volume in source.volumes:
+        destination_path = f"{svm_name(destination)}:{volume_name(destination, volume)}"
+        lines.append(f"    snapmirror create -source-path {svm_name(source)}:{volume_name(source, volume)} -destination-path {destination_path} -policy MirrorAllSnapshots")
+        lines.append(f"    snapmirror initialize -destination-path {destination_path}")
+    for line in lines:
+        logging.info(line)
+        print(line)
+
+# The plan command
+def plan_command(args):
+    try:
+        plan = plan_capacity(args.workload)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return
+    for reason in plan['reasons']:
+        print(f"- {reason}")
+    print(f"Plan: {plan['deployment_type']}, {plan['ha_pairs']} HA pair(s), {plan['throughput_capacity']} MB/s, "
+          f"{plan['storage_capacity']} GiB, {plan['disk_iops'] or 'included'} SSD IOPS")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'workload': args.workload, **plan}, f, indent=2)
+        print(f"Create it with: python3 FSxN-CLI.py -k <key_pair> -sg <security_group> --plan {args.output}")
+    else:
+        print(f"Create it with: python3 FSxN-CLI.py -k <key_pair> -sg <security_group> -dt {plan['deployment_type']} "
+              f"-sc {plan['storage_capacity']} -tc {plan['throughput_capacity']}"
+              + (f" --ha-pairs {plan['ha_pairs']}" if plan['ha_pairs'] > 1 else '')
+              + (f" --disk-iops {plan['disk_iops']}" if plan['disk_iops'] else ''))
+
+# fio job file of the benchmark stage
+def fio_job_file(stack):
+    """Jobs are separated by stonewall, so they run one after the other and each is reported on its own"""
+    lines = ['[global]'] + [f"{key}={value}" for key, value in {**FIO_GLOBAL_OPTIONS, 'runtime': stack.fio_runtime}.items()]
+    for name, options in FIO_JOBS.items():
+        for iodepth in stack.fio_iodepths:
+            lines += ['', f"[{name}-qd{iodepth}]", 'stonewall'] + [f"{key}={value}" for key, value in {**options, 'iodepth': iodepth}.items()]
+    return '\n'.join(lines) + '\n'
+
+# Seconds the fio stage of a stack may take on one client
+def fio_timeout(stack):
+    return FIO_SETUP_SECONDS + len(FIO_JOBS) * len(stack.fio_iodepths) * (stack.fio_runtime + FIO_GLOBAL_OPTIONS['ramp_time'])
+
+# Shell commands that run the fio job matrix on a client
+def fio_commands(stack):
+    """fio runs in a directory of its own on the first mounted volume, once the user-data has mounted it, and
+    its JSON output is printed compressed, so that a whole job matrix fits in what SSM returns inline"""
+    mount_point = shlex.quote(MOUNT_ROOT + mounted_volumes(stack)[0]['junction_path'])
+    directory = f'{mount_point}/fio-"$(hostname)"'
+    return [
+        'set -euo pipefail',
+        'command -v fio > /dev/null || dnf install -y -q fio > /dev/null',
+        f"timeout {FIO_SETUP_SECONDS} bash -c 'until mountpoint -q {mount_point}; do sleep 10; done'",
+        f"mkdir -p {directory} && cd {directory}",
+        f"cat > /tmp/fsxn-cli.fio << 'JOBS'\n{fio_job_file(stack)}JOBS",
+        'fio --output-format=json /tmp/fsxn-cli.fio | gzip -9 | base64 -w0',
+        f"cd / && rm -rf {directory}",
+    ]
+
+# Throughput, IOPS and latency percentiles of each job of a fio JSON document
+def parse_fio(document):
+    """`document` is the output of fio --output-format=json. Throughput is in MB/s and the completion
+    latency percentiles are in microseconds; a direction without I/O has none."""
+    global_options = document.get('global options', {})
+    jobs = []
+    for job in document['jobs']:
+        if job.get('error'):
+            raise Exception(f"fio job {job['jobname']} failed with error {job['error']}")
+        options = {**global_options, **job.get('job options', {})}
+        parsed = {'job': job['jobname'], 'rw': options.get('rw'), 'bs': options.get('bs'), 'iodepth': int(options.get('iodepth', 1)), 'clients': 1}
+        for direction in ['read', 'write']:
+            percentiles = job[direction]['clat_ns'].get('percentile', {})
+            parsed[f"{direction}_mbps"] = job[direction]['bw_bytes'] / 1e6
+            parsed[f"{direction}_iops"] = job[direction]['iops']
+            parsed[f"{direction}_latency_us"] = {name: percentiles[key] / 1000 for name, key in FIO_PERCENTILES.items() if key in percentiles}
+        jobs.append(parsed)
+    return jobs
+
+# Combine the parsed fio output of several clients
+def merge_fio(clients):
+    """Throughput and IOPS add up over the clients; each latency percentile is that of the slowest client"""
+    merged = {}
+    for jobs in clients:
+        for job in jobs:
+            if job['job'] not in merged:
+                merged[job['job']] = {**job, 'read_latency_us': dict(job['read_latency_us']), 'write_latency_us': dict(job['write_latency_us'])}
+                continue
+            total = merged[job['job']]
+            total['clients'] += job['clients']
+            for direction in ['read', 'write']:
+                total[f"{direction}_mbps"] += job[f"{direction}_mbps"]
+                total[f"{direction}_iops"] += job[f"{direction}_iops"]
+                latencies = total[f"{direction}_latency_us"]
+                for name, value in job[f"{direction}_latency_us"].items():
+                    latencies[name] = max(latencies.get(name, 0), value)
+    return list(merged.values())
+
+# SSD IOPS a stack was provisioned with
+def provisioned_iops(stack):
+    """Provisioned or included with the storage, but never more than the throughput capacity supports"""
+    iops = stack.disk_iops or stack.storage_capacity * INCLUDED_IOPS_PER_GIB
+    return min(iops, MAX_SSD_IOPS[stack.throughput_capacity // stack.ha_pairs] * stack.ha_pairs)
+
+# Compare fio results with the provisioned throughput and IOPS
+def compare_fio(jobs, throughput_capacity, iops):
+    """The best sequential job is held against the throughput capacity and the best of the others against the SSD IOPS.
+    Reads served from the file server's cache can go beyond the SSD IOPS."""
+    checks = []
+    for kind, metric, unit, provisioned in [('sequential', 'mbps', 'MB/s', throughput_capacity), ('random', 'iops', 'IOPS', iops)]:
+        candidates = [job for job in jobs if (job['rw'] in FIO_SEQUENTIAL) == (kind == 'sequential')]
+        if not candidates:
+            continue
+        best = max(candidates, key=lambda job: job[f"read_{metric}"] + job[f"write_{metric}"])
+        value = best[f"read_{metric}"] + best[f"write_{metric}"]
+        checks.append({'kind': kind, 'job': best['job'], 'value': round(value, 1) if metric == 'mbps' else round(value), 'unit': unit, 'provisioned': provisioned,
+                       'percent': round(value / provisioned * 100), 'ok': value >= provisioned * FIO_TARGET_FRACTION})
+    return checks
+
+# Print fio results and their comparison with what was provisioned
+def print_fio(jobs, checks):
+    print(f"{'JOB':<16}{'CLIENTS':>8}{'MB/S':>10}{'IOPS':>10}{'P50 US':>10}{'P99 US':>10}{'P99.9 US':>10}")
+    for job in jobs:
+        # Latency of the slower direction, so a mixed job shows its writes
+        latency = {name: max(job['read_latency_us'].get(name, 0), job['write_latency_us'].get(name, 0)) for name in FIO_PERCENTILES}
+        print(f"{job['job']:<16}{job['clients']:>8}{round(job['read_mbps'] + job['write_mbps'], 1):>10}{round(job['read_iops'] + job['write_iops']):>10}"
+              f"{round(latency['p50']):>10}{round(latency['p99']):>10}{round(latency['p99.9']):>10}")
+    for check in checks:
+        print(f"{check['kind'].capitalize()}: {check['value']} {check['unit']} ({check['job']}) is {check['percent']}% of the provisioned "
+              f"{check['provisioned']} {check['unit']}: " + ('ok' if check['ok'] else f"below the {round(FIO_TARGET_FRACTION * 100)}% target"))
+
+# Wait until every client is online in SSM
+def wait_for_ssm(ctx, instance_ids):
+    deadline = time.monotonic() + SSM_REGISTRATION_TIMEOUT
+    while True:
+        pages = ctx.ssm.get_paginator('describe_instance_information').paginate(Filters = [{'Key': 'InstanceIds', 'Values': instance_ids}])
+        online = {info['InstanceId'] for page in pages for info in page['InstanceInformationList'] if info['PingStatus'] == 'Online'}
+        missing = [instance_id for instance_id in instance_ids if instance_id not in online]
+        if not missing:
+            return
+        if time.monotonic() > deadline:
+            raise Exception(f"{', '.join(missing)} did not come online in SSM within {SSM_REGISTRATION_TIMEOUT // 60} minutes; the clients need "
+                            f"an instance profile with AmazonSSMManagedInstanceCore and a route to the SSM endpoints")
+        time.sleep(SSM_POLL_INTERVAL)
+
+# Wait for a Run Command invocation on every client and return what each printed
+def wait_for_command(ctx, command_id, instance_ids, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        # A large fleet's invocations come in several pages
+        pages = ctx.ssm.get_paginator('list_command_invocations').paginate(CommandId = command_id)
+        statuses = {invocation['InstanceId']: invocation['Status'] for page in pages for invocation in page['CommandInvocations']}
+        if all(statuses.get(instance_id) in SSM_FINAL_STATUSES for instance_id in instance_ids):
+            break
+        if time.monotonic() > deadline:
+            raise Exception(f"Command {command_id} did not finish within {timeout // 60} minutes")
+        time.sleep(SSM_POLL_INTERVAL)
+    outputs = []
+    for instance_id in instance_ids:
+        invocation = ctx.ssm.get_command_invocation(CommandId = command_id, InstanceId = instance_id)
+        if invocation['Status'] != 'Success':
+            raise Exception(f"Command {command_id} ended {invocation['Status']} on {instance_id}: {invocation['StandardErrorContent'][-500:]}")
+        outputs.append(invocation['StandardOutputContent'])
+    return outputs
+
+# Decode the compressed fio JSON a client printed
+def decode_fio_output(output):
+    if len(output) >= SSM_MAX_OUTPUT:
+        raise Exception(f"fio output was cut off by SSM at {SSM_MAX_OUTPUT} characters; use fewer --fio-iodepths")
+    return json.loads(gzip.decompress(base64.b64decode(output)))
+
+# Run the fio job matrix on the clients of a stack
+def run_fio(stack, instance_ids):
+    """One Run Command runs the jobs on every client at once, so their throughput adds up.
+    Returns the merged jobs and their comparison with the provisioned throughput and IOPS."""
+    ctx = region_context(stack.region)
+    logging.info(f"Waiting for {', '.join(instance_ids)} to come online in SSM...")
+    wait_for_ssm(ctx, instance_ids)
+    response = ctx.ssm.send_command(
+        InstanceIds = instance_ids,
+        DocumentName = 'AWS-RunShellScript',
+        Comment = f"FSxN-CLI fio benchmark of {stack_key(stack)}"[:100],
+        Parameters = {'commands': fio_commands(stack), 'executionTimeout': [str(fio_timeout(stack))]},
+    )
+    command_id = response['Command']['CommandId']
+    logging.info(f"fio started on {len(instance_ids)} client(s) of {stack_key(stack)}: command {command_id}")
+    clients = [parse_fio(decode_fio_output(output)) for output in wait_for_command(ctx, command_id, instance_ids, fio_timeout(stack))]
+    jobs = merge_fio(clients)
+    return jobs, compare_fio(jobs, stack.throughput_capacity, provisioned_iops(stack))
+
+# Benchmark the created stacks with fio and append the results to the run report
+def fio_stage(stacks, summaries, max_workers, report):
+    """A stack whose benchmark fails is reported and skipped; its resources stay as they are"""
+    created = [(stack, summary) for stack, summary in zip(stacks, summaries) if summary['status'] == 'CREATED' and mounted_volumes(stack)]
+    if not created:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_fio, stack, summary['instance_ids']) for stack, summary in created]
+    for (stack, _), future in zip(created, futures):
+        try:
+            jobs, checks = future.result()
+        except Exception as e:
+            logging.error(f"fio benchmark of {stack_key(stack)} failed: {str(e)}")
+            print(f"fio benchmark of {stack_key(stack)} failed: {str(e)}")
+            continue
+        print(f"fio benchmark of {stack_key(stack)}:")
+        print_fio(jobs, checks)
+        try:
+            run_metrics.write_records(report, run_metrics.fio(stack, jobs, checks))
+        except OSError as e:
+            logging.warning(f"Could not add the fio results to the run report: {str(e)}")
+
+# The fio-report command
+def fio_report_command(args):
+    try:
+        clients = []
+        for path in args.outputs:
+            with open(path) as f:
+                clients.append(parse_fio(json.load(f)))
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return
+    jobs = merge_fio(clients)
+    print_fio(jobs, compare_fio(jobs, args.throughput_capacity, args.iops))
+
+# Order in which destroy deletes FSx resources; instances are terminated alongside
+DESTROY_TIERS = ['volume', 'svm', 'file_system']
+
+# Instance states that still need a terminate call
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Do a resource's tags match every key of `tags`, a dict of key -> accepted values?
+def tags_match(resource_tags, tags):
+    values = {tag['Key']: tag['Value'] for tag in resource_tags or []}
+    return all(values.get(key) in accepted for key, accepted in tags.items())
+
+# FSx resources of one kind, as ID -> {'name', 'lifecycle'}
+def describe_fsx(ctx, kind, ids=None, file_system_ids=None):
+    """By ID (missing IDs are left out), by parent file system, or every one in the region"""
+    from botocore.exceptions import ClientError
+    api, id_param, response_key, id_key = DESCRIBE_APIS[kind]
+    requests = [{}]
+    if ids is not None:
+        requests = [{id_param: ids[start:start + DESCRIBE_BATCH_SIZE]} for start in range(0, len(ids), DESCRIBE_BATCH_SIZE)]
+    elif file_system_ids is not None:
+        requests = [{'Filters': [{'Name': 'file-system-id', 'Values': file_system_ids[start:start + DESCRIBE_BATCH_SIZE]}]}
+                    for start in range(0, len(file_system_ids), DESCRIBE_BATCH_SIZE)]
+    resources = {}
+    for request in requests:
+        try:
+            pages = list(ctx.fsx.get_paginator(api).paginate(**request))
+        except ClientError as e:
+            if not e.response['Error']['Code'].endswith('NotFound'):
+                raise
+            # One missing ID fails the whole batch, like in describe_lifecycles()
+            for resource_id in request[id_param] if len(request.get(id_param, [])) > 1 else []:
+                resources.update(describe_fsx(ctx, kind, ids=[resource_id]))
+            continue
+        for page in pages:
+            for resource in page[response_key]:
+                # Root volumes go away with their SVM and cannot be deleted on their own
+                if kind == 'volume' and resource.get('OntapConfiguration', {}).get('StorageVirtualMachineRoot'):
+                    continue
+                if kind == 'file_system' and resource.get('FileSystemType', 'ONTAP') != 'ONTAP':
+                    continue
+                name = resource.get('Name') or next((tag['Value'] for tag in resource.get('Tags', []) if tag['Key'] == 'Name'), '-')
+                resources[resource[id_key]] = {'name': name, 'lifecycle': resource['Lifecycle'], 'tags': resource.get('Tags', [])}
+    return resources
+
+# EC2 instances that are not terminated yet, as ID -> {'name', 'lifecycle'}
+def describe_instances(ctx, ids=None, tags=None):
+    from botocore.exceptions import ClientError
+    filters = [{'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES + ['shutting-down']}]
+    filters += [{'Name': f"tag:{key}", 'Values': list(values)} for key, values in (tags or {}).items()]
+    instances = {}
+    try:
+        for page in ctx.ec2.get_paginator('describe_instances').paginate(Filters = filters, **({'InstanceIds': list(ids)} if ids else {})):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    name = next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), '-')
+                    instances[instance['InstanceId']] = {'name': name, 'lifecycle': instance['State']['Name']}
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+            raise
+        # One unknown ID fails the whole call, so look the others up one by one
+        for instance_id in ids if ids and len(ids) > 1 else []:
+            instances.update(describe_instances(ctx, [instance_id], tags))
+    return instances
+
+# Placement groups this script created, as name -> {'name', 'lifecycle'}
+def describe_placement_groups(ctx, names=None, tags=None):
+    """By name or by tags; groups without the created-by tag are never returned, so a group the user made is left alone"""
+    filters = [{'Name': f"tag:{TOOL_TAG['Key']}", 'Values': [TOOL_TAG['Value']]}]
+    filters += [{'Name': f"tag:{key}", 'Values': list(values)} for key, values in (tags or {}).items()]
+    if names:
+        filters.append({'Name': 'group-name', 'Values': list(names)})
+    response = ctx.ec2.describe_placement_groups(Filters = filters)
+    return {group['GroupName']: {'name': group['GroupName'], 'lifecycle': group['State']}
+            for group in response['PlacementGroups'] if group['State'] != 'deleted'}
+
+# Find what destroy deletes in one region
+def destroy_plan(ctx, file_system_ids=None, file_system_tags=None, instance_ids=None, instance_tags=None, placement_groups=None,
+                 placement_group_tags=None):
+    """Return kind -> ID -> {'name', 'lifecycle'}. File systems are picked by ID or
+    by tags; every SVM and non-root volume of those file systems is included,
+    since a file system cannot be deleted while it has any. Placement groups are
+    picked by name or by tags."""
+    plan = {'instance': {}, 'placement_group': {}, 'volume': {}, 'svm': {}, 'file_system': {}}
+    if file_system_ids:
+        plan['file_system'] = describe_fsx(ctx, 'file_system', ids=file_system_ids)
+    elif file_system_tags:
+        plan['file_system'] = {resource_id: resource for resource_id, resource in describe_fsx(ctx, 'file_system').items()
+                               if tags_match(resource['tags'], file_system_tags)}
+    if plan['file_system']:
+        for kind in ['svm', 'volume']:
+            plan[kind] = describe_fsx(ctx, kind, file_system_ids=list(plan['file_system']))
+    if instance_ids or instance_tags:
+        plan['instance'] = describe_instances(ctx, instance_ids, instance_tags)
+    if placement_groups or placement_group_tags:
+        plan['placement_group'] = describe_placement_groups(ctx, placement_groups, placement_group_tags)
+    return plan
+
+# Start deleting one resource
+def delete_resource(ctx, kind, resource_id):
+    """A resource that is already gone counts as deleted"""
+    from botocore.exceptions import ClientError
+    try:
+        if kind == 'volume':
+            ctx.fsx.delete_volume(VolumeId = resource_id, OntapConfiguration = {'SkipFinalBackup': True})
+        elif kind == 'svm':
+            ctx.fsx.delete_storage_virtual_machine(StorageVirtualMachineId = resource_id)
+        else:
+            # ONTAP takes final backups per volume, so the file system itself has no backup option
+            ctx.fsx.delete_file_system(FileSystemId = resource_id)
+    except ClientError as e:
+        if not e.response['Error']['Code'].endswith('NotFound'):
+            raise
+    logging.info(f"Deletion of {kind} {resource_id} initiated")
+
+# Wait until every resource of one tier is gone
+def wait_for_deletion(ctx, kind, resource_ids):
+    """Polls the whole tier with one batched describe, backing off from min_interval to max_interval"""
+    deadline = time.monotonic() + (wait_timeout or WAITER_SETTINGS['timeout'].get(kind, 3600))
+    delay = WAITER_SETTINGS['min_interval']
+    remaining = list(resource_ids)
+    while remaining:
+        if kind == 'instance':
+            statuses = {instance_id: instance['lifecycle'] for instance_id, instance in describe_instances(ctx, remaining).items()}
+        else:
+            statuses = describe_lifecycles(ctx.fsx, kind, remaining)
+        failed = [resource_id for resource_id, status in statuses.items() if status == 'FAILED']
+        if failed:
+            raise Exception(f"Deleting {kind} {', '.join(failed)} failed")
+        remaining = list(statuses)
+        if not remaining:
+            break
+        if time.monotonic() > deadline:
+            raise Exception(f"Timed out waiting for {kind} {', '.join(remaining)} to be deleted")
+        logging.info(f"Waiting for {len(remaining)} {kind}(s) in {ctx.region} to be deleted...")
+        time.sleep(delay * random.uniform(1 - WAITER_SETTINGS['jitter'], 1 + WAITER_SETTINGS['jitter']))
+        delay = min(delay * 2, WAITER_SETTINGS['max_interval'])
+
+# Delete one tier: every resource at once, then one batched wait for all of them
+def destroy_tier(ctx, kind, resources, max_workers):
+    """Resources already being deleted are only waited on"""
+    if not resources:
+        return
+    errors = {}
+    if kind == 'instance':
+        live = [resource_id for resource_id, resource in resources.items() if resource['lifecycle'] in LIVE_INSTANCE_STATES]
+        for start in range(0, len(live), DESCRIBE_BATCH_SIZE):
+            ctx.ec2.terminate_instances(InstanceIds = live[start:start + DESCRIBE_BATCH_SIZE])
+        logging.info(f"Termination of {len(live)} instance(s) in {ctx.region} initiated")
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            deletes = {executor.submit(delete_resource, ctx, kind, resource_id): resource_id
+                       for resource_id, resource in resources.items() if resource['lifecycle'] != 'DELETING'}
+            for future in as_completed(deletes):
+                if future.exception():
+                    errors[deletes[future]] = future.exception()
+    wait_for_deletion(ctx, kind, [resource_id for resource_id in resources if resource_id not in errors])
+    if errors:
+        raise Exception('; '.join(f"{kind} {resource_id}: {str(e)}" for resource_id, e in errors.items()))
+
+# Delete placement groups once the instances in them are terminated
+def delete_placement_groups(ctx, names):
+    """A group that is already gone counts as deleted. A later run can launch into the same group,
+    so one that still has instances is kept. Returns the number of groups deleted."""
+    from botocore.exceptions import ClientError
+    deleted = 0
+    for name in names:
+        try:
+            ctx.ec2.delete_placement_group(GroupName = name)
+            logging.info(f"Placement group {name} deleted")
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidPlacementGroup.InUse':
+                logging.warning(f"Placement group {name} in {ctx.region} still has instances of another run, kept")
+                continue
+            if e.response['Error']['Code'] != 'InvalidPlacementGroup.Unknown':
+                raise
+        deleted += 1
+    return deleted
+
+# Delete everything in a region's plan and return a summary
+def destroy_region(ctx, plan, max_workers):
+    """Instances are terminated while the FSx tiers are deleted one after the other; a failed tier stops the tiers after it.
+    Placement groups are deleted once the instances are gone."""
+    started = time.monotonic()
+    summary = {'region': ctx.region, 'deleted': {}, 'error': None}
+    errors = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        instances = executor.submit(destroy_tier, ctx, 'instance', plan['instance'], max_workers)
+        try:
+            for kind in DESTROY_TIERS:
+                tier_started = time.monotonic()
+                destroy_tier(ctx, kind, plan[kind], max_workers)
+                summary['deleted'][kind] = len(plan[kind])
+                logging.info(f"All {len(plan[kind])} {kind}(s) in {ctx.region} deleted in {int(time.monotonic() - tier_started)}s")
+        except Exception as e:
+            errors.append(str(e))
+        try:
+            instances.result()
+            summary['deleted']['instance'] = len(plan['instance'])
+            summary['deleted']['placement_group'] = delete_placement_groups(ctx, list(plan['placement_group']))
+        except Exception as e:
+            errors.append(str(e))
+    if errors:
+        summary['error'] = '; '.join(errors)
+        logging.error(f"Destroy in {ctx.region} failed: {summary['error']}")
+    summary['minutes'] = round((time.monotonic() - started) / 60, 1)
+    return summary
+
+# Work out which regions and which resources a destroy command targets
+def destroy_targets(args):
+    """Return region -> keyword arguments of destroy_plan()"""
+    targets = {}
+    if args.run:
+        if not os.path.exists(run_state_path(args.run)):
+            raise Exception(f"No saved state for run {args.run} in {os.path.dirname(run_state_path(args.run))}")
+        for key, stack in RunState(args.run).data['stacks'].items():
+            region = key.rsplit(' (', 1)[1].rstrip(')')
+            target = targets.setdefault(region, {'file_system_ids': [], 'instance_ids': [], 'placement_groups': []})
+            if stack['steps'].get('file_system_id'):
+                target['file_system_ids'].append(stack['steps']['file_system_id'])
+            if stack['steps'].get('instance_ids'):
+                target['instance_ids'].extend(stack['steps']['instance_ids'])
+            # Runs saved before client fleets have a single instance_id
+            if stack['steps'].get('instance_id'):
+                target['instance_ids'].append(stack['steps']['instance_id'])
+            if stack['steps'].get('placement_group') and stack['steps']['placement_group'] not in target['placement_groups']:
+                target['placement_groups'].append(stack['steps']['placement_group'])
+        return targets
+
+    regions = enabled_regions(os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')) if args.region == ['all-enabled'] else args.region
+    if args.tag:
+        tags = {}
+        for key, value in (tag.split('=', 1) for tag in args.tag):
+            tags.setdefault(key, []).append(value)
+        # Only what this script created; a resource someone made by hand with the same tags is left alone
+        owned = {**tags, TOOL_TAG['Key']: [TOOL_TAG['Value']]}
+        return {region: {'file_system_tags': owned, 'instance_tags': owned, 'placement_group_tags': tags} for region in regions}
+
+    # Only the stack names matter, so the create options keep their defaults. Like with --tag, a file system
+    # or instance that shares a stack's name but was not created by this script is never picked.
+    for stack in load_manifest(args.manifest, parse_args(['-k', '-sg', '-r'] + regions)):
+        target = targets.setdefault(stack.region, {'file_system_tags': {'Name': [], TOOL_TAG['Key']: [TOOL_TAG['Value']]},
+                                                   'instance_tags': {'Name': [], TOOL_TAG['Key']: [TOOL_TAG['Value']]}, 'placement_groups': []})
+        target['file_system_tags']['Name'].append(file_system_name(stack))
+        target['instance_tags']['Name'].append(instance_name(stack))
+        if stack.placement_group and stack.placement_group not in target['placement_groups']:
+            target['placement_groups'].append(stack.placement_group)
+    return targets
+
+# Print what a destroy plan deletes
+def print_plan(plans):
+    for region, plan in plans.items():
+        for kind in ['instance', 'placement_group'] + DESTROY_TIERS:
+            for resource_id, resource in plan[kind].items():
+                print(f"{region}  {kind:<16}{resource_id:<24}{resource['lifecycle']:<14}{resource['name']}")
+
+# The destroy command
+def destroy(args):
+    try:
+        targets = destroy_targets(args)
+        with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+            plans = dict(zip(targets, executor.map(lambda region: destroy_plan(region_context(region), **targets[region]), targets)))
+    except Exception as e:
+        logging.error(f"Error: {str(e)}")
+        print(f"Error: {str(e)}")
+        return
+
+    plans = {region: plan for region, plan in plans.items() if any(plan.values())}
+    if not plans:
+        print("Nothing to delete")
+        return
+    print_plan(plans)
+    if not args.yes:
+        print("Nothing was deleted; run again with --yes to delete these resources")
+        return
+
+    # Regions are independent, so they are torn down at the same time
+    with ThreadPoolExecutor(max_workers=len(plans)) as executor:
+        summaries = list(executor.map(lambda region: destroy_region(region_context(region), plans[region], args.max_workers), plans))
+    for summary in summaries:
+        # Tiers that finished are gone from AWS, so they go from the inventory too
+        plan = plans[summary['region']]
+        inventory.remove([resource_id for kind in summary['deleted'] for resource_id in plan[kind]])
+        deleted = ', '.join(f"{count} {kind}(s)" for kind, count in summary['deleted'].items() if count)
+        print(f"{summary['region']}: deleted {deleted or 'nothing'} in {summary['minutes']} minutes"
+              + (f"; failed: {summary['error']}" if summary['error'] else ''))
+
+# Seconds since the epoch of a describe timestamp, or None
+def epoch(value):
+    return value.timestamp() if hasattr(value, 'timestamp') else None
+
+# Match `name` literally in a GLOB pattern
+def glob_escape(name):
+    return re.sub(r'([*?\[])', r'[\1]', name)
+
+# Inventory row of one described FSx resource or EC2 instance
+def inventory_row(kind, resource):
+    tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags') or []}
+    if kind == 'instance':
+        return {'id': resource['InstanceId'], 'kind': kind, 'name': tags.get('Name'), 'lifecycle': resource['State']['Name'],
+                'created': epoch(resource.get('LaunchTime')), 'tags': tags,
+                'details': {'instance_type': resource.get('InstanceType'), 'subnet_id': resource.get('SubnetId')}}
+    ontap = resource.get('OntapConfiguration') or {}
+    row = {'id': resource[DESCRIBE_APIS[kind][3]], 'kind': kind, 'name': resource.get('Name') or tags.get('Name'),
+           'lifecycle': resource['Lifecycle'], 'created': epoch(resource.get('CreationTime')), 'tags': tags,
+           'file_system_id': resource.get('FileSystemId')}
+    if kind == 'file_system':
+        row['details'] = {'deployment_type': ontap.get('DeploymentType'), 'storage_capacity': resource.get('StorageCapacity'),
+                          'throughput_capacity': ontap.get('ThroughputCapacity'), 'vpc_id': resource.get('VpcId')}
+    elif kind == 'svm':
+        row['parent_id'] = resource.get('FileSystemId')
+        row['details'] = {'subtype': resource.get('Subtype')}
+    else:
+        row['parent_id'] = ontap.get('StorageVirtualMachineId')
+        row['details'] = {'size_mb': ontap.get('SizeInMegabytes'), 'junction_path': ontap.get('JunctionPath'), 'type': ontap.get('OntapVolumeType')}
+    return row
+
+# Every resource of one kind in a region, as inventory rows
+def list_inventory(ctx, kind):
+    """Instances are limited to those tagged by this script and not terminated; root volumes are left out, as in describe_fsx()"""
+    if kind == 'instance':
+        filters = [{'Name': f"tag:{TOOL_TAG['Key']}", 'Values': [TOOL_TAG['Value']]},
+                   {'Name': 'instance-state-name', 'Values': LIVE_INSTANCE_STATES + ['shutting-down']}]
+        pages = ctx.ec2.get_paginator('describe_instances').paginate(Filters = filters)
+        return [inventory_row(kind, instance) for page in pages for reservation in page['Reservations'] for instance in reservation['Instances']]
+    api, _, response_key, _ = DESCRIBE_APIS[kind]
+    return [inventory_row(kind, resource) for page in ctx.fsx.get_paginator(api).paginate() for resource in page[response_key]
+            if not (resource.get('OntapConfiguration') or {}).get('StorageVirtualMachineRoot')
+            and resource.get('FileSystemType', 'ONTAP') == 'ONTAP']
+
+# List a region and bring its inventory up to date
+def refresh_inventory(ctx, max_age=None):
+    """Skipped when the region was listed less than `max_age` seconds ago; returns (added, changed, removed) or None"""
+    account = discovery_cache.account_id(ctx.region)
+    refreshed = inventory.refreshed(account, ctx.region)
+    if max_age is not None and refreshed and time.time() - refreshed < max_age:
+        return None
+    with ThreadPoolExecutor(max_workers=len(INVENTORY_KINDS)) as executor:
+        rows = [row for kind_rows in executor.map(lambda kind: list_inventory(ctx, kind), INVENTORY_KINDS) for row in kind_rows]
+    return inventory.sync(account, ctx.region, rows, kinds=INVENTORY_KINDS)
+
+# Add what a stack created to the inventory, so the next preflight knows about it without a refresh
+def record_inventory(stack, summary):
+    steps = run_state.steps(stack_key(stack))
+    ready = summary['status'] == 'CREATED'
+    tags = lambda name: {tag['Key']: tag['Value'] for tag in stack_tags(stack, name)}
+    file_system_id, svm_id = steps.get('file_system_id'), steps.get('svm_id')
+    rows = []
+    if file_system_id:
+        rows.append({'id': file_system_id, 'kind': 'file_system', 'name': file_system_name(stack), 'file_system_id': file_system_id,
+                     'lifecycle': 'AVAILABLE' if ready else 'CREATING', 'tags': tags(file_system_name(stack)),
+                     'details': {'deployment_type': stack.deployment_type, 'storage_capacity': stack.storage_capacity,
+                                 'throughput_capacity': stack.throughput_capacity}})
+    if svm_id:
+        rows.append({'id': svm_id, 'kind': 'svm', 'name': svm_name(stack), 'parent_id': file_system_id, 'file_system_id': file_system_id,
+                     'lifecycle': 'CREATED' if ready else 'CREATING', 'tags': tags(svm_name(stack))})
+    for volume in stack.volumes:
+        volume_id = steps.get(f"volume_id:{volume['name']}")
+        if volume_id:
+            rows.append({'id': volume_id, 'kind': 'volume', 'name': volume_name(stack, volume), 'parent_id': svm_id, 'file_system_id': file_system_id,
+                         'lifecycle': 'CREATED' if ready else 'CREATING', 'tags': tags(volume_name(stack, volume)),
+                         'details': {'size_mb': volume['size'] * 1024, 'junction_path': volume.get('junction_path'), 'type': volume['type']}})
+    for instance_id in steps.get('instance_ids') or []:
+        rows.append({'id': instance_id, 'kind': 'instance', 'name': instance_name(stack), 'lifecycle': 'running' if ready else 'pending',
+                     'tags': tags(instance_name(stack)), 'details': {'instance_type': stack.instance_type}})
+    if rows:
+        inventory.sync(discovery_cache.account_id(stack.region), stack.region, rows)
+
+# Print inventory rows as a table
+def print_inventory(rows):
+    for row in rows:
+        print(f"{row['region']:<16}{row['kind']:<12}{row['id']:<24}{row['lifecycle']:<14}{row['name'] or '-':<32}{row['parent_id'] or '-'}")
+
+# The inventory command
+def inventory_command(args):
+    if args.action == 'query':
+        # Only the local index is read, so no AWS call and no credentials are needed
+        account = discovery_cache.cached_account()
+        started = time.perf_counter()
+        rows = inventory.query(account, args.region, args.kind, args.name,
+                               dict(tag.split('=', 1) for tag in args.tag), args.parent, args.has_volume, args.all)
+        print_inventory(rows)
+        print(f"{len(rows)} resource(s) in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return
+
+    try:
+        regions = enabled_regions(os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')) if args.region == ['all-enabled'] else args.region
+        max_age = args.max_age * 60 if args.max_age is not None else None
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            futures = {region: executor.submit(refresh_inventory, region_context(region), max_age) for region in regions}
+    except Exception as e:
+        logging.error(f"Error: {str(e)}")
+        print(f"Error: {str(e)}")
+        return
+    for region, future in futures.items():
+        if future.exception():
+            logging.error(f"Inventory refresh of {region} failed: {str(future.exception())}")
+            print(f"{region}: failed: {str(future.exception())}")
+        elif future.result() is None:
+            print(f"{region}: refreshed less than {args.max_age} minutes ago, skipped")
+        else:
+            print(f"{region}: {'{} added, {} changed, {} removed'.format(*future.result())}")
+
+# Run a blocking call on the async engine's bounded executor
+async def run_blocking(func, *args):
+    """Await `func(*args)` without blocking the event loop; at most --async-workers calls run at once"""
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(async_executor, functools.partial(func, *args))
+
+# asyncio counterpart of StatusPoller
+class AsyncStatusPoller:
+    """Poll every resource awaited in one region from a single asyncio task.
+
+    Uses the same batched describes and AdaptiveWaiter schedule as
+    StatusPoller, but sleeps with asyncio.sleep, so hundreds of waits
+    cost one task instead of one thread each. A cancelled wait is
+    dropped at the next poll.
+    """
+
+    def __init__(self, fsx_client):
+        import asyncio
+        self.fsx_client = fsx_client
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def wait(self, kind, resource_id, profile):
+        """Wait until the resource is ready and return its description"""
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        self.pending[(kind, resource_id)] = {
+            'waiter': AdaptiveWaiter(kind, resource_id, profile, self.fsx_client.meta.region_name),
+            'future': future,
+            'due': time.monotonic(),
+        }
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+        self.wakeup.set()
+        try:
+            return await future
+        finally:
+            self.pending.pop((kind, resource_id), None)
+
+    async def _run(self):
+        import asyncio
+        while self.pending:
+            now = time.monotonic()
+            next_due = min(entry['due'] for entry in self.pending.values())
+            if next_due > now:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), next_due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due_kinds = {kind for (kind, _), entry in self.pending.items() if entry['due'] <= now}
+            for kind in due_kinds:
+                resource_ids = [resource_id for (k, resource_id) in self.pending if k == kind]
+                try:
+                    resources = await run_blocking(describe_resources, self.fsx_client, kind, resource_ids)
+                except Exception as e:
+                    logging.warning(f"Describing {len(resource_ids)} {kind} resources failed, retrying: {str(e)}")
+                    for resource_id in resource_ids:
+                        if (kind, resource_id) in self.pending:
+                            self.pending[(kind, resource_id)]['due'] = time.monotonic() + WAITER_SETTINGS['max_interval'] / 4
+                    continue
+                # The run state is a file, so it is written off the event loop too
+                await run_blocking(record_lifecycles, resources)
+                finished = []
+                for resource_id in resource_ids:
+                    entry = self.pending.get((kind, resource_id))
+                    if entry is None or entry['future'].done():
+                        self.pending.pop((kind, resource_id), None)
+                    elif apply_status(entry, kind, resource_id, resources):
+                        finished.append(entry['waiter'])
+                        del self.pending[(kind, resource_id)]
+                if finished:
+                    await run_blocking(record_durations, finished)
+
+# Get the asyncio poller of a region for the running event loop
+def async_poller(region):
+    import asyncio
+    key = (asyncio.get_running_loop(), region)
+    if key not in async_pollers:
+        async_pollers[key] = AsyncStatusPoller(region_context(region).fsx)
+    return async_pollers[key]
+
+async_pollers = {}
+
+# Awaitable create steps
+async def async_create_file_system(stack):
+    return await run_blocking(create_file_system, stack)
+
+async def async_create_svm(stack, file_system_id):
+    return await run_blocking(create_svm, stack, file_system_id)
+
+async def async_create_volume(stack, volume, svm_id):
+    return await run_blocking(create_volume, stack, volume, svm_id)
+
+async def async_create_ec2(stack, file_system_id=None, svm_id=None):
+    return await run_blocking(create_ec2, stack, file_system_id, svm_id)
+
+# Awaitable waiters, returning the resource ID like the threaded ones
+async def async_wait_for_file_system(stack, file_system_id):
+    logging.info(f"Waiting for file system {file_system_id} to become available...")
+    await async_poller(stack.region).wait('file_system', file_system_id, stack.deployment_type)
+    return file_system_id
+
+async def async_wait_for_svm(stack, svm_id):
+    logging.info(f"Waiting for {svm_id} to become available...")
+    check_nfs_endpoint(stack, await async_poller(stack.region).wait('svm', svm_id, stack.deployment_type))
+    return svm_id
+
+async def async_wait_for_volume(stack, volume_id):
+    logging.info(f"Waiting for volume {volume_id} to become available...")
+    await async_poller(stack.region).wait('volume', volume_id, stack.deployment_type)
+    return volume_id
+
+# Provision one stack on the event loop
+async def async_provision_stack(stack, results=None):
+    """Same dependency order as build_stack_graph. Created IDs are collected in `results`.
+
+    Cancelling the returned coroutine cancels every step still in flight.
+    """
+    import asyncio
+    results = {} if results is None else results
+
+    async def step(name, func, *args):
+        # Skip steps an earlier attempt of this run finished, like checkpointed() does for threads
+        result = run_state.result(stack_key(stack), name)
+        if result is not None:
+            logging.info(f"Step {name} of {stack_key(stack)} already finished: {result}")
+            run_metrics.step(stack, name, 0, 'skipped')
+            return result
+        started = time.monotonic()
+        try:
+            result = await func(stack, *args)
+        except asyncio.CancelledError:
+            # The other branch of the stack failed
+            run_metrics.step(stack, name, time.monotonic() - started, 'cancelled')
+            raise
+        except Exception:
+            run_metrics.step(stack, name, time.monotonic() - started, 'failed')
+            raise
+        run_metrics.step(stack, name, time.monotonic() - started, 'ok')
+        await run_blocking(run_state.record, stack_key(stack), name, result)
+        return result
+
+    svm_created = asyncio.Event()
+
+    async def create_ec2_step():
+        # Like build_stack_graph, clients that mount the volumes wait for the SVM ID
+        if stack.mount and mounted_volumes(stack):
+            await svm_created.wait()
+            results['instance_ids'] = await step('instance_ids', async_create_ec2, results['file_system_id'], results['svm_id'])
+        else:
+            results['instance_ids'] = await step('instance_ids', async_create_ec2)
+
+    volume_slots = asyncio.Semaphore(stack.volume_concurrency)
+
+    async def volume_step(volume, svm_id):
+        # Waits are not limited; they share the region's batched poller
+        async with volume_slots:
+            volume_id = await step(f"volume_id:{volume['name']}", async_create_volume, volume, svm_id)
+        results[f"volume_id:{volume['name']}"] = volume_id
+        return await async_wait_for_volume(stack, volume_id)
+
+    async def create_volumes(stack, svm_id):
+        # Same steps as create_volumes(): one per create and 'volumes' for the whole set, so either engine can resume the other's run
+        volume_ids = await asyncio.gather(*(volume_step(volume, svm_id) for volume in stack.volumes), return_exceptions=True)
+        errors = {volume['name']: e for volume, e in zip(stack.volumes, volume_ids) if isinstance(e, BaseException)}
+        if errors:
+            raise Exception('; '.join(f"volume {name}: {str(e)}" for name, e in errors.items()))
+        return {volume['name']: volume_id for volume, volume_id in zip(stack.volumes, volume_ids)}
+
+    async def fsx_chain():
+        results['file_system_id'] = await step('file_system_id', async_create_file_system)
+        await step('file_system', async_wait_for_file_system, results['file_system_id'])
+        results['svm_id'] = await step('svm_id', async_create_svm, results['file_system_id'])
+        svm_created.set()
+        await step('svm', async_wait_for_svm, results['svm_id'])
+        results['volumes'] = await step('volumes', create_volumes, results['svm_id'])
+
+    tasks = [asyncio.ensure_future(fsx_chain()), asyncio.ensure_future(create_ec2_step())]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # On failure or cancellation, don't leave the other branch running
+        for task in tasks:
+            task.cancel()
+    return results
+
+# Provision many stacks on one event loop
+async def async_provision_fleet(stacks, max_workers):
+    """Async counterpart of provision_fleet, returning the same summaries"""
+    import asyncio
+    slots = asyncio.Semaphore(max_workers)
+
+    async def provision(stack):
+        async with slots:
+            results = {}
+            started = time.monotonic()
+            try:
+                await async_provision_stack(stack, results)
+            except Exception as e:
+                return stack_summary(stack, results, started, e)
+            return stack_summary(stack, results, started)
+
+    return await asyncio.gather(*(provision(stack) for stack in stacks))
+
+# Set up the process-wide state every engine needs
+def configure(args):
+    """Called by main(); code that imports this module calls it once before provisioning"""
+    global rate_limiter, api_stats, client_settings, subnet_settings, discovery_cache, duration_history, wait_timeout, async_executor, run_state, run_metrics, inventory
+    rate_limiter = RateLimiter(args.api_rate, max(1, args.api_rate * 2))
+    api_stats = ApiStats()
+    client_settings = {'max_attempts': args.max_attempts, 'max_pool_connections': args.max_pool_connections}
+    subnet_settings = {'min_free_ips': args.subnet_min_free_ips, 'tags': dict(tag.split('=', 1) for tag in args.subnet_tag)}
+    discovery_cache = DiscoveryCache(os.path.join(STATE_DIR, 'discovery-cache.json'), args.cache_mode)
+    duration_history = DurationHistory(os.path.join(STATE_DIR, 'durations.json'))
+    wait_timeout = args.wait_timeout * 60 if args.wait_timeout else None
+    async_executor = ThreadPoolExecutor(max_workers=args.async_workers, thread_name_prefix='aws-call')
+    run_state = RunState(args.resume, args.argv)
+    run_metrics = RunMetrics(run_state.run_id)
+    inventory = Inventory(os.path.join(STATE_DIR, 'inventory.sqlite'))
+
+# Set the log level in the basic configuration.  This means we will capture all our log entries and not just those at Warning or above.
+def configure_logging():
+    logging.basicConfig(
+        filename='FSxN-CLI.log',
+        level=logging.DEBUG,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+def main():
+    # Commands other than creating resources come first on the command line
+    if sys.argv[1:2] == ['destroy']:
+        args = parse_destroy_args(sys.argv[2:])
+        configure_logging()
+        configure(args)
+        return destroy(args)
+    if sys.argv[1:2] == ['plan']:
+        return plan_command(parse_plan_args(sys.argv[2:]))
+    if sys.argv[1:2] == ['fio-report']:
+        return fio_report_command(parse_fio_report_args(sys.argv[2:]))
+    if sys.argv[1:2] == ['inventory']:
+        args = parse_inventory_args(sys.argv[2:])
+        configure_logging()
+        configure(args)
+        return inventory_command(args)
+
+    # Parse command line arguments
+    args = parse_args()
+    configure_logging()
+    configure(args)
+    
+    try:
+        if args.region == ['all-enabled']:
+            args.region = enabled_regions(os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+            logging.info(f"Enabled regions: {', '.join(args.region)}")
+        if args.volumes:
+            args.volumes = load_volumes(args.volumes)
+        stacks = load_manifest(args.manifest, args) if args.manifest else make_stacks(args)
+    except Exception as e:
+        logging.error(f"Error: {str(e)}")
+        print(f"Error: {str(e)}")
+        return
+
+    # Report every problem at once, before anything is created
+    problems = preflight(stacks)
+    for severity, key, problem in problems:
+        getattr(logging, severity)(f"Preflight {severity}: {key}: {problem}")
+        print(f"{severity.capitalize()}: {key}: {problem}")
+    errors = sum(severity == 'error' for severity, _, _ in problems)
+    if errors:
+        print(f"Preflight failed with {errors} error(s); nothing was created")
+        return
+    if args.preflight_only:
+        print(f"Preflight passed for {len(stacks)} stack(s)")
+        return
+
+    run_state.start([stack_key(stack) for stack in stacks])
+    logging.info(f"{'Resuming' if args.resume else 'Starting'} run {run_state.run_id}, state saved in {run_state.path}")
+
+    # Start discovery in every region up front; a region that fails here is reported by its stacks
+    regions = sorted({stack.region for stack in stacks})
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        for name, future in zip(regions, [executor.submit(lambda name: region_context(name).discovery, name) for name in regions]):
+            if future.exception():
+                logging.error(f"Could not set up region {name}: {str(future.exception())}")
+
+    summaries = []
+    try:
+        if args.engine == 'async':
+            import asyncio
+            summaries = asyncio.run(async_provision_fleet(stacks, args.max_workers))
+        else:
+            summaries = provision_fleet(stacks, args.max_workers)
+    finally:
+        async_executor.shutdown(wait=False)
+        for ctx in region_contexts.values():
+            ctx.executor.shutdown(wait=False)
+        totals = api_stats.totals()
+        logging.info(f"AWS API calls: {totals['calls']}, retries: {totals['retries']}, throttles: {totals['throttles']}, errors: {totals['errors']}")
+
+        # Export the timings even if the run was interrupted
+        report = args.report or os.path.join(STATE_DIR, 'runs', f"{run_state.run_id}.report.jsonl")
+        try:
+            run_metrics.write_report(report, summaries)
+            if args.prometheus_file:
+                run_metrics.write_prometheus(args.prometheus_file, summaries)
+            logging.info(f"Run report written to {report}")
+        except Exception as e:
+            # A metrics problem must never stop the run state, inventory and summary below from being saved
+            logging.warning(f"Could not write the run report: {str(e)}")
+
+    for stack, summary in zip(stacks, summaries):
+        run_state.finish(stack_key(stack), summary['status'], summary.get('error'))
+        try:
+            record_inventory(stack, summary)
+        except Exception as e:
+            logging.warning(f"Could not add {summary['stack']} to the inventory: {str(e)}")
+    resume_hint = f"Continue run {run_state.run_id} with: python3 FSxN-CLI.py --resume {run_state.run_id}"
+
+    if len(summaries) > 1:
+        print_summary(summaries)
+        # Both sides of a SnapMirror pair are ready: print what is needed to start replicating
+        by_stack = {stack_key(stack): summary for stack, summary in zip(stacks, summaries)}
+        for stack in stacks:
+            if stack.source and {by_stack[stack_key(stack)]['status'], by_stack[stack_key(stack.source)]['status']} == {'CREATED'}:
+                print_peering(stack.source, stack, by_stack[stack_key(stack.source)], by_stack[stack_key(stack)])
+        if args.fio:
+            fio_stage(stacks, summaries, args.max_workers, report)
+        if any(summary['status'] == 'FAILED' for summary in summaries):
+            print(resume_hint)
+        return
+
+    summary = summaries[0]
+    if summary['status'] == 'CREATED':
+        print(f"All resource created successfully!")
+        # Show where each volume's data lives, so a volume that should stay on SSD is easy to check
+        for profile, policy in TIERING_PROFILES.items():
+            names = [volume_name(stacks[0], volume) for volume in stacks[0].volumes if volume['tiering'] == profile]
+            if names:
+                print(f"Data placement {profile} (tiering policy {policy}): {format_cell(names)}")
+        logging.debug(f"File System ID: {summary['file_system_id']}")
+        logging.debug(f"SVM ID: {summary['svm_id']}")
+        logging.debug(f"Volume ID: {summary['volume_ids'][0]}")
+        logging.debug(f"EC2 instance IDs: {', '.join(summary['instance_ids'])}")
+        if args.fio:
+            fio_stage(stacks, summaries, args.max_workers, report)
+    else:
+        logging.error(f"Error: {summary['error']}")
+        # Log whatever was created so it can be cleaned up or reused
+        for name in ['file_system_id', 'svm_id', 'volume_ids', 'instance_ids']:
+            if summary[name]:
+                logging.error(f"Created before failure: {name} = {summary[name]}")
+        print(f"Error: {summary['error']}")
+        print(resume_hint)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,18 +1,23 @@
-import boto3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # region
 region = 'ap-southeast-2'
 
-# Initialize the FSx client
-fsx_client = boto3.client('fsx', region_name=region) 
+# FSx, EC2 and SSM clients, created on first use
+clients = {}
+clients_lock = threading.Lock()
 
-# Initialize the EC2 Client
-ec2_client = boto3.client('ec2', region_name=region)
-
-# Initialize the SSM Client
-ssm_client = boto3.client('ssm', region_name=region)
+# Get a client (helper function)
+def get_client(service):
+    """Create the client of `service` the first time it is needed and reuse it afterwards"""
+    with clients_lock:
+        if service not in clients:
+            import boto3 # imported here so that loading this script stays fast
+            clients[service] = boto3.client(service, region_name=region)
+        return clients[service]
 
 # Get user choice (helper function)
 def get_user_choice(prompt, valid_options):
@@ -48,7 +53,7 @@ def get_fsx_inputs():
 # Get Security group
 def get_security_group(sg_name):
     # print(f"Fetching Security group {sg_name}...")
-    response = ec2_client.describe_security_groups(
+    response = get_client('ec2').describe_security_groups(
         Filters = [{'Name': 'group-name', 'Values': [sg_name]}]
     )
     
@@ -62,7 +67,7 @@ def get_security_group(sg_name):
 # Get default VPC
 def get_default_vpc():
     # print(f"Fetching default VPC...")
-    response = ec2_client.describe_vpcs(
+    response = get_client('ec2').describe_vpcs(
         Filters=[{
             'Name': 'is-default',
             'Values':['true']
@@ -77,59 +82,73 @@ def get_default_vpc():
     # print(f"Default VPC found: {default_vpc}")
     return default_vpc
 
-# Get subnets in default VPC
+# Get subnets in default VPC, one per availability zone
 def get_subnets(vpc_id):
     # print(f"Fetching subnets in {vpc_id}...")
-    response = ec2_client.describe_subnets(
-        Filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    pages = get_client('ec2').get_paginator('describe_subnets').paginate(
+        Filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}, {'Name': 'state', 'Values': ['available']}],
+        PaginationConfig = {'PageSize': 100}
     )
 
-    if not response['Subnets']:
-        raise Exception(f"No subnets found in the VPC: {vpc_id}")
-    
-    subnets = []
-    for subnet in response['Subnets']:
-        subnets.append(subnet['SubnetId'])
+    # Multi-AZ needs two subnets in different zones; stop reading pages once we have them
+    subnets = {}
+    for page in pages:
+        for subnet in page['Subnets']:
+            subnets.setdefault(subnet['AvailabilityZone'], subnet['SubnetId'])
+        if len(subnets) >= 2:
+            break
 
-        # if len(subnets) == 2:
-        #     break
+    if not subnets:
+        raise Exception(f"No subnets found in the VPC: {vpc_id}")
     # print(f"Subnets are: {subnets}")
-    return subnets
+    return list(subnets.values())
 
 # Get AMI Id through SSM parameter
 def get_ami(parameter_name):
     # print(f"Fetching AMI ID from SSM parameter: {parameter_name}...")
-    response = ssm_client.get_parameter(Name = parameter_name)
+    response = get_client('ssm').get_parameter(Name = parameter_name)
     ami_id = response['Parameter']['Value']
 
     # print(f"AMI ID: {ami_id}")
     return ami_id
 
+# Start resource discovery in the background
+def start_discovery(executor):
+    """Start every independent lookup at once and return them as futures resolved by the create steps"""
+    return {
+        'subnet_ids': executor.submit(lambda: get_subnets(get_default_vpc())),
+        'image_id': executor.submit(get_ami, f"/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-6.12-x86_64"),
+        'fsx_security_group': executor.submit(get_security_group, f"FSx"), # Change security group "FSx" as per your use case
+        'ec2_security_group': executor.submit(get_security_group, f"SGFor-{region}"), # Change security group "SGFor-ap-southeast-2" as per your use case
+    }
+
 # Variables
 storage_capacity = 2048 # FSx ONTAP storage capacity in GiB.
-subnet_ids = get_subnets(get_default_vpc())
 svm_name = 'svm'
 volume_size = 1024 # Volume size in GiB
 volume_name = 'data'
 admin_password = 'asdf4321' # change it as per your use case
 instance_type = 't3.medium'
-image_id = get_ami(f"/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-6.12-x86_64")
-deployment_type, snapmirror, snapmirror_type = get_fsx_inputs()
+tiering_policy = 'ALL' # NONE keeps data on SSD, AUTO and SNAPSHOT_ONLY tier cold data, ALL tiers everything
+cooling_period = None # days before cold data is tiered, 2 to 183; only for AUTO and SNAPSHOT_ONLY
+storage_efficiency = True
+snapshot_policy = 'none'
 
 # Create file system
 def create_file_system():
     print(f"Creating FSx file system: {snapmirror_type}" if snapmirror == 'yes' else f"Creating FSx file system: {deployment_type}_{region}")
+    subnet_ids = discovery['subnet_ids'].result()
     if (deployment_type == 'MULTI_AZ_1' or deployment_type == 'SINGLE_AZ_1'):
         throughput_capacity = 128 # [128, 256, 512, 1024, 2048, 4096]
     else:
         throughput_capacity = 384 # [384, 768, 1536, 3072, 6144]
 
     if (deployment_type == 'SINGLE_AZ_1' or deployment_type == 'SINGLE_AZ_2'):
-        response = fsx_client.create_file_system(
+        response = get_client('fsx').create_file_system(
             FileSystemType = 'ONTAP',
             StorageCapacity = storage_capacity,
             SubnetIds = subnet_ids[:1],
-            SecurityGroupIds = [get_security_group(f"FSx")], # Change security group "FSx" as per your use case
+            SecurityGroupIds = [discovery['fsx_security_group'].result()],
             OntapConfiguration={
                 'AutomaticBackupRetentionDays' : 0,
                 'DeploymentType' : deployment_type,
@@ -140,11 +159,13 @@ def create_file_system():
         )
 
     else:
-        response = fsx_client.create_file_system(
+        if len(subnet_ids) < 2:
+            raise Exception(f"{deployment_type} needs subnets in two availability zones, but the default VPC has subnets in only one")
+        response = get_client('fsx').create_file_system(
             FileSystemType = 'ONTAP',
             StorageCapacity = storage_capacity,
             SubnetIds = subnet_ids[:2],
-            SecurityGroupIds = [get_security_group(f"FSx")], # Change security group "FSx" as per your use case
+            SecurityGroupIds = [discovery['fsx_security_group'].result()],
             OntapConfiguration={
                 'AutomaticBackupRetentionDays' : 0,
                 'DeploymentType' : deployment_type,
@@ -163,11 +184,11 @@ def create_file_system():
 def wait_for_file_system(file_system_id):
     print(f"Waiting for file system {file_system_id} to become available...")
     while True:
-        response = fsx_client.describe_file_systems(FileSystemIds=[file_system_id])
+        response = get_client('fsx').describe_file_systems(FileSystemIds=[file_system_id])
         status = response['FileSystems'][0]['Lifecycle']
         if status == 'AVAILABLE':
             print(f"File system {file_system_id} is now available.")
-            break
+            return file_system_id
         elif status in ['FAILED', 'DELETING']:
             raise Exception(f"File system creation failed with status: {status}")
         time.sleep(30)
@@ -175,7 +196,7 @@ def wait_for_file_system(file_system_id):
 # Create storage virtual machine
 def create_svm(file_system_id):
     print(f"Creating SVM: {svm_name}_{snapmirror_type}" if snapmirror == 'yes' else f"Creating SVM: {svm_name}")
-    response = fsx_client.create_storage_virtual_machine(
+    response = get_client('fsx').create_storage_virtual_machine(
         FileSystemId = file_system_id,
         Name = f"{svm_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{svm_name}",
         RootVolumeSecurityStyle = 'UNIX',
@@ -188,11 +209,11 @@ def create_svm(file_system_id):
 def wait_for_svm(svm_id):
     print(f"Waiting for {svm_id} to become available...")
     while True:
-        response = fsx_client.describe_storage_virtual_machines(StorageVirtualMachineIds=[svm_id])
+        response = get_client('fsx').describe_storage_virtual_machines(StorageVirtualMachineIds=[svm_id])
         status = response['StorageVirtualMachines'][0]['Lifecycle']
         if status == 'CREATED':
             print(f"SVM {svm_id} is now active")
-            break
+            return svm_id
         elif status in ['FAILED', 'DELETING']:
             raise Exception(f"SVM creation failed with status: {status}")
         time.sleep(15)
@@ -202,20 +223,21 @@ def create_volume(svm_id):
     print(f"Creating data volume {volume_name}_{snapmirror_type}..." if snapmirror == 'yes' else f"Creating data volume {volume_name}...")
     
     if (snapmirror == 'yes' and snapmirror_type == 'dest'):
-        response = fsx_client.create_volume(
+        response = get_client('fsx').create_volume(
             Name = f"{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{volume_name}",
             VolumeType = 'ONTAP',
             OntapConfiguration = {        
                 'SizeInMegabytes': volume_size*1024,
                 'StorageVirtualMachineId': svm_id,
                 'TieringPolicy' : {
-                    'Name': 'ALL'
+                    'Name': tiering_policy,
+                    **({'CoolingPeriod': cooling_period} if cooling_period else {})
                 },
                 'OntapVolumeType': 'DP',
             }
         )
     else:
-        response = fsx_client.create_volume(
+        response = get_client('fsx').create_volume(
             Name = f"{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"{volume_name}",
             VolumeType = 'ONTAP',
             OntapConfiguration = {        
@@ -223,12 +245,13 @@ def create_volume(svm_id):
                 'StorageVirtualMachineId': svm_id,
                 'JunctionPath': f"/{volume_name}_{snapmirror_type}" if snapmirror == 'yes' else f"/{volume_name}",
                 'SecurityStyle': 'UNIX',
-                'StorageEfficiencyEnabled': True,
+                'StorageEfficiencyEnabled': storage_efficiency,
                 'TieringPolicy' : {
-                    'Name': 'ALL'
+                    'Name': tiering_policy,
+                    **({'CoolingPeriod': cooling_period} if cooling_period else {})
                 },
                 'OntapVolumeType': 'RW',
-                'SnapshotPolicy': 'none'
+                'SnapshotPolicy': snapshot_policy
             }
         )
     volume_id = response['Volume']['VolumeId']
@@ -239,11 +262,11 @@ def create_volume(svm_id):
 def wait_for_volume(volume_id):
     print(f"Waiting for volume {volume_id} to become available...")
     while True:
-        response = fsx_client.describe_volumes(VolumeIds=[volume_id])
+        response = get_client('fsx').describe_volumes(VolumeIds=[volume_id])
         status = response['Volumes'][0]['Lifecycle']
         if status == 'CREATED':
             print(f"Volume {volume_id} is now available")
-            break
+            return volume_id
         elif status in ['FAILED', 'DELETING']:
             raise Exception(f"Volume creation failed with sttaus: {status}")
         time.sleep(15)
@@ -252,14 +275,15 @@ def wait_for_volume(volume_id):
 # Create EC2 instance
 def create_ec2():
     print(f"Creating EC2 instance...")
-    response = ec2_client.run_instances(
-        ImageId = image_id,
+    subnet_ids = discovery['subnet_ids'].result()
+    response = get_client('ec2').run_instances(
+        ImageId = discovery['image_id'].result(),
         InstanceType = instance_type,
         KeyName = region, # change key-pair "ap-southeast-2" as per your use case
         SubnetId = subnet_ids[0],
         MaxCount = 1,
         MinCount = 1,
-        SecurityGroupIds = [get_security_group(f"SGFor-{region}")], #  # Change security group "SGFor-ap-southeast-2" as per your use case
+        SecurityGroupIds = [discovery['ec2_security_group'].result()],
         TagSpecifications = [{
             'ResourceType': 'instance',
             'Tags':[{'Key': 'Name', 'Value': f"{snapmirror_type}" if snapmirror == 'yes' else f"{deployment_type}_client_{region}"}]
@@ -271,28 +295,87 @@ def create_ec2():
     return instance_id
 
 
-def main():
-    try:
-        file_system_id = create_file_system()
-        wait_for_file_system(file_system_id)
+# Run provisioning steps as a dependency graph
+class TaskGraph:
+    """Run each step as soon as the steps it depends on have finished"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+
+    def add(self, name, func, deps=()):
+        """Register step `name`; `func` is called with the results of `deps` in order"""
+        for dep in deps:
+            if dep not in self.tasks:
+                raise Exception(f"Step {name} depends on unknown step {dep}")
+        self.tasks[name] = (func, tuple(deps))
+
+    def run(self):
+        """Run every step and return a dict of step name -> result"""
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if any(dep in self.errors or dep in self.skipped for dep in deps):
+                        self.skipped.append(name)
+                        del pending[name]
+                    elif all(dep in self.results for dep in deps):
+                        running[executor.submit(func, *[self.results[dep] for dep in deps])] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        self.errors[name] = e
+
+        if self.errors:
+            raise Exception('; '.join(f"{name} failed: {str(e)}" for name, e in self.errors.items()))
+        return self.results
 
-        svm_id = create_svm(file_system_id)
-        wait_for_svm(svm_id)
 
-        volume_id = create_volume(svm_id)
-        wait_for_volume(volume_id)
+def main():
+    # Look up the VPC, subnets, AMI and security groups while the user answers the questions
+    global discovery, deployment_type, snapmirror, snapmirror_type
+    discovery_executor = ThreadPoolExecutor(max_workers=4)
+    discovery = start_discovery(discovery_executor)
+    deployment_type, snapmirror, snapmirror_type = get_fsx_inputs()
+
+    # The EC2 client only needs the AMI, subnet and security group, so it is launched while FSx is still provisioning
+    graph = TaskGraph()
+    graph.add('file_system_id', create_file_system)
+    graph.add('file_system', wait_for_file_system, deps=['file_system_id'])
+    graph.add('svm_id', create_svm, deps=['file_system'])
+    graph.add('svm', wait_for_svm, deps=['svm_id'])
+    graph.add('volume_id', create_volume, deps=['svm'])
+    graph.add('volume', wait_for_volume, deps=['volume_id'])
+    graph.add('instance_id', create_ec2)
 
-        instance_id = create_ec2()
-        
+    try:
+        results = graph.run()
 
         print(f"All resource created successfully!")
-        print(f"File System ID: {file_system_id}")
-        print(f"SVM ID: {svm_id}")
-        print(f"Volume ID: {volume_id}")
-        print(f"EC2 instance ID: {instance_id}")
+        print(f"File System ID: {results['file_system_id']}")
+        print(f"SVM ID: {results['svm_id']}")
+        print(f"Volume ID: {results['volume_id']}")
+        print(f"EC2 instance ID: {results['instance_id']}")
         
     except Exception as e:
         print(f"Error: {str(e)}")
+        for name in ['file_system_id', 'svm_id', 'volume_id', 'instance_id']:
+            if name in graph.results:
+                print(f"Created before failure: {name} = {graph.results[name]}")
+    finally:
+        discovery_executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
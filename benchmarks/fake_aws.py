@@ -0,0 +1,418 @@
+import base64
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+from botocore.awsrequest import AWSResponse
+
+
+# Operations the fake serves, per service. Anything else fails loudly so a new API call is noticed.
+FSX_RESOURCES = {
+    # kind: (create operation, describe operation, ID prefix, response key, list key, ID key, ID filter, ready state)
+    'file_system': ('CreateFileSystem', 'DescribeFileSystems', 'fs', 'FileSystem', 'FileSystems', 'FileSystemId', 'FileSystemIds', 'AVAILABLE'),
+    'svm': ('CreateStorageVirtualMachine', 'DescribeStorageVirtualMachines', 'svm', 'StorageVirtualMachine', 'StorageVirtualMachines', 'StorageVirtualMachineId', 'StorageVirtualMachineIds', 'CREATED'),
+    'volume': ('CreateVolume', 'DescribeVolumes', 'fsvol', 'Volume', 'Volumes', 'VolumeId', 'VolumeIds', 'CREATED'),
+}
+
+# Error code of a missing resource, per kind
+NOT_FOUND = {'file_system': 'FileSystemNotFound', 'svm': 'StorageVirtualMachineNotFound', 'volume': 'VolumeNotFound'}
+
+# Sample fio output every client of a Run Command prints, compressed like the fio stage of FSxN-CLI.py does
+FIO_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fio-sample.json')
+
+# Default behaviour of the fake; every value can be overridden per scenario
+DEFAULT_PROFILE = {
+    # Median seconds and lognormal sigma of the time a resource spends CREATING, before time scaling
+    'durations': {'file_system': (1800, 0.15), 'svm': (480, 0.2), 'volume': (60, 0.3)},
+    # Median seconds and lognormal sigma of the time a resource spends DELETING (shutting-down for instances)
+    'delete_durations': {'file_system': (1200, 0.2), 'svm': (300, 0.2), 'volume': (60, 0.3), 'instance': (60, 0.3)},
+    # Median seconds and lognormal sigma of one API round trip (not scaled)
+    'latency': (0.03, 0.5),
+    # Number of subnets in the default VPC
+    'subnets': 3,
+    # Fraction of calls answered with a throttling error
+    'throttle_rate': 0.0,
+    # Fraction of file systems that end up FAILED instead of AVAILABLE
+    'file_system_failure_rate': 0.0,
+    # Fraction of RunInstances calls that fail with InsufficientInstanceCapacity
+    'launch_failure_rate': 0.0,
+    # Median seconds and lognormal sigma of an SSM Run Command, before time scaling
+    'command_duration': (600, 0.1),
+    # Simulated seconds per real second, so a 30 minute file system takes 30 minutes / time_scale
+    'time_scale': 300,
+}
+
+# A canned HTTP body for botocore to parse
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+# In-process FSx, EC2, SSM and STS backend
+class FakeAWS:
+    """Answers botocore requests from memory, through the before-send event.
+
+    Requests are still serialized, signed, retried and parsed by the real
+    botocore client, so retries, throttling and the client hooks of
+    FSxN-CLI.py behave as they do against AWS. Only the network is replaced.
+
+    Every request draws its latency, throttling and outcome from a random
+    generator of its own, seeded by the seed, the operation and how many
+    calls of that operation came before. The Nth call of an operation is
+    therefore treated the same way in every run with the same seed, however
+    the threads of FSxN-CLI.py interleave.
+    """
+
+    def __init__(self, profile=None, seed=0):
+        self.profile = {**DEFAULT_PROFILE, **(profile or {})}
+        self.seed = seed
+        self.sequences = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.tokens = {}
+        self.placement_groups = {}
+        self.commands = {}
+        self.calls = {}
+        self.counter = 0
+
+    def install(self, client):
+        client.meta.events.register('before-send', self.handle)
+        return client
+
+    def _new_id(self, prefix):
+        self.counter += 1
+        return f"{prefix}-{self.counter:017x}"
+
+    @property
+    def random(self):
+        """Random generator of the request this thread is serving"""
+        return self.local.random
+
+    def _request_random(self, operation):
+        with self.lock:
+            sequence = self.sequences[operation] = self.sequences.get(operation, 0) + 1
+        return random.Random(f"{self.seed}/{operation}/{sequence}")
+
+    def lifecycle(self, resource_id):
+        resource = self.resources[resource_id]
+        if 'deleted_at' in resource:
+            return 'DELETING' if resource['kind'] != 'instance' else 'shutting-down'
+        if time.monotonic() < resource['ready_at']:
+            return 'CREATING' if resource['kind'] != 'instance' else 'pending'
+        return resource['final']
+
+    def exists(self, resource_id):
+        """False once a deleted resource has finished DELETING; FSx then stops returning it"""
+        resource = self.resources.get(resource_id)
+        return resource is not None and time.monotonic() < resource.get('deleted_at', float('inf'))
+
+    def _delete(self, kind, resource_id):
+        with self.lock:
+            if not self.exists(resource_id):
+                raise FakeError(NOT_FOUND.get(kind, 'InvalidInstanceID.NotFound'), f"{resource_id} not found")
+            resource = self.resources[resource_id]
+            if 'deleted_at' not in resource:
+                median, sigma = self.profile['delete_durations'][kind]
+                resource['deleted_at'] = time.monotonic() + median * self.random.lognormvariate(0, sigma) / self.profile['time_scale']
+        return self.lifecycle(resource_id)
+
+    def children(self, kind, parent_id):
+        """IDs of the live SVMs of a file system, or of the live volumes of an SVM"""
+        parent_key = 'FileSystemId' if kind == 'svm' else 'StorageVirtualMachineId'
+        return [resource_id for resource_id, resource in list(self.resources.items())
+                if resource['kind'] == kind and self.exists(resource_id)
+                and (resource['params'].get(parent_key) or resource['params'].get('OntapConfiguration', {}).get(parent_key)) == parent_id]
+
+    def file_system_of(self, resource_id):
+        resource = self.resources[resource_id]
+        if resource['kind'] == 'file_system':
+            return resource_id
+        if resource['kind'] == 'svm':
+            return resource['params']['FileSystemId']
+        return self.file_system_of(resource['params']['OntapConfiguration']['StorageVirtualMachineId'])
+
+    def handle(self, request, event_name, **kwargs):
+        service, operation = event_name.split('.')[-2:]
+        region = urlparse(request.url).hostname.split('.')[1]
+        if service in ('ec2', 'sts'):
+            params = {key: values[0] for key, values in parse_qs(request.body.decode() if isinstance(request.body, bytes) else request.body or '').items()}
+        else:
+            params = json.loads(request.body or b'{}')
+
+        with self.lock:
+            self.calls[f"{service}.{operation}"] = self.calls.get(f"{service}.{operation}", 0) + 1
+        self.local.random = self._request_random(f"{service}.{operation}")
+        median, sigma = self.profile['latency']
+        time.sleep(median * self.random.lognormvariate(0, sigma))
+
+        if self.random.random() < self.profile['throttle_rate']:
+            code = 'RequestLimitExceeded' if service == 'ec2' else 'ThrottlingException'
+            return self._error(service, 400, code, 'Rate exceeded')
+        try:
+            body = getattr(self, f"_{service}_{operation}")(region, params)
+        except FakeError as e:
+            return self._error(service, 400, e.code, e.message)
+        if service in ('ec2', 'sts'):
+            return self._xml(service, operation, body)
+        return AWSResponse(request.url, 200, {'x-amzn-requestid': '1'}, RawBody(json.dumps(body).encode()))
+
+    def _error(self, service, status, code, message):
+        if service in ('ec2', 'sts'):
+            body = f"<Response><Errors><Error><Code>{code}</Code><Message>{escape(message)}</Message></Error></Errors><RequestID>1</RequestID></Response>"
+        else:
+            body = json.dumps({'__type': code, 'message': message})
+        return AWSResponse('', status, {'x-amzn-requestid': '1'}, RawBody(body.encode()))
+
+    def _xml(self, service, operation, body):
+        namespace = 'http://ec2.amazonaws.com/doc/2016-11-15/' if service == 'ec2' else 'https://sts.amazonaws.com/doc/2011-06-15/'
+        document = f'<{operation}Response xmlns="{namespace}"><requestId>1</requestId>{body}</{operation}Response>'
+        return AWSResponse('', 200, {'x-amzn-requestid': '1'}, RawBody(document.encode()))
+
+    # Create an FSx resource, honouring ClientRequestToken like FSx does
+    def _create(self, kind, params):
+        _, _, prefix, response_key, _, id_key, _, ready = FSX_RESOURCES[kind]
+        token = params.get('ClientRequestToken')
+        with self.lock:
+            if token and token in self.tokens:
+                resource_id = self.tokens[token]
+            else:
+                resource_id = self._new_id(prefix)
+                median, sigma = self.profile['durations'][kind]
+                failed = kind == 'file_system' and self.random.random() < self.profile['file_system_failure_rate']
+                duration = median * self.random.lognormvariate(0, sigma) / self.profile['time_scale']
+                self.resources[resource_id] = {'kind': kind, 'ready_at': time.monotonic() + duration,
+                                               'final': 'FAILED' if failed else ready, 'params': params}
+                if token:
+                    self.tokens[token] = resource_id
+        return {response_key: {id_key: resource_id, 'Lifecycle': self.lifecycle(resource_id)}}
+
+    def _describe(self, kind, params, region=None):
+        _, _, _, _, list_key, id_key, id_filter, _ = FSX_RESOURCES[kind]
+        resource_ids = params.get(id_filter) or [resource_id for resource_id, resource in list(self.resources.items())
+                                                 if resource['kind'] == kind and self.exists(resource_id)]
+        for resource_id in resource_ids:
+            if not self.exists(resource_id):
+                raise FakeError(NOT_FOUND[kind], f"{resource_id} not found")
+        for entry in params.get('Filters', []):
+            if entry['Name'] == 'file-system-id':
+                resource_ids = [resource_id for resource_id in resource_ids if self.file_system_of(resource_id) in entry['Values']]
+        described = []
+        for resource_id in resource_ids:
+            resource_params = self.resources[resource_id]['params']
+            ontap = {'StorageVirtualMachineRoot': False}
+            if kind == 'volume':
+                ontap['StorageVirtualMachineId'] = resource_params['OntapConfiguration']['StorageVirtualMachineId']
+            described.append({id_key: resource_id, 'Lifecycle': self.lifecycle(resource_id), 'Tags': resource_params.get('Tags', []),
+                              'Name': resource_params.get('Name'), 'FileSystemType': resource_params.get('FileSystemType'),
+                              'FileSystemId': self.file_system_of(resource_id), 'OntapConfiguration': ontap})
+            if kind == 'svm':
+                described[-1]['Endpoints'] = {'Nfs': {'DNSName': f"{resource_id}.{self.file_system_of(resource_id)}.fsx.{region}.amazonaws.com"}}
+        return {list_key: described}
+
+    def _fsx_CreateFileSystem(self, region, params):
+        return self._create('file_system', params)
+
+    def _fsx_DescribeFileSystems(self, region, params):
+        return self._describe('file_system', params)
+
+    def _fsx_CreateStorageVirtualMachine(self, region, params):
+        if self.lifecycle(params['FileSystemId']) != 'AVAILABLE':
+            raise FakeError('BadRequest', f"File system {params['FileSystemId']} is not available")
+        return self._create('svm', params)
+
+    def _fsx_DescribeStorageVirtualMachines(self, region, params):
+        return self._describe('svm', params, region)
+
+    def _fsx_CreateVolume(self, region, params):
+        return self._create('volume', params)
+
+    def _fsx_DescribeVolumes(self, region, params):
+        return self._describe('volume', params)
+
+    def _fsx_DeleteVolume(self, region, params):
+        return {'VolumeId': params['VolumeId'], 'Lifecycle': self._delete('volume', params['VolumeId'])}
+
+    def _fsx_DeleteStorageVirtualMachine(self, region, params):
+        if self.children('volume', params['StorageVirtualMachineId']):
+            raise FakeError('BadRequest', f"SVM {params['StorageVirtualMachineId']} still has volumes")
+        return {'StorageVirtualMachineId': params['StorageVirtualMachineId'], 'Lifecycle': self._delete('svm', params['StorageVirtualMachineId'])}
+
+    def _fsx_DeleteFileSystem(self, region, params):
+        if self.children('svm', params['FileSystemId']):
+            raise FakeError('BadRequest', f"File system {params['FileSystemId']} still has SVMs")
+        return {'FileSystemId': params['FileSystemId'], 'Lifecycle': self._delete('file_system', params['FileSystemId'])}
+
+    def _ssm_GetParameter(self, region, params):
+        return {'Parameter': {'Name': params['Name'], 'Type': 'String', 'Value': 'ami-0123456789abcdef0', 'Version': 1}}
+
+    # Only instances launched with an instance profile register with SSM
+    def _ssm_DescribeInstanceInformation(self, region, params):
+        instance_ids = [value for entry in params.get('Filters', []) if entry['Key'] == 'InstanceIds' for value in entry['Values']]
+        return {'InstanceInformationList': [{'InstanceId': instance_id, 'PingStatus': 'Online', 'PlatformType': 'Linux'}
+                                            for instance_id in instance_ids if self.exists(instance_id)
+                                            and self.resources[instance_id]['params'].get('IamInstanceProfile.Name')]}
+
+    def _ssm_SendCommand(self, region, params):
+        for instance_id in params['InstanceIds']:
+            if not self.exists(instance_id):
+                raise FakeError('InvalidInstanceId', f"{instance_id} is not a managed instance")
+        with self.lock:
+            command_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+            median, sigma = self.profile['command_duration']
+            ready_at = time.monotonic() + median * self.random.lognormvariate(0, sigma) / self.profile['time_scale']
+            self.commands[command_id] = {'instance_ids': params['InstanceIds'], 'ready_at': ready_at}
+        return {'Command': {'CommandId': command_id, 'DocumentName': params['DocumentName'], 'Status': 'Pending'}}
+
+    def _command_status(self, command_id):
+        return 'Success' if time.monotonic() >= self.commands[command_id]['ready_at'] else 'InProgress'
+
+    # Served in pages of MaxResults, at most 50 like SSM
+    def _ssm_ListCommandInvocations(self, region, params):
+        instance_ids = self.commands[params['CommandId']]['instance_ids']
+        start = int(params.get('NextToken', 0))
+        end = min(start + min(params.get('MaxResults', 50), 50), len(instance_ids))
+        page = {'CommandInvocations': [{'CommandId': params['CommandId'], 'InstanceId': instance_id, 'Status': self._command_status(params['CommandId'])}
+                                       for instance_id in instance_ids[start:end]]}
+        if end < len(instance_ids):
+            page['NextToken'] = str(end)
+        return page
+
+    def _ssm_GetCommandInvocation(self, region, params):
+        status = self._command_status(params['CommandId'])
+        with open(FIO_OUTPUT) as f:
+            output = base64.b64encode(gzip.compress(json.dumps(json.load(f)).encode())).decode() if status == 'Success' else ''
+        return {'CommandId': params['CommandId'], 'InstanceId': params['InstanceId'], 'Status': status,
+                'StandardOutputContent': output, 'StandardErrorContent': ''}
+
+    def _sts_GetCallerIdentity(self, region, params):
+        return '<GetCallerIdentityResult><Account>123456789012</Account><Arn>arn:aws:iam::123456789012:user/bench</Arn><UserId>BENCH</UserId></GetCallerIdentityResult>'
+
+    def _ec2_DescribeVpcs(self, region, params):
+        return '<vpcSet><item><vpcId>vpc-0123456789abcdef0</vpcId><isDefault>true</isDefault></item></vpcSet>'
+
+    def _ec2_DescribeSubnets(self, region, params):
+        # A VPC of `subnets` subnets spread over three zones, served in pages of MaxResults
+        start = int(params.get('NextToken', 0))
+        end = min(start + int(params.get('MaxResults', 1000)), self.profile['subnets'])
+        items = ''.join(f"<item><subnetId>subnet-{index + 1:017x}</subnetId><vpcId>vpc-0123456789abcdef0</vpcId>"
+                        f"<availabilityZone>{region}{'abc'[index % 3]}</availabilityZone><state>available</state>"
+                        f"<availableIpAddressCount>4091</availableIpAddressCount><defaultForAz>{str(index < 3).lower()}</defaultForAz></item>"
+                        for index in range(start, end))
+        next_token = f"<nextToken>{end}</nextToken>" if end < self.profile['subnets'] else ''
+        return f"<subnetSet>{items}</subnetSet>{next_token}"
+
+    def _ec2_DescribeSecurityGroups(self, region, params):
+        return '<securityGroupInfo><item><groupId>sg-0123456789abcdef0</groupId><groupName>bench</groupName></item></securityGroupInfo>'
+
+    def _ec2_RunInstances(self, region, params):
+        token = params.get('ClientToken')
+        with self.lock:
+            if token and token in self.tokens:
+                instance_ids = self.tokens[token]
+            elif self.random.random() < self.profile['launch_failure_rate']:
+                raise FakeError('InsufficientInstanceCapacity', 'Insufficient capacity')
+            elif params.get('Placement.GroupName') and params['Placement.GroupName'] not in self.placement_groups:
+                raise FakeError('InvalidPlacementGroup.Unknown', f"The placement group '{params['Placement.GroupName']}' is unknown")
+            else:
+                # All or nothing, like a launch with MinCount equal to MaxCount
+                instance_ids = [self._new_id('i') for _ in range(int(params['MaxCount']))]
+                tags = self._tags(params)
+                for instance_id in instance_ids:
+                    self.resources[instance_id] = {'kind': 'instance', 'ready_at': time.monotonic(), 'final': 'running', 'params': params, 'tags': tags}
+                if token:
+                    self.tokens[token] = instance_ids
+        items = ''.join(f"<item><instanceId>{instance_id}</instanceId><instanceState><code>0</code><name>pending</name></instanceState></item>"
+                        for instance_id in instance_ids)
+        return f"<instancesSet>{items}</instancesSet>"
+
+    def _ec2_CreatePlacementGroup(self, region, params):
+        with self.lock:
+            if params['GroupName'] in self.placement_groups:
+                raise FakeError('InvalidPlacementGroup.Duplicate', f"The placement group '{params['GroupName']}' already exists")
+            self.placement_groups[params['GroupName']] = {'strategy': params['Strategy'], 'tags': self._tags(params)}
+        return f"<placementGroup><groupName>{escape(params['GroupName'])}</groupName><strategy>{params['Strategy']}</strategy><state>available</state></placementGroup>"
+
+    def _ec2_DescribePlacementGroups(self, region, params):
+        filters = self._filters(params)
+        items = ''
+        for name, group in list(self.placement_groups.items()):
+            if name not in filters.get('group-name', [name]):
+                continue
+            if any(group['tags'].get(key[len('tag:'):]) not in values for key, values in filters.items() if key.startswith('tag:')):
+                continue
+            tags = ''.join(f"<item><key>{escape(key)}</key><value>{escape(value)}</value></item>" for key, value in group['tags'].items())
+            items += (f"<item><groupName>{escape(name)}</groupName><strategy>{group['strategy']}</strategy><state>available</state>"
+                      f"<tagSet>{tags}</tagSet></item>")
+        return f"<placementGroupSet>{items}</placementGroupSet>"
+
+    # A group cannot be deleted while any instance in it is not terminated yet
+    def _ec2_DeletePlacementGroup(self, region, params):
+        with self.lock:
+            if params['GroupName'] not in self.placement_groups:
+                raise FakeError('InvalidPlacementGroup.Unknown', f"The placement group '{params['GroupName']}' is unknown")
+            if any(resource['kind'] == 'instance' and resource['params'].get('Placement.GroupName') == params['GroupName'] and self.exists(resource_id)
+                   for resource_id, resource in self.resources.items()):
+                raise FakeError('InvalidPlacementGroup.InUse', f"The placement group '{params['GroupName']}' is in use")
+            del self.placement_groups[params['GroupName']]
+        return '<return>true</return>'
+
+    def _ec2_TerminateInstances(self, region, params):
+        items = ''
+        for key in sorted(key for key in params if key.startswith('InstanceId.')):
+            self._delete('instance', params[key])
+            items += f"<item><instanceId>{params[key]}</instanceId><currentState><code>32</code><name>shutting-down</name></currentState></item>"
+        return f"<instancesSet>{items}</instancesSet>"
+
+    # Tags of the first TagSpecification of an EC2 request, as a dict
+    def _tags(self, params):
+        return {params[key]: params[key[:-3] + 'Value'] for key in params if key.startswith('TagSpecification.1.Tag.') and key.endswith('.Key')}
+
+    # Filters of an EC2 request, as name -> values
+    def _filters(self, params):
+        filters = {}
+        for key in params:
+            if key.startswith('Filter.') and key.endswith('.Name'):
+                prefix = key[:-len('Name')]
+                filters[params[key]] = [params[value] for value in params if value.startswith(prefix + 'Value.')]
+        return filters
+
+    def _ec2_DescribeInstances(self, region, params):
+        instance_ids = [params[key] for key in params if key.startswith('InstanceId.')]
+        filters = self._filters(params)
+        for instance_id in instance_ids:
+            if instance_id not in self.resources:
+                raise FakeError('InvalidInstanceID.NotFound', f"The instance ID '{instance_id}' does not exist")
+        items = ''
+        for instance_id, resource in list(self.resources.items()):
+            if resource['kind'] != 'instance' or (instance_ids and instance_id not in instance_ids):
+                continue
+            state = self.lifecycle(instance_id) if self.exists(instance_id) else 'terminated'
+            if state not in filters.get('instance-state-name', [state]):
+                continue
+            if any(resource['tags'].get(name[len('tag:'):]) not in values for name, values in filters.items() if name.startswith('tag:')):
+                continue
+            tags = ''.join(f"<item><key>{escape(key)}</key><value>{escape(value)}</value></item>" for key, value in resource['tags'].items())
+            items += (f"<item><reservationId>r-{instance_id[2:]}</reservationId><instancesSet><item><instanceId>{instance_id}</instanceId>"
+                      f"<instanceState><code>16</code><name>{state}</name></instanceState><tagSet>{tags}</tagSet></item></instancesSet></item>")
+        return f"<reservationSet>{items}</reservationSet>"
+
+    def __getattr__(self, name):
+        if name.startswith('_') and name.count('_') >= 2:
+            raise NotImplementedError(f"The fake backend does not implement {name[1:].replace('_', '.', 1)}")
+        raise AttributeError(name)
+
+# An error the fake returns to the client
+class FakeError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
@@ -0,0 +1,210 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Repository root, where FSxN-CLI.py lives
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Results the suite is compared against; refresh with --update-baseline after an intended change
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# How much worse than the baseline a metric may get: (factor, absolute slack)
+TOLERANCE = {
+    'wall_seconds': (1.3, 1.0),
+    'api_calls': (1.25, 10),
+    'api_retries': (1.5, 5),
+    'peak_rss_mb': (1.25, 10),
+}
+
+# Scenarios: number of stacks, volumes per stack and their size, engine, fake backend profile, extra arguments, whether
+# to resume after the first run and whether to destroy the run afterwards
+SCENARIOS = {
+    'single': {'stacks': 1, 'engine': 'threads'},
+    'single-async': {'stacks': 1, 'engine': 'async'},
+    'fleet': {'stacks': 20, 'engine': 'threads'},
+    'fleet-async': {'stacks': 20, 'engine': 'async'},
+    'large-vpc': {'stacks': 1, 'engine': 'threads', 'profile': {'subnets': 1000}},
+    'bulk-volumes': {'stacks': 1, 'volumes': 100, 'engine': 'threads'},
+    'bulk-volumes-async': {'stacks': 1, 'volumes': 100, 'engine': 'async'},
+    'throttled-fleet': {'stacks': 20, 'engine': 'threads', 'profile': {'throttle_rate': 0.1}},
+    'failures': {'stacks': 10, 'engine': 'threads', 'profile': {'file_system_failure_rate': 0.3, 'launch_failure_rate': 0.2}},
+    'resume': {'stacks': 5, 'engine': 'threads', 'profile': {'launch_failure_rate': 1.0}, 'resume': True},
+    'destroy': {'stacks': 10, 'volumes': 5, 'engine': 'threads', 'args': ['--placement-group', 'bench'], 'destroy': True},
+    # Prometheus export of a default run, which has mount records as well as steps, waits and API calls
+    'prometheus': {'stacks': 1, 'engine': 'threads', 'args': ['--prometheus-file', 'metrics.prom']},
+    # More clients than the 50 command invocations SSM lists per page
+    'fio': {'stacks': 2, 'volume_size': 1024, 'engine': 'threads', 'args': ['--fio', '--instance-profile', 'bench', '--clients', '60']},
+}
+
+# Load FSxN-CLI.py as a module
+def load_cli():
+    spec = importlib.util.spec_from_file_location('fsxn_cli', os.path.join(ROOT, 'FSxN-CLI.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Run FSxN-CLI's main() with the given arguments, hiding its output
+def run_main(module, argv):
+    sys.argv = ['FSxN-CLI'] + argv
+    module.region_contexts.clear()
+    started = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.main()
+    return time.monotonic() - started
+
+# ID of the run FSxN-CLI saved in `workdir`
+def saved_run_id(workdir):
+    return [entry[:-len('.state.jsonl')] for entry in os.listdir(os.path.join(workdir, 'runs')) if entry.endswith('.state.jsonl')][0]
+
+# Whether the Prometheus file of a scenario was written, with the gauges of the run itself
+def prometheus_exported(workdir):
+    try:
+        with open(os.path.join(workdir, 'metrics.prom')) as f:
+            return any(line.startswith('fsxn_run_duration_seconds ') for line in f)
+    except FileNotFoundError:
+        return False
+
+# Run one scenario in this process and return its measurements
+def run_scenario(name, time_scale, seed):
+    scenario = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix=f"fsxn-bench-{name}-")
+    os.chdir(workdir)
+    os.environ.update({
+        'FSXN_CLI_HOME': workdir,
+        'AWS_ACCESS_KEY_ID': 'AKIABENCHMARK',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+    })
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    from fake_aws import FakeAWS
+
+    # botocore draws the jitter of its retry backoff from the random module
+    random.seed(seed)
+    module = load_cli()
+    backend = FakeAWS({**scenario.get('profile', {}), 'time_scale': time_scale}, seed)
+    make_client = module.make_client
+    module.make_client = lambda session, service, region: backend.install(make_client(session, service, region))
+
+    # Scale the waiter by the same factor as the fake, so polling behaves as it would against AWS
+    for key in ['min_interval', 'max_interval', 'misconfigured_grace']:
+        module.WAITER_SETTINGS[key] /= time_scale
+    module.WAITER_SETTINGS['timeout'] = {kind: seconds / time_scale for kind, seconds in module.WAITER_SETTINGS['timeout'].items()}
+    for kind in module.DEFAULT_DURATIONS:
+        module.DEFAULT_DURATIONS[kind] /= time_scale
+    module.SSM_POLL_INTERVAL /= time_scale
+
+    manifest = os.path.join(workdir, 'manifest.json')
+    with open(manifest, 'w') as f:
+        volumes = [{'name': f"vol{index + 1}", 'size': scenario.get('volume_size', 10)} for index in range(scenario.get('volumes', 1))]
+        json.dump({'stacks': [{'name': f"bench-{index + 1}", 'volumes': volumes} for index in range(scenario['stacks'])]}, f)
+    report = os.path.join(workdir, 'report.jsonl')
+    argv = ['-k', 'bench', '-sg', 'bench', '--manifest', manifest, '--engine', scenario['engine'],
+            '--max-workers', str(scenario['stacks']), '--api-rate', '20', '--report', report] + scenario.get('args', [])
+
+    wall = run_main(module, argv)
+    if scenario.get('resume'):
+        backend.profile['launch_failure_rate'] = 0
+        wall += run_main(module, ['--resume', saved_run_id(workdir)])
+    if scenario.get('destroy'):
+        wall += run_main(module, ['destroy', '--run', saved_run_id(workdir), '--yes', '--api-rate', '20'])
+
+    with open(report) as f:
+        records = list(map(json.loads, f))
+    runs = [record for record in records if record['type'] == 'run']
+    return {
+        'scenario': name,
+        'stacks': scenario['stacks'],
+        'created': runs[-1]['created'],
+        'failed': runs[-1]['failed'],
+        'wall_seconds': round(wall, 2),
+        'api_calls': sum(run['api_calls'] for run in runs),
+        'api_retries': sum(run['api_retries'] for run in runs),
+        'api_throttles': sum(run['api_throttles'] for run in runs),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'remaining': sum(backend.exists(resource_id) for resource_id in backend.resources) + len(backend.placement_groups) if scenario.get('destroy') else 0,
+        'benchmarked': len({record['stack'] for record in records if record['type'] == 'fio'}) if '--fio' in scenario.get('args', []) else None,
+        'exported': prometheus_exported(workdir) if '--prometheus-file' in scenario.get('args', []) else None,
+        'calls': dict(sorted(backend.calls.items())),
+    }
+
+# Names of the metrics of `result` that are worse than `baseline` allows
+def regressions(result, baseline):
+    worse = []
+    for metric, (factor, slack) in TOLERANCE.items():
+        if metric in baseline and result[metric] > baseline[metric] * factor + slack:
+            worse.append(f"{metric} {result[metric]} (baseline {baseline[metric]})")
+    if result['created'] + result['failed'] != result['stacks']:
+        worse.append(f"only {result['created'] + result['failed']} of {result['stacks']} stacks finished")
+    if result.get('remaining'):
+        worse.append(f"{result['remaining']} resources left after destroy")
+    if result.get('exported') is False:
+        worse.append("no Prometheus file with the run's gauges")
+    if result.get('benchmarked') is not None and result['benchmarked'] != result['created']:
+        worse.append(f"fio results for only {result['benchmarked']} of {result['created']} stacks")
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FSxN-CLI.py orchestration against an in-process fake of FSx, EC2, SSM and STS')
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--time-scale', type=float, default=600, help='Simulated seconds per real second (default: 600, so a 30 minute file system takes 3 seconds)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the fake latencies and failures (default: 1)')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--update-baseline', action='store_true', help=f"Save the results as the new baseline in {os.path.relpath(BASELINE, ROOT)}")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    # Child process: run one scenario and print its result
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, args.time_scale, args.seed)))
+        return
+
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    # Every scenario runs in its own process, so peak memory is per scenario
+    results = {}
+    failed = False
+    print(f"{'Scenario':<18}{'Stacks':>7}{'Created':>8}{'Failed':>7}{'Wall s':>8}{'API calls':>10}{'Retries':>8}{'Peak MB':>8}  Regressions")
+    for name in args.scenarios or SCENARIOS:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+                                '--time-scale', str(args.time_scale), '--seed', str(args.seed)],
+                               capture_output=True, text=True)
+        if child.returncode != 0:
+            print(f"{name:<18}failed:\n{child.stderr}")
+            failed = True
+            continue
+        result = results[name] = json.loads(child.stdout.splitlines()[-1])
+        worse = regressions(result, baseline.get(name, {}))
+        failed = failed or bool(worse)
+        print(f"{name:<18}{result['stacks']:>7}{result['created']:>8}{result['failed']:>7}{result['wall_seconds']:>8}"
+              f"{result['api_calls']:>10}{result['api_retries']:>8}{result['peak_rss_mb']:>8}  {'; '.join(worse) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(BASELINE, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline updated: {BASELINE}")
+    elif failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Repository root, where FSxN-CLI.py and FSxN.py live
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be loaded before an AWS call is about to happen
+HEAVY_MODULES = ['boto3', 'botocore', 'asyncio']
+
+# Load FSxN.py without running main(), the way another script would reuse its functions
+LOAD_FSXN = (
+    "import importlib.util; "
+    f"spec = importlib.util.spec_from_file_location('fsxn', {os.path.join(ROOT, 'FSxN.py')!r}); "
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+)
+
+# Commands to time: name -> arguments for the python interpreter
+CASES = {
+    'python -c pass (baseline)': ['-c', 'pass'],
+    'FSxN-CLI.py -h': [os.path.join(ROOT, 'FSxN-CLI.py'), '-h'],
+    'FSxN-CLI.py (missing arguments)': [os.path.join(ROOT, 'FSxN-CLI.py')],
+    'FSxN-CLI.py (bad throughput)': [os.path.join(ROOT, 'FSxN-CLI.py'), '-k', 'demo-key', '-sg', 'demo-sg', '-dt', 'MULTI_AZ_2', '-tc', '128'],
+    'FSxN-CLI.py fio-report (sample)': [os.path.join(ROOT, 'FSxN-CLI.py'), 'fio-report', os.path.join(ROOT, 'benchmarks', 'fio-sample.json'), '-tc', '384', '--iops', '6144'],
+    'load FSxN.py': ['-c', LOAD_FSXN],
+}
+
+# Run one case and return its wall time in milliseconds
+def run_once(args, cwd):
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - started) * 1000
+
+# Names of the heavy modules a case imports
+def heavy_imports(args, cwd):
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')}
+    return [name for name in HEAVY_MODULES if name in imported]
+
+def main():
+    parser = argparse.ArgumentParser(description='Time how long FSxN-CLI.py and FSxN.py take to start without calling AWS')
+    parser.add_argument('-n', '--runs', type=int, default=20, help='Runs per case (default: 20)')
+    args = parser.parse_args()
+
+    # Run from an empty directory, so a log file written too early would show up
+    with tempfile.TemporaryDirectory() as cwd:
+        os.environ['FSXN_CLI_HOME'] = cwd
+        print(f"{'Case':<34}{'Min ms':>8}{'Median ms':>11}  Heavy imports")
+        for name, case_args in CASES.items():
+            times = [run_once(case_args, cwd) for _ in range(args.runs)]
+            heavy = heavy_imports(case_args, cwd)
+            print(f"{name:<34}{min(times):>8.1f}{statistics.median(times):>11.1f}  {', '.join(heavy) or '-'}")
+        if os.listdir(cwd):
+            print(f"Files written without calling AWS: {', '.join(os.listdir(cwd))}")
+
+if __name__ == "__main__":
+    main()